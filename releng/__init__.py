@@ -40,25 +40,52 @@ def run_build(build, job_type, opts, project=Project.GROMACS):
     """
     from context import BuildContext
     from factory import ContextFactory
+    from profiling import profile
     # Please ensure that __main__.py stays in sync.
     factory = ContextFactory(default_project=project)
     with factory.status_reporter:
-        BuildContext._run_build(factory, build, job_type, opts)
+        with profile(factory, 'run_build'):
+            BuildContext._run_build(factory, build, job_type, opts)
 
-def read_build_script_config(script_name):
-    """Reads build options specified in a build script.
+def run_builds(build, job_type, opts_list, project=Project.GROMACS):
+    """Entry point for running several configurations in a single build.
+
+    Runs the build script once for each set of build options, sequentially
+    in the same process, with a single checkout of the projects.  This
+    avoids paying the setup cost of a build for each configuration, which
+    dominates for short configurations on slow agents.
+
+    Each configuration gets its own build directory (:file:`build/config-{N}`
+    for out-of-source builds) and log directory (:file:`logs/config-{N}`),
+    and its failures are reported prefixed with its name.  A failure in one
+    configuration does not prevent building the others.
 
     Args:
-        script_name (str): Name of the build script (see run_build()).
+        build (str): Build type identifying the build script to use
+            (see run_build()).
+        job_type (JobType): Type/scope of the job.
+        opts_list (List[List[str]]): Build options for each configuration.
+
+    Returns the result (``SUCCESS``, ``UNSTABLE``, or ``FAILURE``) for each
+    configuration through the status file.
     """
     from context import BuildContext
     from factory import ContextFactory
-    factory = ContextFactory()
+    from profiling import profile
+    factory = ContextFactory(default_project=project)
     with factory.status_reporter as status:
-        config = BuildContext._read_build_script_config(factory, script_name)
-        status.return_value = config
+        with profile(factory, 'run_builds'):
+            status.return_value = BuildContext._run_builds(factory, build, job_type, opts_list)
 
-def prepare_multi_configuration_build(configfile):
+def read_build_script_config(script_name):
+    """Reads build options specified in a build script.
+
+    Args:
+        script_name (str): Name of the build script (see run_build()).
+    """
+    _run_operation(_read_build_script_config, script_name)
+
+def prepare_multi_configuration_build(configfile, shards=1, job_type=JobType.GERRIT):
     """Main entry point for preparing matrix builds.
 
     Reads a file with configurations to use (one configuration per line,
@@ -69,30 +96,47 @@ def prepare_multi_configuration_build(configfile):
         configfile (str): File that contains the configurations to use.
             Names without directory separators are interpreted as
             :file:`gromacs/admin/builds/{configfile}.txt`.
+        shards (int): If larger than one, the configurations are also split
+            into this many shards with roughly equal estimated cost, each of
+            which can be built by a separate matrix build.
+        job_type (JobType): Type of the job that builds the configurations.
+            Results recorded in the result store are only reused for the
+            same job type.
     """
-    from factory import ContextFactory
-    from matrixbuild import prepare_build_matrix
-    factory = ContextFactory()
-    with factory.status_reporter as status:
-        status.return_value = prepare_build_matrix(factory, configfile)
+    _run_operation(_prepare_multi_configuration_build, configfile, shards, job_type)
 
 def process_multi_configuration_build_results(inputfile):
     """Processes results after a matrix build has been run.
 
     Reads a JSON file that provides information about the configurations
     (the output from prepare_multi_configuration_build()) and the URL of
-    the finished Jenkins matrix build.
+    the finished Jenkins matrix build.  For a sharded matrix, the file
+    provides a list of URLs, one for the build of each shard, and the results
+    from all of them are merged.  If the file also provides the URL of a
+    build that retried configurations with infrastructure failures, the runs
+    in that build replace the original runs.
     Reads information about the executed build using Jenkins REST API and
     verifies that all configurations were built.
 
     Args:
         inputfile (str): File to read the input from, relative to working dir.
     """
-    from factory import ContextFactory
-    from matrixbuild import process_matrix_results
-    factory = ContextFactory()
-    with factory.status_reporter as status:
-        status.return_value = process_matrix_results(factory, inputfile)
+    _run_operation(_process_multi_configuration_build_results, inputfile)
+
+def merge_test_results(inputs, output):
+    """Merges JUnit test results from several test shards.
+
+    Used when the tests of a configuration are split into shards with the
+    ``test-shard`` build option and run in separate builds; the results of
+    run_ctest() from each shard are combined into one report.  The build
+    fails if the inputs are not the results of all the shards, or if some
+    test is reported more than once.
+
+    Args:
+        inputs (List[str]): JUnit XML files to merge, relative to working dir.
+        output (str): File to write the merged results to.
+    """
+    _run_operation(_merge_test_results, inputs, output)
 
 def get_actions_from_triggering_comment():
     """Processes Gerrit comment that triggered the build.
@@ -100,11 +144,7 @@ def get_actions_from_triggering_comment():
     Parses the comment that triggered an on-demand build and returns a
     structure that tells the workflow build what it needs to do.
     """
-    from factory import ContextFactory
-    from ondemand import get_actions_from_triggering_comment
-    factory = ContextFactory()
-    with factory.status_reporter as status:
-        status.return_value = get_actions_from_triggering_comment(factory)
+    _run_operation(_get_actions_from_triggering_comment)
 
 def do_ondemand_post_build(inputfile):
     """Does processing after on-demand builds have finished.
@@ -119,11 +159,7 @@ def do_ondemand_post_build(inputfile):
     Args:
         inputfile (str): File to read the input from, relative to working dir.
     """
-    from factory import ContextFactory
-    from ondemand import do_post_build
-    factory = ContextFactory()
-    with factory.status_reporter as status:
-        status.return_value = do_post_build(factory, inputfile)
+    _run_operation(_do_ondemand_post_build, inputfile)
 
 def get_build_revisions():
     """Provides information about revisions used in the build.
@@ -131,10 +167,7 @@ def get_build_revisions():
     Returns a structure that provides a list of projects and their revisions
     used in this build.
     """
-    from factory import ContextFactory
-    factory = ContextFactory()
-    with factory.status_reporter as status:
-        status.return_value = factory.projects.get_build_revisions()
+    _run_operation(_get_build_revisions)
 
 def read_source_version_info():
     """Reads version info from the source repository.
@@ -142,13 +175,99 @@ def read_source_version_info():
     Returns a structure that provides version information from the source
     repository.
     """
-    from context import BuildContext
+    _run_operation(_read_source_version_info)
+
+def run_batch(operations):
+    """Runs several of the entry points above in a single invocation.
+
+    All the operations share the same project checkouts and environment,
+    so the startup and project initialization cost is only paid once.
+    The operations are run in the given order, and the return value is a
+    dictionary that maps the name of each operation to the value that the
+    corresponding individual call would return.  If an operation fails,
+    the return values of operations that already completed are still
+    reported.
+
+    Args:
+        operations (List): Operations to run.  Each item is either a name of
+            an entry point that takes no arguments (e.g.,
+            ``'get_build_revisions'``), or a list with the name followed by
+            the arguments (e.g.,
+            ``['read_build_script_config', 'clang-format']``).
+            Each operation can appear only once.
+    """
+    _run_operation(_run_batch, operations)
+
+def _run_operation(operation, *args):
+    """Runs an operation with a default factory and reports its return value."""
     from factory import ContextFactory
+    from profiling import profile
     factory = ContextFactory()
     with factory.status_reporter as status:
-        context = BuildContext._run_build(factory, 'get-version-info', JobType.GERRIT, None)
-        version, regtest_md5sum = context._get_version_info()
-        status.return_value = {
-                'version': version,
-                'regressiontestsMd5sum': regtest_md5sum
-            }
+        with profile(factory, operation.__name__.lstrip('_')):
+            status.return_value = operation(factory, *args)
+
+def _read_build_script_config(factory, script_name):
+    from context import BuildContext
+    return BuildContext._read_build_script_config(factory, script_name)
+
+def _prepare_multi_configuration_build(factory, configfile, shards=1, job_type=JobType.GERRIT):
+    from matrixbuild import prepare_build_matrix
+    return prepare_build_matrix(factory, configfile, shards, job_type)
+
+def _process_multi_configuration_build_results(factory, inputfile):
+    from matrixbuild import process_matrix_results
+    return process_matrix_results(factory, inputfile)
+
+def _merge_test_results(factory, inputs, output):
+    from cmake import merge_junit_xml
+    merge_junit_xml(factory.executor, inputs, output)
+
+def _get_actions_from_triggering_comment(factory):
+    from ondemand import get_actions_from_triggering_comment
+    return get_actions_from_triggering_comment(factory)
+
+def _do_ondemand_post_build(factory, inputfile):
+    from ondemand import do_post_build
+    return do_post_build(factory, inputfile)
+
+def _get_build_revisions(factory):
+    return factory.projects.get_build_revisions()
+
+def _read_source_version_info(factory):
+    from context import BuildContext
+    context = BuildContext._run_build(factory, 'get-version-info', JobType.GERRIT, None)
+    version, regtest_md5sum = context._get_version_info()
+    return {
+            'version': version,
+            'regressiontestsMd5sum': regtest_md5sum
+        }
+
+# Operations that can be combined with run_batch().
+_BATCH_OPERATIONS = {
+        'read_build_script_config': _read_build_script_config,
+        'prepare_multi_configuration_build': _prepare_multi_configuration_build,
+        'process_multi_configuration_build_results': _process_multi_configuration_build_results,
+        'merge_test_results': _merge_test_results,
+        'get_actions_from_triggering_comment': _get_actions_from_triggering_comment,
+        'do_ondemand_post_build': _do_ondemand_post_build,
+        'get_build_revisions': _get_build_revisions,
+        'read_source_version_info': _read_source_version_info
+    }
+
+def _run_batch(factory, operations):
+    from common import ConfigurationError
+    results = dict()
+    # Report partial results also if some operation fails.
+    factory.status_reporter.return_value = results
+    for operation in operations:
+        if isinstance(operation, basestring):
+            name, args = operation, []
+        else:
+            name, args = operation[0], list(operation[1:])
+        if name not in _BATCH_OPERATIONS:
+            raise ConfigurationError('unknown batch operation: ' + name)
+        if name in results:
+            raise ConfigurationError('batch operation requested multiple times: ' + name)
+        results[name] = _BATCH_OPERATIONS[name](factory, *args)
+    return results
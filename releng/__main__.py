@@ -13,18 +13,23 @@ import os
 import six
 
 from common import Project
-from context import BuildContext
 from factory import ContextFactory
-import matrixbuild
+from profiling import profile
+
+# The modules needed by the subcommands are imported in the functions below,
+# similar to the entry points in __init__.py.
 
 def run_build(args, factory):
+    from context import BuildContext
     BuildContext._run_build(factory, args.script, args.job_type, args.opts)
 
 def prepare_matrix(args, factory):
+    import matrixbuild
     status = factory.status_reporter
     status.return_value = matrixbuild.prepare_build_matrix(factory, args.matrix)
 
 def process_matrix(args, factory):
+    import matrixbuild
     status = factory.status_reporter
     if args.input_file:
         status.return_value = matrixbuild.process_matrix_results(factory, args.input_file)
@@ -92,4 +97,5 @@ if not args.run:
     factory.init_executor(cls=DryRunExecutor)
 factory.init_gerrit_integration(user=args.user)
 with factory.status_reporter as status:
-    args.func(args, factory)
+    with profile(factory, args.func.__name__):
+        args.func(args, factory)
@@ -0,0 +1,187 @@
+"""
+Partitioning of CPUs between concurrent builds on one agent
+
+On agents with several executors, concurrent builds otherwise compete for
+the same cores and caches.  This module splits the CPUs available to the
+process into disjoint slots (one per executor), keeping hyperthreads of a
+core and, where possible, cores of a NUMA node in the same slot.  A build
+claims a free slot by locking a file in a node-local directory, and the
+commands it runs are pinned to the CPUs of the slot.
+
+This is only supported on Linux; elsewhere, no slot is claimed.
+"""
+from __future__ import print_function
+
+import os
+
+import hardware
+
+def _read_cpu_list(executor, path):
+    try:
+        lines = list(executor.read_file(path))
+    except (IOError, OSError):
+        return None
+    if not lines:
+        return None
+    return hardware.parse_cpu_list(lines[0])
+
+def get_cpu_topology(executor, cpus):
+    """Groups CPUs into NUMA nodes and physical cores.
+
+    Args:
+        executor (Executor): Executor for reading system information.
+        cpus (List[int]): CPUs to consider.
+
+    Returns:
+        List[List[List[int]]]: For each NUMA node, a list of cores, each a
+            list of the hardware threads (restricted to cpus) in it.
+            If the topology cannot be read, each CPU is treated as a separate
+            core and all CPUs as a single node.
+    """
+    cpus = set(cpus)
+    nodes = []
+    node_ids = _read_cpu_list(executor, '/sys/devices/system/node/online') or []
+    for node_id in node_ids:
+        node_cpus = _read_cpu_list(executor,
+                '/sys/devices/system/node/node{0}/cpulist'.format(node_id))
+        if node_cpus:
+            node_cpus = [x for x in node_cpus if x in cpus]
+            if node_cpus:
+                nodes.append(node_cpus)
+    covered = set()
+    for node_cpus in nodes:
+        covered.update(node_cpus)
+    if covered != cpus:
+        nodes = [sorted(cpus)]
+    result = []
+    for node_cpus in nodes:
+        cores = []
+        seen = set()
+        for cpu in node_cpus:
+            if cpu in seen:
+                continue
+            siblings = _read_cpu_list(executor,
+                    '/sys/devices/system/cpu/cpu{0}/topology/thread_siblings_list'.format(cpu))
+            core = sorted(set(siblings or [cpu]) & set(node_cpus) | {cpu})
+            seen.update(core)
+            cores.append(core)
+        result.append(cores)
+    return result
+
+def partition_cpus(topology, count):
+    """Splits CPUs into disjoint slots.
+
+    Cores are distributed as evenly as possible between the slots, in the
+    order of the NUMA nodes, so that each slot spans as few nodes as
+    possible.  Hyperthreads of a core always end up in the same slot.
+
+    Args:
+        topology: CPU topology as returned by get_cpu_topology().
+        count (int): Number of slots.
+
+    Returns:
+        List[List[int]]: Sorted CPUs for each slot.
+    """
+    cores = [core for node in topology for core in node]
+    slots = []
+    start = 0
+    for index in range(count):
+        end = (len(cores) * (index + 1)) // count
+        slot = sorted([cpu for core in cores[start:end] for cpu in core])
+        slots.append(slot)
+        start = end
+    return slots
+
+class CpuPartition(object):
+    """CPU slot claimed by this build.
+
+    The slot stays claimed while the lock file is open, i.e., until
+    release() is called or the process exits.
+
+    Attributes:
+        index (int): Index of the slot.
+        cpus (List[int]): CPUs in the slot.
+    """
+
+    def __init__(self, index, cpus, lock_fp):
+        self.index = index
+        self.cpus = cpus
+        self._lock_fp = lock_fp
+
+    def release(self):
+        if self._lock_fp:
+            self._lock_fp.close()
+            self._lock_fp = None
+
+def _try_lock(path):
+    import fcntl
+    fp = open(path, 'a')
+    try:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        fp.close()
+        return None
+    return fp
+
+def claim_cpu_partition(executor, lock_dir, slot_count):
+    """Claims a free CPU slot for this build.
+
+    Args:
+        executor (Executor): Executor for reading system information.
+        lock_dir (str): Node-local directory for the lock files.
+        slot_count (int): Number of slots to split the CPUs into (the number
+            of executors on the agent).
+
+    Returns:
+        CpuPartition or None: The claimed slot, or None if all slots are in
+            use or the CPUs cannot be partitioned.
+    """
+    cpus = hardware.get_allowed_cpus(executor)
+    if not cpus or slot_count < 1:
+        return None
+    slots = partition_cpus(get_cpu_topology(executor, cpus), slot_count)
+    if not all(slots):
+        # Fewer cores than slots.
+        return None
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    for index, slot_cpus in enumerate(slots):
+        path = os.path.join(lock_dir, 'cpu-slot-{0}-of-{1}.lock'.format(index, slot_count))
+        fp = _try_lock(path)
+        if fp:
+            return CpuPartition(index, slot_cpus, fp)
+    return None
+
+def create_affinity_setter(cpus):
+    """Creates a function that sets the CPU affinity of the calling process.
+
+    The C library is resolved and the CPU mask built here, in the parent, so
+    that the returned function can be used as ``preexec_fn`` for
+    subprocesses: between fork and exec in the child, it only calls
+    ``sched_setaffinity`` (and writes a message to stderr if that fails).
+
+    Returns:
+        Callable or None: The function, or None if the C library does not
+            provide ``sched_setaffinity`` (i.e., not on Linux).
+    """
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        sched_setaffinity = libc.sched_setaffinity
+    except (AttributeError, OSError):
+        return None
+    mask_bits = 8 * ctypes.sizeof(ctypes.c_ulong)
+    words = max(cpus) // mask_bits + 1
+    mask = (ctypes.c_ulong * words)()
+    for cpu in cpus:
+        mask[cpu // mask_bits] |= 1 << (cpu % mask_bits)
+    mask_size = ctypes.sizeof(mask)
+    mask_ref = ctypes.byref(mask)
+    get_errno = ctypes.get_errno
+    message = 'Setting CPU affinity to {0} failed: errno '.format(
+            ','.join([str(x) for x in cpus]))
+    def set_affinity():
+        if sched_setaffinity(0, mask_size, mask_ref) != 0:
+            os.write(2, message + str(get_errno()) + '\n')
+    return set_affinity
@@ -1,284 +1,362 @@
 """
 Information about Jenkins build agents
+
+The information is read from an inventory file, :file:`agents.json` in this
+directory, which has the following structure:
+
+``default_label``
+  Jenkins label used for configurations that do not require any labels.
+``defaults``
+  Default values for ``executors`` and ``build_parallelism`` for agents that
+  do not specify them.
+``special_host_groups``
+  List of groups of agents (each an object with ``hosts`` and optional
+  ``notes``) that should only be used if no agent outside the group can be
+  used.  For example, use Windows machines only for builds that can only be
+  run there.  Order matters; the first group is excluded first from the set
+  of possible hosts, so that if a build can run in the first or second
+  group, it will run in the second.
+``agents``
+  Object with an entry for each agent that releng-based dynamic matrix builds
+  should be able to run builds on, with the following fields:
+
+  ``labels`` (required)
+    Labels that the agent supports (see options.py and docs/releng.rst for
+    general information about the labels).
+  ``unused_labels``
+    Labels for software that is installed and working, but should not be used
+    for builds.  Only for documentation.
+  ``notes``
+    Free-form description.
+  ``matrix``
+    Whether the agent is on the node axis of the Jenkins matrix jobs.  If any
+    config gets assigned to a node outside the axis, Jenkins would silently
+    not build it, so this is used to give a fatal error instead.
+  ``executors``
+    Number of Jenkins executors (concurrent builds) on the agent.
+  ``build_parallelism``
+    Default number of parallel jobs for a build.
+  ``cores``, ``memory``, ``gpus``
+    Capacity of the agent: number of hardware threads, memory in GiB, and
+    number of GPUs.  Required for every agent, so that the inventory stays
+    complete; a value that is not known is given as ``null``, and reported
+    as a warning when the inventory is loaded.
+  ``gcc_for_libstdcxx``
+    Installed gcc (i.e., one of the labels) that should be used for compilers
+    (i.e., icc and clang) that need to use an external C++ standard library.
+  ``environment_subshell``
+    Shell-like command that establishes an environment that should be used
+    in order to access a suitable toolchain.
+
+The file is read and validated on first use, and kept in memory in a form
+that is optimized for selecting hosts for configurations.
 """
+from __future__ import print_function
+
+import json
+import os.path
+import sys
+
 from common import ConfigurationError
 
-BS_MAC = 'bs_mac'
-BS_MIC = 'bs_mic'
-BS_NIX1204 = 'bs_nix1204'
-BS_NIX1310 = 'bs_nix1310'
-BS_NIX1404 = 'bs_nix1404'
-BS_NIX_AMD_GPU = 'bs_nix-amd_gpu'
-BS_NIX_AMD = 'bs_nix-amd'
-BS_GPU01 = 'bs_gpu01'
-BS_NIX_DOCS = 'bs_nix-docs'
-BS_NIX_STATIC_ANALYZER = 'bs_nix-static_analyzer'
-BS_WIN2008 = 'bs_Win2008_64'
-BS_WIN2012R2 = 'bs-win2012r2'
-BS_JETSON_TK1 = 'bs_jetson_tk1'
-BS_JETSON_TX1 = 'bs_jetson_tx1'
-BS_OVERDRIVE_1000 = 'bs_overdrive_1000'
-
-DOCKER_DEFAULT = 'docker-ubuntu-15.04'
-
-ALL_LABELS = (DOCKER_DEFAULT,)
-
-# For each agent that releng-based dynamic matrix builds should be able to run
-# builds on, this should list the labels that the agent supports (see
-# options.py and docs/releng.rst for general information about the labels).
-#
-# If we later move to a workflow build, we can skip all this, and directly use
-# the labels assigned to agents in Jenkins: the workflow plugin supports
-# selecting the node using a label expression, which we can easily construct
-# directly in options.py.
-#
-# Versions that are commented out are installed and working, but are not
-# part of the description, as a crude form of load balancing.
-_HOST_LABELS = {
-            BS_MIC:         { 'gcc-4.8', 'gcc-4.9', 'gcc-5', 'gcc-7', 'gcc-8', 'gcc-9',
-                              # These CUDA versions are installed, but aren't useful to use
-                              # 'cuda-6.5', 'cuda-7.5',
-                              # CUDA is made available on this agent only so that we
-                              # can test that a CUDA build on a agent with no GPU works.
-                              'cuda-7.0', 'cuda-10.0', 'cuda-10.1',
-                              'icc-16.0', 'icc-16', 'icc-17', 'icc-18', 'icc-19',
-                              'phi',
-                              'cmake-2.8.12.2', 'cmake-3.3.2', 'cmake-3.6.1', 'cmake-3.8.1', 'cmake-3.9.6', 'cmake-3.10.0',
-                              'sse2', 'sse4.1', 'avx_256', 'mic',
-                              'tsan', 'x11'
-                            },
-            BS_MAC:         { 'gcc-4.8', 'gcc-4.9', 'gcc-6', 'gcc-8',
-                              'clang-4', 'clang-6', 'clang-7', 'clang-8',
-                              'gcov-4.6', 'gcov-6.1', 'gcov-6',
-                              'icc-12.1', 'icc-13.0', 'icc-15.0', 'icc-16.0', 'icc-16',
-                              'cmake-3.4.3', 'cmake-3.5.2', 'cmake-3.12.1',
-                              'sse2', 'sse4.1',
-                              'tidy',
-                              # 'x11',
-                              },
-            BS_NIX1204:     { 'gcc-4.8', 'gcc-5', 'gcc-7', 'gcc-8',
-                              # These gcc are installed, but we don't want to use them if we can avoid it.
-                              # 'gcc-6',
-                              'clang-4', 'clang-5', 'clang-8',
-                              # These clang are installed, but we don't want to use them if we can avoid it.
-                              # 'clang-6',
-                              'cuda-6.5', 'cuda-7.0', 'cuda-8.0', 'cuda-9.1', 'cuda-9.2', 'cuda-10.0', 'cuda-10.1',
-                              'opencl-1.1', 'opencl-1.2',
-                              # These are installed, but we prefer to target such jobs to bs_nix1310
-                              # 'cuda-9.0',
-                              'nvidia', # GPU vendor
-                              'cmake-2.8.8', 'cmake-3.6.1', 'cmake-3.10.0', 'cmake-3.15.1', # 'cmake-3.8.1', 'cmake-3.9.6',
-                              'sse2', 'sse4.1', 'avx_256', 'avx2_256',
-                              'libhwloc-1.8', 'libhwloc-2.0.4',
-                              'mpi', # 'x11',
-                              'valgrind' },
-            BS_NIX1310:     { 'gcc-4.8', 'gcc-4.9', 'gcc-5', 'gcc-6',
-                              'clang-6',
-                              # These clang are installed, but we don't want to use them if we can avoid it.
-                              # 'clang-3.4', 'clang-4', 'clang-5',
-                              'icc-18', 'icc-19',
-                              'cuda-5.0', 'cuda-7.0', 'cuda-7.5', 'cuda-8.0', 'cuda-9.0',
-                              'opencl-1.1', 'opencl-1.2',
-                              'clFFT-2.14',
-                              'nvidia', # GPU vendor
-                              'cmake-2.8.11.2', 'cmake-3.4.3', 'cmake-3.5.2', 'cmake-3.8.1',  'cmake-3.9.6', #'cmake-3.10.0',
-                              'sse2', 'sse4.1', 'avx_256', 'avx2_256',
-                              'mpi', # 'x11',
-                              'valgrind', 'tsan',
-                              'libhwloc-1.7',
-                            },
-            BS_NIX1404:     { 'gcc-7', 'gcc-8',
-                              'clang-7',
-                              'cmake-3.4.3', 'cmake-3.9.6', 'cmake-3.13.2',
-                              'sse2', 'sse4.1', 'avx_128_fma',
-                              'mpi',
-                              'valgrind'
-                            },
-            BS_NIX_AMD_GPU: { 'gcc-4.8', 'gcc-4.9', 'gcc-5', 'gcc-8',
-                              'amdappsdk-3.0',
-                              'opencl-1.1', 'opencl-1.2', 'opencl-2.0',
-                              'cmake-2.8.12.2', 'cmake-3.5.2',
-                              'sse2', 'sse4.1', 'avx_128_fma',
-                              'mpi',
-                            },
-            BS_NIX_AMD:     { 'gcc-4.8', 'gcc-4.9', 'gcc-5', 'clang-8',
-                              'clang-3.4', 'clang-3.6', 'clang-4', 'clang-5', 'clang-6', 'clang-7',
-                              'cmake-2.8.12.2', 'cmake-3.4.3', 'cmake-3.11.4',
-                              'sse2', 'sse4.1', 'avx_128_fma',
-                              'mpi',
-                            },
-            BS_GPU01:       { 'gcc-5', 'gcc-7', 'gcc-8', 'gcc-9',
-                              'clang-4', 'clang-5', 'clang-6', 'clang-7', 'clang-8',
-                              'libcxx-7',
-                              'cmake-3.4.3', 'cmake-3.12.1', 'cmake-3.14.5',
-                              'sse2', 'sse4.1', 'avx_256', 'avx2_256',
-                              'mpi',
-                              'opencl-1.1', 'opencl-1.2', 'opencl-2.0',
-                              'clFFT-2.14',
-                              'amd', # GPU vendor
-                              'tsan',
-                              'tidy',
-                              'amdappsdk-3.0', # TODO: remove
-                              'libhwloc-1.11.2',
-                            },
-            BS_NIX_DOCS:    { 'cmake-3.6.1', 'cmake-3.13.3',
-                              'doxygen-1.8.5', 'sphinx-1.6.1'
-                            },
-            BS_NIX_STATIC_ANALYZER: {
-                              'clang-3.8', 'clang-4', 'clang-5', 'clang-6', 'clang-7', 'clang-8',
-                              'clang-static-analyzer-3.8', 'clang-static-analyzer-4', 'clang-static-analyzer-5',
-                              'clang-static-analyzer-6', 'clang-static-analyzer-7', 'clang-static-analyzer-8',
-                              'cmake-3.5.1', 'cmake-3.7.2', 'cmake-3.12.4'
-                            },
-            BS_WIN2008:     { 'msvc-2010',
-                              'icc-12.1' },
-            BS_WIN2012R2:   { 'msvc-2013', 'msvc-2015', 'msvc-2017',
-                              'icc-16.0', 'icc-16', 'icc-18',
-                              'cmake-2.8.12.2', 'cmake-3.2.3', 'cmake-3.3.0', 'cmake-3.6.1', 'cmake-3.10.2',
-                              'sse2', 'sse4.1', 'avx_256', 'avx2_256',
-                            },
-            BS_JETSON_TK1:  { 'gcc-4.8', 'gcc-4.9', 'gcc-5',
-                              'clang-3.9',
-                              'arm_neon',
-                              'cmake-3.8.1', 'cmake-3.13.3',
-                              'cuda-6.5',
-                              'nvidia', # GPU vendor
-                             },
-            BS_JETSON_TX1:  { 'gcc-4.8', 'gcc-4.9', 'gcc-5',
-                              'clang-3.9',
-                              'arm_neon_asimd',
-                              'cmake-3.5.1', 'cmake-3.13.3',
-                              'cuda-8.0'
-                              'nvidia', # GPU vendor
-                              },
-            BS_OVERDRIVE_1000: {
-                                 'armclang-18.3', 'armclang-18.4', 'armclang-19.2', 'armclang-19.3', 'gcc-7',
-                                 # ARMPL comes with the ARM HPC stack, so no separate versioning
-                                 'armpl',
-                                 'arm_neon_asimd',
-                                 'cmake-3.10.2',
-                                 'armhpc-18.3', 'armhpc-18.4', 'armhpc-19.2', 'armhpc-19.3'},
-            DOCKER_DEFAULT: {} # TODO
-        }
-
-# Specifies an installed gcc (ie found in the list above) for each
-# host that should be used for compilers (ie icc and clang) that need
-# to use an external C++ standard library, such as one from gcc.
-_DEFAULT_GCC_FOR_LIBSTDCXX = {
-            # This agent uses macports clang that does not need a gcc
-            # BS_MAC: 'gcc-6',
-            BS_MIC: 'gcc-5',
-            BS_NIX1204: 'gcc-5',
-            BS_NIX1310: 'gcc-5',
-            BS_NIX1404: 'gcc-7',
-            BS_NIX_AMD_GPU: 'gcc-5',
-            BS_GPU01: 'gcc-5',
-            BS_NIX_AMD: 'gcc-5',
-            BS_JETSON_TK1: 'gcc-5',
-            BS_JETSON_TX1: 'gcc-5',
-            BS_OVERDRIVE_1000: 'gcc-7'
+_INVENTORY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'agents.json')
+
+class AgentInfo(object):
+    """Information about a single build agent from the inventory.
+
+    Attributes:
+        name (str): Name of the agent in Jenkins.
+        labels (FrozenSet[str]): Labels that the agent supports.
+        matrix (bool): Whether matrix configurations can be built on the agent.
+        executors (int): Number of Jenkins executors on the agent.
+        build_parallelism (int): Default number of parallel build jobs.
+        cores (int): Number of hardware threads, or None if not known.
+        memory (float): Memory in GiB, or None if not known.
+        gpus (int): Number of GPUs, or None if not known.
+        gcc_for_libstdcxx (str): gcc to use for the C++ standard library, or
+            None.
+        environment_subshell (str): Command to establish the toolchain
+            environment, or None.
+    """
+
+    def __init__(self, name, data, defaults):
+        self.name = name
+        self.labels = frozenset(data['labels'])
+        self.matrix = data.get('matrix', False)
+        self.executors = data.get('executors', defaults['executors'])
+        self.build_parallelism = data.get('build_parallelism', defaults['build_parallelism'])
+        self.cores = data.get('cores', None)
+        self.memory = data.get('memory', None)
+        self.gpus = data.get('gpus', None)
+        self.gcc_for_libstdcxx = data.get('gcc_for_libstdcxx', None)
+        self.environment_subshell = data.get('environment_subshell', None)
+
+def _check_type(path, value, types):
+    if isinstance(value, bool) and bool not in types:
+        types = ()
+    if not isinstance(value, types):
+        raise ConfigurationError('agent inventory: invalid value for {0}: {1!r}'.format(path, value))
+
+def _check_keys(path, data, required, optional):
+    _check_type(path, data, (dict,))
+    for key in required:
+        if key not in data:
+            raise ConfigurationError('agent inventory: {0} is missing {1}'.format(path, key))
+    unknown = set(data.iterkeys()) - set(required) - set(optional)
+    unknown = [x for x in unknown if not x.startswith('_')]
+    if unknown:
+        raise ConfigurationError('agent inventory: unknown keys in {0}: {1}'.format(path, ', '.join(sorted(unknown))))
+
+def _check_string_list(path, value):
+    _check_type(path, value, (list,))
+    for item in value:
+        _check_type(path, item, (basestring,))
+
+def _check_positive(path, value, types):
+    _check_type(path, value, types)
+    if value <= 0:
+        raise ConfigurationError('agent inventory: {0} must be positive'.format(path))
+
+def _check_capacity(check):
+    def checker(path, value):
+        if value is not None:
+            check(path, value)
+    return checker
+
+_CAPACITY_FIELDS = ('cores', 'memory', 'gpus')
+
+_AGENT_FIELDS = {
+        'labels': _check_string_list,
+        'unused_labels': _check_string_list,
+        'notes': lambda path, value: _check_type(path, value, (basestring,)),
+        'matrix': lambda path, value: _check_type(path, value, (bool,)),
+        'executors': lambda path, value: _check_positive(path, value, (int,)),
+        'build_parallelism': lambda path, value: _check_positive(path, value, (int,)),
+        'cores': _check_capacity(lambda path, value: _check_positive(path, value, (int,))),
+        'memory': _check_capacity(lambda path, value: _check_positive(path, value, (int, float))),
+        'gpus': _check_capacity(lambda path, value: _check_type(path, value, (int,))),
+        'gcc_for_libstdcxx': lambda path, value: _check_type(path, value, (basestring,)),
+        'environment_subshell': lambda path, value: _check_type(path, value, (basestring,))
     }
 
+def validate_inventory(data):
+    """Checks that inventory data read from JSON is valid.
+
+    Returns:
+        List[str]: Warnings about agents whose capacity is not known.
+
+    Raises:
+        ConfigurationError: If the data does not follow the schema.
+    """
+    warnings = []
+    _check_keys('inventory', data, ('default_label', 'defaults', 'special_host_groups', 'agents'), ())
+    _check_type('default_label', data['default_label'], (basestring,))
+    _check_keys('defaults', data['defaults'], ('executors', 'build_parallelism'), ())
+    for key, value in data['defaults'].iteritems():
+        _AGENT_FIELDS[key]('defaults.' + key, value)
+    agents = data['agents']
+    _check_type('agents', agents, (dict,))
+    for name, agent in agents.iteritems():
+        path = 'agents.' + name
+        _check_keys(path, agent, ('labels',) + _CAPACITY_FIELDS, _AGENT_FIELDS.keys())
+        for key, value in agent.iteritems():
+            if key in _AGENT_FIELDS:
+                _AGENT_FIELDS[key](path + '.' + key, value)
+        unknown = [key for key in _CAPACITY_FIELDS if agent[key] is None]
+        if unknown:
+            warnings.append('agent inventory: unknown capacity for {0}: {1}'.format(name, ', '.join(unknown)))
+        gcc = agent.get('gcc_for_libstdcxx', None)
+        if gcc and gcc not in agent['labels']:
+            raise ConfigurationError('agent inventory: {0}.gcc_for_libstdcxx is not one of the labels: {1}'.format(path, gcc))
+    groups = data['special_host_groups']
+    _check_type('special_host_groups', groups, (list,))
+    for index, group in enumerate(groups):
+        path = 'special_host_groups[{0}]'.format(index)
+        _check_keys(path, group, ('hosts',), ('notes',))
+        _check_string_list(path + '.hosts', group['hosts'])
+        for host in group['hosts']:
+            if host not in agents:
+                raise ConfigurationError('agent inventory: unknown agent in {0}: {1}'.format(path, host))
+    return sorted(warnings)
+
+class _LabelIndex(object):
+    """Host label table compiled into bitmasks for fast matching.
+
+    Each host is assigned a bit (in sorted order of the host names), and each
+    label maps to a mask of the hosts that support it, so that the hosts
+    supporting a set of labels are found with a few bitwise operations.
+    Results are also cached per label set, as matrices typically contain
+    many configurations with the same labels.
+    """
+
+    def __init__(self, host_labels, special_groups):
+        self._hosts = sorted(host_labels.iterkeys())
+        bits = dict([(host, 1 << i) for i, host in enumerate(self._hosts)])
+        self._all_mask = (1 << len(self._hosts)) - 1
+        self._label_masks = dict()
+        for host, labels in host_labels.iteritems():
+            for label in labels:
+                self._label_masks[label] = self._label_masks.get(label, 0) | bits[host]
+        self._group_masks = []
+        for group in special_groups:
+            mask = 0
+            for host in group:
+                mask |= bits.get(host, 0)
+            self._group_masks.append(mask)
+        self._cache = dict()
+
+    def get_possible_hosts(self, labels):
+        key = frozenset(labels)
+        result = self._cache.get(key, None)
+        if result is None:
+            result = self._hosts_from_mask(self._match(key))
+            self._cache[key] = result
+        return list(result)
+
+    def _match(self, labels):
+        mask = self._all_mask
+        for label in labels:
+            mask &= self._label_masks.get(label, 0)
+            if not mask:
+                return 0
+        for group_mask in self._group_masks:
+            if not mask & ~group_mask:
+                break
+            mask &= ~group_mask
+        return mask
+
+    def _hosts_from_mask(self, mask):
+        return tuple([host for i, host in enumerate(self._hosts) if mask & (1 << i)])
+
+class _Inventory(object):
+    """Compiled form of the agent inventory."""
+
+    def __init__(self, data):
+        defaults = data['defaults']
+        self.default_label = data['default_label']
+        self.defaults = AgentInfo(None, {'labels': []}, defaults)
+        self.agents = dict()
+        for name, agent in data['agents'].iteritems():
+            self.agents[name] = AgentInfo(name, agent, defaults)
+        self.special_host_groups = [set(x['hosts']) for x in data['special_host_groups']]
+        host_labels = dict([(name, agent.labels) for name, agent in self.agents.iteritems()])
+        self.label_index = _LabelIndex(host_labels, self.special_host_groups)
+
+    def get(self, host):
+        return self.agents.get(host, self.defaults)
+
+def read_inventory(path):
+    """Reads and validates an agent inventory file.
+
+    Warnings about agents with unknown capacity are printed to stderr.
+
+    Raises:
+        ConfigurationError: If the file is not valid.
+    """
+    with open(path, 'r') as fp:
+        try:
+            data = json.load(fp)
+        except ValueError as e:
+            raise ConfigurationError('agent inventory {0} is not valid JSON: {1}'.format(path, e))
+    for warning in validate_inventory(data):
+        print('WARNING: ' + warning, file=sys.stderr)
+    return _Inventory(data)
+
+_inventory = None
+
+def _get_inventory():
+    global _inventory
+    if _inventory is None:
+        _inventory = read_inventory(_INVENTORY_FILE)
+    return _inventory
+
+def get_agent_info(host):
+    """Returns AgentInfo for a host, or None if it is not in the inventory."""
+    return _get_inventory().agents.get(host, None)
+
 def get_default_gcc_for_libstdcxx(host):
-    return _DEFAULT_GCC_FOR_LIBSTDCXX.get(host, None)
-
-# Specifies a shell-like command that establishes an enviroment that should
-# be used on particular hosts in order to access a suitable toolchain.
-# TODO This could be implemented as "agent" BS_MIC_DEVTOOLSET_4, or similar.
-_ENVIRONMENT_SUBSHELL = {
-            # Centos 6.9 on bs_mic uses ancient gcc and ld
-            BS_MIC: '/usr/bin/scl enable devtoolset-4'
-    }
+    return _get_inventory().get(host).gcc_for_libstdcxx
 
 def get_environment_subshell(host):
     # The default system toolchains are mostly fine for us to use.
-    return _ENVIRONMENT_SUBSHELL.get(host, None)
-
-# Specifies the set of hosts that are allowed to execute matrix configurations.
-# This should match the nodes selected on the node axis in the Jenkins matrix jobs.
-# If any config gets assigned to a node outside the Jenkins matrix job axis, Jenkins
-# would silently not build it. This list is used to check the matrix config, so
-# we give a fatal error rather than silently omit a build.
-_MATRIX_HOSTS = {
-            BS_MAC,
-            BS_MIC,
-            BS_NIX1204,
-            BS_NIX1310,
-            BS_NIX1404,
-            BS_NIX_AMD_GPU,
-            BS_NIX_AMD,
-            BS_GPU01,
-            BS_JETSON_TK1,
-            BS_JETSON_TX1,
-            BS_OVERDRIVE_1000,
-            BS_WIN2012R2
-        }
-
-# Specifies groups of hosts that should only be used if no host outside the
-# group can be used.  For example, use Windows machines only for builds that
-# can only be run there.
-#
-# Order matters; the first set is excluded first from the set of possible
-# hosts, so that if a build can run in the first or second set, it will run in
-# the second.
-_SPECIAL_HOST_GROUPS = [
-            # Windows
-            {BS_WIN2008, BS_WIN2012R2},
-            # Special-purpose VMs
-            {BS_NIX_STATIC_ANALYZER},
-            {BS_NIX_DOCS},
-            # ARM agents
-            {BS_JETSON_TK1, BS_JETSON_TX1, BS_OVERDRIVE_1000},
-            # GPU agents
-            {BS_GPU01, BS_NIX1204, BS_NIX1310},
-            # Deprecated GPU agents
-            {BS_NIX_AMD_GPU}
-        ]
-
-# For hosts not specifically listed here, a default hard-coded in
-# get_default_build_parallelism() is used.
-_DEFAULT_BUILD_PARALLELISM = {
-            BS_WIN2008: 4,
-            # The following agents are limited to a single executor, so we
-            # should use all the hardware threads
-            BS_JETSON_TK1: 4,
-            BS_JETSON_TX1: 4,
-            BS_OVERDRIVE_1000: 4,
-            BS_NIX_AMD_GPU: 4,
-            # 8 physical cores without HT, 2 executors
-            BS_MAC: 4,
-            # 12 VM cores, 1 executor
-            BS_NIX_STATIC_ANALYZER: 12,
-            # 8 cores with HT, 2 executors
-            BS_GPU01: 8,
-            # 4 physical cores, each with 2 hyperthreads
-            BS_WIN2012R2: 8
-        }
+    return _get_inventory().get(host).environment_subshell
 
 def is_label(host):
-    return host in ALL_LABELS
+    return host == _get_inventory().default_label
 
 def is_matrix_host(host):
-    return host in _MATRIX_HOSTS
+    return _get_inventory().get(host).matrix
 
 def get_default_build_parallelism(host):
-    return _DEFAULT_BUILD_PARALLELISM.get(host, 2)
+    return _get_inventory().get(host).build_parallelism
+
+def get_executor_count(host):
+    return _get_inventory().get(host).executors
+
+def get_possible_hosts(labels):
+    """Returns the hosts that should be considered for a given set of labels.
+
+    Hosts in special host groups are excluded if any other host supports the
+    labels.  The returned list is sorted to make the result deterministic.
+    """
+    inventory = _get_inventory()
+    if not labels:
+        return [inventory.default_label]
+    return inventory.label_index.get_possible_hosts(labels)
 
 def pick_host(labels, opts):
-    """Selects a host that can build with a given set of labels."""
-    if labels.issubset(_HOST_LABELS[DOCKER_DEFAULT]):
-        return DOCKER_DEFAULT
-    possible_hosts = []
-    for host, host_labels in _HOST_LABELS.iteritems():
-        if labels.issubset(host_labels):
-            possible_hosts.append(host)
+    """Selects a host that can build with a given set of labels.
+
+    This does not consider other configurations; use assign_hosts() to
+    distribute multiple configurations between the hosts.
+    """
+    possible_hosts = get_possible_hosts(labels)
     if not possible_hosts:
         return None
-    # TODO: If there are multiple possible hosts, it would be better to
-    # optimize the selection globally over all the configurations to
-    # avoid assigning all the builds to the same host.
-    for group in _SPECIAL_HOST_GROUPS:
-        if set(possible_hosts).issubset(group):
-            return possible_hosts[0]
-        possible_hosts = [x for x in possible_hosts if x not in group]
     return possible_hosts[0]
+
+def _get_build_duration(host, cost):
+    return float(cost) / get_default_build_parallelism(host)
+
+def assign_hosts(requests, excluded=None):
+    """Selects hosts for a set of configurations, balancing the load.
+
+    The configurations are assigned using the longest-processing-time-first
+    heuristic: configurations are processed starting from the most expensive
+    (and among equally expensive, the most constrained) one, and each is
+    assigned to the possible host where it would finish first, considering
+    the configurations already assigned to the host, the number of executors
+    on the host, and the build parallelism.  This approximately minimizes the
+    time until the whole matrix is built.  Ties are broken by the host name
+    and the order of the configurations, so that the assignment is
+    deterministic.
+
+    Args:
+        requests (List[Tuple[Set[str], float]]): Labels and relative cost
+            for each configuration.
+        excluded (Optional[List[Set[str]]]): Hosts that must not be used for
+            each configuration (e.g., where it already failed).
+
+    Returns:
+        List[str]: Host for each configuration, in the same order as the
+            input, or None for configurations that no host can build.
+    """
+    possible = [get_possible_hosts(labels) for labels, cost in requests]
+    if excluded is not None:
+        possible = [[x for x in hosts if x not in exclude]
+                for hosts, exclude in zip(possible, excluded)]
+    order = sorted(range(len(requests)),
+            key=lambda i: (-requests[i][1], len(possible[i]), i))
+    load = dict()
+    result = [None] * len(requests)
+    for index in order:
+        cost = requests[index][1]
+        def finish_time(host):
+            total = load.get(host, 0.0) + _get_build_duration(host, cost)
+            return total / get_executor_count(host)
+        if not possible[index]:
+            continue
+        host = min(possible[index], key=lambda x: (finish_time(x), x))
+        load[host] = load.get(host, 0.0) + _get_build_duration(host, cost)
+        result[index] = host
+    return result
@@ -4,9 +4,13 @@ Helper routines for parsing CMake-related stuff.
 import os.path
 import re
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 
 from common import BuildError, ConfigurationError
 
+# JUnit XML produced from the CTest output for Jenkins.
+_JUNIT_XML = 'Testing/Temporary/CTest.xml'
+
 def read_cmake_variable_file(executor, path):
     """Reads a file with CMake variable declarations (set commands).
 
@@ -43,19 +47,237 @@ def get_cmake_version(cmd_runner, cmake_executable):
         return match.group(1)
     raise ConfigurationError('Could not parse CMake version:\n' + output)
 
-def process_ctest_xml(executor, memcheck):
+def parse_ctest_test_list(output):
+    """Parses the names of tests from the output of ``ctest -N``.
+
+    Returns:
+        List[str]: Names of the tests, in CTest order.
+    """
+    test_re = r'^\s*Test\s+#\d+: (.*\S)\s*$'
+    tests = []
+    for line in output.splitlines():
+        match = re.match(test_re, line)
+        if match:
+            tests.append(match.group(1))
+    return tests
+
+def escape_ctest_regex(text):
+    """Escapes a string for matching it literally in a CTest regex."""
+    return re.sub(r'([][.*+?^$()|\\])', r'\\\1', text)
+
+def read_ctest_cost_data(executor, path):
+    """Reads average test durations from a CTest cost data file.
+
+    CTest writes the file as :file:`Testing/Temporary/CTestCostData.txt`
+    in the build directory, with a line for each test (name, number of runs,
+    and average duration), followed by a list of failed tests.
+
+    Returns:
+        Dict[str, float]: Average duration for each test.  Empty if the
+            file does not exist.
+    """
+    costs = dict()
+    try:
+        lines = list(executor.read_file(path))
+    except (IOError, OSError):
+        return costs
+    for line in lines:
+        line = line.rstrip('\n')
+        if line == '---':
+            break
+        fields = line.rsplit(None, 2)
+        if len(fields) != 3:
+            continue
+        try:
+            costs[fields[0]] = float(fields[2])
+        except ValueError:
+            continue
+    return costs
+
+def split_tests_into_shards(tests, costs, count):
+    """Splits tests into shards with similar total duration.
+
+    The tests are assigned, longest first, to the shard with the least total
+    duration so far.  Tests without cost data are assumed to take the average
+    duration of the other tests; without any cost data, the tests are dealt
+    out in name order.  The result only depends on the arguments, so that
+    separate builds that run different shards agree on the split if they
+    pass the same arguments.
+
+    Args:
+        tests (List[str]): Names of the tests.
+        costs (Dict[str, float]): Durations of tests (see
+            read_ctest_cost_data()).
+        count (int): Number of shards.
+
+    Returns:
+        List[List[str]]: Tests in each shard, in the order of the input.
+    """
+    known = [costs[x] for x in tests if x in costs]
+    default = sum(known) / len(known) if known else 1.0
+    durations = [costs.get(x, default) for x in tests]
+    totals = [0.0] * count
+    assignment = dict()
+    for index in sorted(range(len(tests)), key=lambda x: (-durations[x], tests[x])):
+        shard = min(range(count), key=lambda x: (totals[x], x))
+        totals[shard] += durations[index]
+        assignment[index] = shard
+    shards = [[] for dummy in range(count)]
+    for index, test in enumerate(tests):
+        shards[assignment[index]].append(test)
+    return shards
+
+class TestOutputPolicy(object):
+    """Controls how much test output is included in the JUnit XML.
+
+    Output of failed tests is always included in full.  For passed tests,
+    only the first and last lines of long output are included, since the
+    output is mostly noise and Jenkins needs to parse all of it.  If
+    spill_dir is given, the full output of such tests is written there as
+    a compressed file, and the JUnit output refers to it.  The files are
+    named after the tests, prefixed with a running index so that test names
+    that map to the same file name do not collide.
+
+    Args:
+        head_lines (int): Number of lines to keep from the start of the
+            output of a passed test.
+        tail_lines (int): Number of lines to keep from the end of the output
+            of a passed test.
+        spill_dir (Optional[str]): Directory where to write the full output
+            of truncated tests.
+        spill_link (Optional[str]): Base for the references to the files in
+            spill_dir (e.g., an URL where they are archived).  If not given,
+            spill_dir is used.
+    """
+
+    def __init__(self, head_lines=100, tail_lines=100, spill_dir=None, spill_link=None):
+        self.head_lines = head_lines
+        self.tail_lines = tail_lines
+        self.spill_dir = spill_dir
+        if spill_link is None:
+            spill_link = spill_dir
+        self.spill_link = spill_link
+        self._spill_count = 0
+
+    def _get_spill_filename(self, test_name):
+        self._spill_count += 1
+        name = re.sub(r'[^\w.-]', '_', test_name)
+        return '{0}-{1}.log.gz'.format(self._spill_count, name)
+
+def process_ctest_xml(executor, memcheck, output_policy=None, output_path=None,
+        properties=None):
+    """Converts the CTest XML output to JUnit XML for Jenkins.
+
+    Both the CTest XML and the JUnit XML are processed one test at a time,
+    so memory use does not grow with the number of tests (only with the
+    size of the output of a single test).
+
+    Args:
+        memcheck (bool): Whether to process the output of a memcheck run.
+        output_policy (Optional[TestOutputPolicy]): If given, output of
+            passed tests is truncated as specified.  By default, output of
+            all tests is included in full.
+        output_path (Optional[str]): Path to write the JUnit XML to.  By
+            default, :file:`Testing/Temporary/CTest.xml`.
+        properties (Optional[Dict[str, str]]): Properties to write for the
+            test suite (e.g., to identify a test shard).
+    """
     tag = _read_ctest_tag_name(executor)
-    xml_name, test_xpath, suite_name = _get_properties(memcheck)
-    ctest_root = _read_ctest_xml(executor, tag, xml_name)
-    junit_root = ET.Element('testsuites')
-    junit_suite = ET.SubElement(junit_root, 'testsuite', {'name': suite_name})
-    for test in ctest_root.findall(test_xpath):
-        if memcheck:
-            _create_junit_testcase_memcheck(test, junit_suite, suite_name)
-        else:
-            _create_junit_testcase(test, junit_suite, suite_name)
-    contents = ET.tostring(junit_root)
-    executor.write_file('Testing/Temporary/CTest.xml', contents)
+    xml_name, test_path, suite_name = _get_properties(memcheck)
+    if memcheck:
+        create_testcase = _create_junit_testcase_memcheck
+    else:
+        create_testcase = _create_junit_testcase
+    if output_policy and output_policy.spill_dir:
+        executor.ensure_dir_exists(output_policy.spill_dir)
+    xml_path = os.path.join('Testing', tag, xml_name)
+    tests = _iterate_xml_elements(executor, xml_path, test_path)
+    testcases = (create_testcase(test, suite_name) for test in tests)
+    if output_policy:
+        testcases = (_apply_output_policy(executor, x, output_policy) for x in testcases)
+    contents = _write_junit_xml(suite_name, testcases, properties)
+    executor.write_file(output_path or _JUNIT_XML, contents)
+
+def write_empty_junit_xml(executor, memcheck, properties=None):
+    """Writes the JUnit XML for a CTest run without any tests."""
+    suite_name = _get_properties(memcheck)[2]
+    executor.write_file(_JUNIT_XML, _write_junit_xml(suite_name, [], properties))
+
+def merge_junit_xml(executor, input_paths, output_path):
+    """Merges JUnit XML files produced by process_ctest_xml().
+
+    Used to combine the results of test shards that ran in separate builds.
+    The test cases from all inputs are put into a single test suite, named
+    after the suite in the first input, and their class names are set to the
+    same name, so that Jenkins reports the tests the same way as from an
+    unsharded run.  Like process_ctest_xml(), the files are processed one
+    test case at a time.
+
+    Each test must appear exactly once in the merged results.  If the inputs
+    are from test shards (see run_ctest()), they must be all the shards of
+    the same split of the same tests; and in any case, a test reported by
+    more than one input is an error.
+
+    Raises:
+        BuildError: If the inputs do not report each test exactly once.
+    """
+    headers = [_read_junit_header(executor, path) for path in input_paths]
+    _check_test_shards(input_paths, [x[1] for x in headers])
+    suite_name = headers[0][0]
+    def iterate_testcases():
+        seen = set()
+        for path in input_paths:
+            for testcase in _iterate_xml_elements(executor, path, ['testsuite', 'testcase']):
+                name = testcase.get('name')
+                if name in seen:
+                    raise BuildError('Test {0} is reported more than once ({1})'.format(
+                        name, path))
+                seen.add(name)
+                testcase.set('classname', suite_name)
+                testcase.tail = None
+                yield testcase
+    executor.write_file(output_path, _write_junit_xml(suite_name, iterate_testcases()))
+
+def _read_junit_header(executor, path):
+    """Reads the name and properties of the test suite in a JUnit XML file.
+
+    Only the start of the file is parsed.
+
+    Returns:
+        Tuple[str, Dict[str, str]]: Name and properties of the test suite.
+    """
+    source = _LineReader(executor.read_file(path))
+    suite_name = None
+    properties = dict()
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            if elem.tag == 'testsuite':
+                suite_name = elem.get('name')
+            elif elem.tag == 'testcase':
+                break
+        elif elem.tag == 'property':
+            properties[elem.get('name')] = elem.get('value')
+        elif elem.tag in ('properties', 'testsuite'):
+            break
+    if suite_name is None:
+        raise BuildError('No test suite found in ' + path)
+    return suite_name, properties
+
+def _check_test_shards(input_paths, properties):
+    """Checks that JUnit XML inputs from test shards cover all the shards."""
+    shards = [x.get('test-shard') for x in properties]
+    if not any(shards):
+        return
+    if not all(shards):
+        raise BuildError('Cannot merge results from test shards with other results')
+    counts = set([x.split('/')[1] for x in shards])
+    if len(counts) != 1 or sorted(shards) != sorted(set(shards)) \
+            or len(shards) != int(counts.pop()):
+        raise BuildError('Expected results from each test shard exactly once, got: '
+                + ', '.join(shards))
+    if len(set([x.get('test-shard-tests') for x in properties])) != 1:
+        raise BuildError('Test shards were split from different lists of tests: '
+                + ', '.join(input_paths))
 
 def _read_ctest_tag_name(executor):
     lines = list(executor.read_file('Testing/TAG'))
@@ -68,35 +290,92 @@ def _get_properties(memcheck):
         # TODO: If the tests pass, they do not create Test entries at all (at
         # least, not for ASAN)...
         # It would be nice to still get the same list of tests always.
-        return 'DynamicAnalysis.xml', './DynamicAnalysis/Test', 'CTest_MemCheck'
+        return 'DynamicAnalysis.xml', ['DynamicAnalysis', 'Test'], 'CTest_MemCheck'
     else:
-        return 'Test.xml', './Testing/Test', 'CTest'
+        return 'Test.xml', ['Testing', 'Test'], 'CTest'
 
-def _read_ctest_xml(executor, tag, xml_name):
-    xml_path = os.path.join('Testing', tag, xml_name)
-    xml_lines = executor.read_file(xml_path)
-    return ET.fromstring(''.join(xml_lines))
+class _LineReader(object):
+    """File-like object for reading from an iterable over lines."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while size < 0 or length < size:
+            line = next(self._lines, None)
+            if line is None:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._buffer = data[size:]
+        return data[:size]
+
+def _iterate_xml_elements(executor, xml_path, element_path):
+    """Iterates over elements at a given path in an XML file.
 
-def _create_junit_testcase(test, parent, suite_name):
+    Each element is only valid until the next one is returned; elements are
+    cleared after processing to keep the memory use constant.
+
+    Args:
+        element_path (List[str]): Tags of the elements on the path from the
+            root element (excluding it) to the elements to return.
+    """
+    source = _LineReader(executor.read_file(xml_path))
+    path = []
+    parents = []
+    for event, elem in ET.iterparse(source, events=('start', 'end')):
+        if event == 'start':
+            path.append(elem.tag)
+            parents.append(elem)
+            continue
+        path.pop()
+        parents.pop()
+        if path[1:] == element_path[:-1]:
+            if elem.tag == element_path[-1]:
+                yield elem
+            # Drop all processed children of the parent (including
+            # unrelated elements like the test list).
+            parents[-1].clear()
+
+def _write_junit_xml(suite_name, testcases, properties=None):
+    """Iterates over the serialized JUnit XML for the given test cases."""
+    yield '<testsuites><testsuite name={0}>'.format(quoteattr(suite_name))
+    if properties:
+        yield '<properties>'
+        for name, value in sorted(properties.iteritems()):
+            yield '<property name={0} value={1} />'.format(quoteattr(name), quoteattr(value))
+        yield '</properties>'
+    for testcase in testcases:
+        yield ET.tostring(testcase)
+    yield '</testsuite></testsuites>'
+
+def _create_junit_testcase(test, suite_name):
     name = test.find('Name').text
     time = _get_named_measurement(test, 'Execution Time')
     passed = (test.get('Status') == 'passed')
     attrs = {'name': name, 'classname': suite_name, 'time': time}
-    junit_case = ET.SubElement(parent, 'testcase', attrs)
+    junit_case = ET.Element('testcase', attrs)
     if not passed:
         reason = _get_named_measurement(test, 'Exit Code')
         failure = ET.SubElement(junit_case, 'failure', {'message': reason})
     output = ET.SubElement(junit_case, 'system-out')
     output.text = test.find('./Results/Measurement/Value').text
+    return junit_case
 
 def _get_named_measurement(test, name):
     return test.find("./Results/NamedMeasurement[@name='{0}']/Value".format(name)).text
 
-def _create_junit_testcase_memcheck(test, parent, suite_name):
+def _create_junit_testcase_memcheck(test, suite_name):
     name = test.find('Name').text
     passed = (test.get('Status') == 'passed')
     attrs = {'name': name, 'classname': suite_name}
-    junit_case = ET.SubElement(parent, 'testcase', attrs)
+    junit_case = ET.Element('testcase', attrs)
     if not passed:
         # TODO: This will produce an empty message if the test fails normally,
         # not because of an ASAN error...
@@ -105,3 +384,26 @@ def _create_junit_testcase_memcheck(test, parent, suite_name):
         failure = ET.SubElement(junit_case, 'failure', {'message': reason})
     output = ET.SubElement(junit_case, 'system-out')
     output.text = test.find('Log').text
+    return junit_case
+
+def _apply_output_policy(executor, junit_case, policy):
+    if junit_case.find('failure') is not None:
+        return junit_case
+    output = junit_case.find('system-out')
+    if not output.text:
+        return junit_case
+    lines = output.text.splitlines(True)
+    omitted = len(lines) - policy.head_lines - policy.tail_lines
+    if omitted <= 0:
+        return junit_case
+    note = '[... {0} lines omitted'.format(omitted)
+    if policy.spill_dir:
+        filename = policy._get_spill_filename(junit_case.get('name'))
+        executor.write_file(os.path.join(policy.spill_dir, filename), output.text,
+                compress=True)
+        note += '; full output in {0}/{1}'.format(policy.spill_link, filename)
+    note += ' ...]\n'
+    head = lines[:policy.head_lines]
+    tail = lines[len(lines)-policy.tail_lines:]
+    output.text = ''.join(head) + note + ''.join(tail)
+    return junit_case
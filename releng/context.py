@@ -1,20 +1,35 @@
 """
 Top-level interface for build scripts to the releng package.
 """
+from __future__ import print_function
+
 import os
 import glob
 import hashlib
+import json
 import re
 import shutil
 import subprocess
 
 from common import BuildError, CommandError, ConfigurationError
 from common import JobType, Project
-from options import BuildConfig, process_build_options, select_build_hosts
+from options import BuildConfig, get_build_labels, get_canonical_key
+from options import process_build_options, select_build_hosts
 from script import BuildScript, BuildScriptSettings
 import cmake
+import resourcespec
+import resultstore
+import testselection
 import utils
 
+# Test timing data that CTest writes in the build directory and reads to
+# start the longest tests first.
+_CTEST_COST_DATA = 'Testing/Temporary/CTestCostData.txt'
+
+def _get_ctest_regex(tests):
+    """Returns a CTest regex that matches exactly the given tests."""
+    return '^(' + '|'.join([cmake.escape_ctest_regex(x) for x in tests]) + ')$'
+
 class BuildContext(object):
     """Top-level interface for build scripts to the releng package.
 
@@ -46,8 +61,15 @@ class BuildContext(object):
         self._projects = factory.projects
         self._version = None
         self.workspace = factory.workspace
+        self._config_key = get_canonical_key(
+                list(opts or []) + list(script_settings.build_opts or []))
         self.env, self.opts = process_build_options(factory, opts, script_settings)
         self.params = factory.jenkins.params
+        self._build_url = factory.jenkins.build_url
+        self._node_cache_dir = factory.jenkins.node_cache_dir
+        self._node_name = factory.jenkins.node_name
+        self._result_store_path = factory.jenkins.result_store_path
+        self._build_labels = get_build_labels(list(opts or []))
 
     # TODO: Consider if these would be better set in the build script, and
     # just the values queried.
@@ -110,6 +132,11 @@ class BuildContext(object):
         The working directory should be the build directory.
         Currently, does not support running CMake multiple times.
 
+        If a result store is configured, the compiler and CMake versions used
+        are recorded there (see resultstore.py).  With the ``test-selection``
+        build option, the target information needed by run_ctest() is
+        requested from CMake.
+
         Args:
             options (Dict[str,str]): Dictionary of macro definitions to pass to
                 CMake using ``-D``.
@@ -122,6 +149,7 @@ class BuildContext(object):
         options['CMAKE_CXX_COMPILER'] = self.env.cxx_compiler
         options['CMAKE_INSTALL_PREFIX'] = self.workspace.install_dir
         options.update(self.env.extra_cmake_options)
+        options.update(self.env._get_job_pool_cmake_options())
         cmake_args = [self.env.cmake_command, self.workspace.get_project_dir(Project.GROMACS)]
         if self.env.cmake_generator is not None:
             cmake_args.extend(['-G', self.env.cmake_generator])
@@ -129,11 +157,43 @@ class BuildContext(object):
                 ['-D{0}={1}'.format(key, value)
                     for key, value in sorted(options.iteritems())
                     if value is not None])
+        if self.env._test_selection:
+            testselection.write_codemodel_query(self._executor)
         self.run_cmd([self.env.cmake_command, '--version'])
+        self._record_toolchain()
         self.run_cmd(cmake_args, failure_message='CMake configuration failed')
 
+    def _record_toolchain(self):
+        """Records the toolchain of this build in the result store.
+
+        The fingerprint of the compiler, CUDA and CMake versions is used to only
+        reuse results of matrix configurations for the same toolchain (see
+        resultstore.py).
+        """
+        if not self._result_store_path:
+            return
+        cmds = [[self.env.cmake_command, '--version']]
+        for compiler in (self.env.c_compiler, self.env.cxx_compiler):
+            if compiler:
+                cmds.append([compiler, '--version'])
+        if self.env.cuda_root:
+            cmds.append([os.path.join(self.env.cuda_root, 'bin', 'nvcc'), '--version'])
+        versions = []
+        for cmd in cmds:
+            try:
+                versions.append(self._cmd_runner.check_output(cmd))
+            except CommandError:
+                versions.append(None)
+        fingerprint = resultstore.compute_toolchain_fingerprint(versions)
+        store = resultstore.ResultStore(self._result_store_path)
+        try:
+            store.record_toolchain(self._node_name, self._build_labels, fingerprint)
+        finally:
+            store.close()
+
     def build_target(self, target=None, parallel=True, keep_going=False,
-            target_descr=None, failure_string=None, continue_on_failure=False):
+            target_descr=None, failure_string=None, continue_on_failure=False,
+            adaptive=None):
         """Builds a given target.
 
         run_cmake() must have been called to generate the build system.
@@ -153,14 +213,23 @@ class BuildContext(object):
             continue_on_failure (Optional[bool]): If ``True`` and the target
                 fails to build, the failure is only reported and
                 ``self.failed`` is set to ``True``.
+            adaptive (Optional[bool]): If ``True``, the number of parallel
+                jobs is reduced while the build agent is overloaded, and
+                increased again when there is headroom.  If ``None``, the
+                ``adaptive-jobs`` build option determines this.
 
         Raises:
             BuildError: If the target fails to build, and
                 ``continue_on_failure`` is not specified.
         """
-        cmd = self.env._get_build_cmd(target=target, parallel=parallel, keep_going=keep_going)
+        if adaptive is None:
+            adaptive = bool(self.opts.adaptive_jobs)
         try:
-            self.run_cmd(cmd)
+            if adaptive and parallel and self.env._supports_jobserver():
+                self._build_target_adaptive(target, keep_going)
+            else:
+                cmd = self.env._get_build_cmd(target=target, parallel=parallel, keep_going=keep_going)
+                self.run_cmd(cmd)
         except BuildError:
             if failure_string is None:
                 if target_descr is not None:
@@ -175,29 +244,203 @@ class BuildContext(object):
             else:
                 raise BuildError(failure_string)
 
-    def run_ctest(self, args, memcheck=False, failure_string=None):
+    def _build_target_adaptive(self, target, keep_going):
+        import throttle
+        cmd = self.env._get_build_cmd(target=target, keep_going=keep_going, jobserver=True)
+        server = throttle.AdaptiveJobServer(self._executor,
+                self.env._get_max_build_jobs(), self.env._get_compile_job_memory())
+        with server:
+            env = self._cmd_runner.get_environment()
+            env['MAKEFLAGS'] = server.makeflags
+            self.run_cmd(cmd, env=env)
+
+    def run_ctest(self, args, memcheck=False, failure_string=None, truncate_output=False,
+            smoke_tests=None):
         """Runs tests using CTest.
 
         The build is marked unstable if any test fails.
 
+        The tests run in parallel if the ``test-jobs`` or ``cpu-partition``
+        build options are used.  With CTest 3.16 or newer, CTest then also
+        gets a resource specification of the CPUs and GPUs available to the
+        build, so that tests that declare their resource needs are packed
+        without oversubscribing the agent.  The test timing data that CTest
+        uses for scheduling (longest tests first) is kept between builds of
+        the same configuration in a node-local cache.
+
+        With the ``test-shard=I/K`` build option, only the I'th of K parts of
+        the tests is run.  The tests are split by name, since the timing data
+        in the node-local cache differs between agents, and all shards must
+        agree on the split.  The shard and a digest of the split tests are
+        recorded in the JUnit XML, so that merge_junit_xml() can check that
+        the shards together run each test exactly once.  Shards do not
+        update the cached timing data.
+
+        With the ``test-selection=first|only`` build option, the tests that
+        can be affected by the change being built are determined from the
+        files it changes and the target information from CMake (see
+        testselection.py).  These tests and the ``smoke_tests`` are run first
+        (or only those, for pre-submit verification), and the selection is
+        written to :file:`ctest-selection.json` in the log directory.  If the
+        affected tests cannot be determined reliably, all tests are run.
+
+        The test results are converted to JUnit XML for Jenkins.  With
+        ``truncate_output``, long output from passed tests is truncated in the
+        JUnit XML, and the full output is written compressed into
+        :file:`ctest-output/` in the log directory; the job then needs to
+        archive these files for the links in the test report to work.
+
         Args:
             args (List[str]): Additional arguments to pass to CTest.
             memcheck (Optional[bool]): If ``true``, run CTest with a memory checker.
             failure_string (Optional[str]): If give, this message is used as
                 the failure message reported to Gerrit if the tests fail.
+            truncate_output (Optional[bool]): If ``true``, truncate long
+                output of passed tests in the JUnit XML.
+            smoke_tests (Optional[List[str]]): Names of tests that are always
+                run with the affected tests.
         """
         dtype = 'ExperimentalTest'
         if memcheck:
             dtype = 'ExperimentalMemCheck'
         cmd = [self.env.ctest_command, '-D', dtype]
+        if self.env._test_jobs and not any(x.startswith(('-j', '--parallel')) for x in args):
+            cmd.extend(['-j', str(self.env._test_jobs)])
+        if self.env._test_jobs and self.env._supports_resource_spec() \
+                and not any(x.startswith('--resource-spec-file') for x in args):
+            spec_path = self.workspace.get_path_for_logfile('ctest-resource-spec.json')
+            resourcespec.write_resource_spec(self._executor, spec_path,
+                    self.env._get_test_resource_spec())
+            cmd.extend(['--resource-spec-file', spec_path])
         cmd.extend(args)
-        try:
-            self._cmd_runner.check_call(cmd)
-        except CommandError as e:
+        # Each phase is a separate CTest run, with arguments to select tests.
+        phases = [[]]
+        junit_properties = None
+        test_selection = self.env._test_selection
+        if self.env._test_shard:
+            if test_selection:
+                print('test-shard: ignoring test selection by impact',
+                        file=self._executor.console)
+            tests, junit_properties = self._select_test_shard(args)
+            if not tests:
+                cmake.write_empty_junit_xml(self._executor, memcheck, junit_properties)
+                return
+            phases = [['-R', _get_ctest_regex(tests)]]
+        else:
+            if test_selection:
+                phases = self._get_test_selection_phases(args, test_selection, smoke_tests)
+                if not phases:
+                    cmake.write_empty_junit_xml(self._executor, memcheck)
+                    return
+            self._restore_ctest_cost_data(dtype)
+        output_policy = None
+        if truncate_output:
+            output_policy = self._get_test_output_policy()
+        junit_paths = []
+        error = None
+        for index, phase_args in enumerate(phases):
+            try:
+                self._cmd_runner.check_call(cmd + phase_args)
+            except CommandError as e:
+                if error is None:
+                    error = e
+            junit_path = None
+            if len(phases) > 1:
+                junit_path = 'Testing/Temporary/CTest-{0}.xml'.format(index + 1)
+            cmake.process_ctest_xml(self._executor, memcheck, output_policy,
+                    output_path=junit_path, properties=junit_properties)
+            junit_paths.append(junit_path)
+        if error is not None:
             if failure_string is None:
-                failure_string = 'failed test: ' + e.cmd
+                failure_string = 'failed test: ' + error.cmd
             self.mark_unstable(failure_string)
-        cmake.process_ctest_xml(self._executor, memcheck)
+        if not self.env._test_shard:
+            cost_cache_path = self._get_ctest_cost_cache_path(dtype)
+            self._executor.ensure_dir_exists(os.path.dirname(cost_cache_path))
+            self._executor.copy_file(_CTEST_COST_DATA, cost_cache_path)
+        if len(phases) > 1:
+            cmake.merge_junit_xml(self._executor, junit_paths, 'Testing/Temporary/CTest.xml')
+
+    def _restore_ctest_cost_data(self, dtype):
+        self._executor.ensure_dir_exists(os.path.dirname(_CTEST_COST_DATA))
+        self._executor.copy_file(self._get_ctest_cost_cache_path(dtype), _CTEST_COST_DATA)
+
+    def _select_test_shard(self, args):
+        """Returns the tests to run in the test shard of this build.
+
+        Returns:
+            Tuple[List[str], Dict[str, str]]: Tests to run, and properties
+                that identify the shard in the JUnit XML.
+        """
+        index, count = self.env._test_shard
+        output = self._cmd_runner.check_output([self.env.ctest_command, '-N'] + args)
+        tests = cmake.parse_ctest_test_list(output)
+        shard = cmake.split_tests_into_shards(tests, dict(), count)[index]
+        print('test-shard={0}/{1}: running {2} of {3} tests: {4}'.format(
+            index + 1, count, len(shard), len(tests), ' '.join(shard)),
+            file=self._executor.console)
+        properties = {
+                'test-shard': '{0}/{1}'.format(index + 1, count),
+                'test-shard-tests': hashlib.sha1('\n'.join(tests)).hexdigest()
+            }
+        return shard, properties
+
+    def _get_test_selection_phases(self, args, mode, smoke_tests):
+        """Selects tests affected by the change being built.
+
+        The selection is written into the log directory, so that it can be
+        inspected and reproduced.
+
+        Returns:
+            List[List[str]]: Arguments to select tests for each phase of the
+                test run.
+        """
+        if not self.env._is_cmake_version_at_least(testselection.MINIMUM_CMAKE_VERSION):
+            print('test selection: CMake version not known to support it, running all tests',
+                    file=self._executor.console)
+            return [[]]
+        output = self._cmd_runner.check_output(
+                [self.env.ctest_command, '--show-only=json-v1'] + args)
+        tests = testselection.parse_ctest_json(output)
+        targets = testselection.read_codemodel(self._executor)
+        changed_files = self.workspace.get_changed_files(Project.GROMACS)
+        selection = testselection.select_tests(tests, targets, changed_files, smoke_tests)
+        path = self.workspace.get_path_for_logfile('ctest-selection.json')
+        data = selection.to_dict()
+        data['mode'] = mode
+        self._executor.write_file(path, json.dumps(data, indent=2, sort_keys=True) + '\n')
+        if selection.tests is None:
+            print('test selection: running all tests ({0})'.format(selection.reason),
+                    file=self._executor.console)
+            return [[]]
+        print('test selection: {0} of {1} tests affected by {2} changed files: {3}'.format(
+            len(selection.tests), len(tests), len(changed_files), ' '.join(selection.tests)),
+            file=self._executor.console)
+        if not selection.tests:
+            if mode == 'only':
+                return []
+            return [[]]
+        phases = [['-R', _get_ctest_regex(selection.tests)]]
+        if mode == 'first' and len(selection.tests) < len(tests):
+            phases.append(['-E', _get_ctest_regex(selection.tests)])
+        return phases
+
+    def _get_ctest_cost_cache_path(self, dtype):
+        """Returns the path where CTest cost data for this build is cached.
+
+        The cache is shared between builds on the same agent, and the data is
+        kept separately for each configuration (independent of the order and
+        spelling of the build options).
+        """
+        fingerprint = hashlib.sha1(self._config_key + '\n' + dtype).hexdigest()
+        return os.path.join(self._node_cache_dir, 'ctest-cost', fingerprint + '.txt')
+
+    def _get_test_output_policy(self):
+        spill_dir = self.workspace.get_log_dir(category='ctest-output')
+        spill_link = os.path.relpath(spill_dir, self.workspace.root)
+        if self._build_url:
+            spill_link = '{0}/artifact/{1}'.format(self._build_url.rstrip('/'), spill_link)
+        return cmake.TestOutputPolicy(spill_dir=spill_dir, spill_link=spill_link)
 
     def compute_md5(self, path):
         """Computes MD5 hash of a file.
@@ -458,6 +701,57 @@ class BuildContext(object):
         script.do_build(context, factory.cwd)
         return context
 
+    @staticmethod
+    def _run_builds(factory, build, job_type, opts_list):
+        """Runs the build script for several configurations.
+
+        The projects are checked out and the build script loaded only once;
+        each configuration then gets its own build context, build and log
+        directories, and status section.
+
+        Returns:
+            List[Dict]: Options and result for each configuration.
+        """
+        projects = factory.projects
+        workspace = factory.workspace
+        status = factory.status_reporter
+        console = factory.executor.console
+        workspace._clear_workspace_dirs()
+        projects.checkout_project(factory.default_project)
+        build_script_path = workspace._resolve_build_input_file(build, '.py')
+        script = BuildScript(factory.executor, build_script_path)
+        for project in script.settings.extra_projects:
+            projects.checkout_project(project)
+        projects.print_project_info()
+        projects.check_projects()
+        cmake_version = None
+        if factory.default_project == Project.GROMACS:
+            gromacs_dir = workspace.get_project_dir(Project.GROMACS)
+            cmake_version = cmake.read_cmake_minimum_version(factory.executor, gromacs_dir)
+        initial_cwd = factory.cwd.cwd
+        initial_env = factory.cmd_runner._save_state()
+        results = []
+        for index, opts in enumerate(opts_list):
+            name = 'config-{0}'.format(index + 1)
+            print('-----------------------------------------------------------', file=console)
+            print('Building {0}: {1}'.format(name, ' '.join(opts)), file=console)
+            factory.cwd.chdir(initial_cwd)
+            factory.cmd_runner._restore_state(initial_env)
+            context = None
+            with status.section(name) as section:
+                try:
+                    context = factory.create_context(job_type, opts, script.settings)
+                    out_of_source = script.settings.build_out_of_source or context.opts.out_of_source
+                    workspace._init_config_dirs(name, out_of_source)
+                    if cmake_version:
+                        context.env._set_cmake_minimum_version(cmake_version)
+                    script.do_build(context, factory.cwd)
+                finally:
+                    if context is not None:
+                        context.env._release_resources()
+            results.append({ 'opts': opts, 'result': section.result })
+        return results
+
     @staticmethod
     def _read_build_script_config(factory, script_name):
         projects = factory.projects
@@ -0,0 +1,197 @@
+"""
+Generation of covering arrays for matrix builds
+
+A covering array of strength t contains, for every choice of t option axes
+and every combination of values on those axes, at least one configuration
+that has that combination.  This gives the same t-wise interaction coverage
+as the full cross product of the axes with far fewer configurations.
+
+The matrix files can declare axes and constraints with directives (see
+:file:`docs/releng.rst`); matrixbuild.py parses those and calls
+generate_covering_array().
+"""
+
+import fnmatch
+import itertools
+
+from common import ConfigurationError
+
+class Axis(object):
+    """Option axis for covering array generation.
+
+    Attributes:
+        name (str): Name of the axis.
+        values (List[Tuple[str]]): Possible values of the axis, each a tuple
+            of options (empty if the value adds no options).
+    """
+
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+
+class Constraint(object):
+    """Base class for constraints on generated configurations."""
+
+    def is_violated(self, opts, complete):
+        """Checks the constraint on a (partial) configuration.
+
+        Args:
+            opts (List[str]): Options in the configuration.
+            complete (bool): Whether opts is a complete configuration.
+                Partial configurations are rejected only if no completion
+                can satisfy the constraint.
+        """
+        raise NotImplementedError()
+
+def matches_option(opts, pattern):
+    """Checks whether any option in opts matches a shell-style pattern."""
+    return any([fnmatch.fnmatchcase(x, pattern) for x in opts])
+
+class RequireConstraint(Constraint):
+    """Requires one of a set of options if an option is present.
+
+    ``RequireConstraint('cuda-*', ['gcc-*', 'clang-*'])`` means that any
+    configuration with a CUDA option must also use gcc or clang.
+    """
+
+    def __init__(self, pattern, required):
+        self._pattern = pattern
+        self._required = required
+
+    def is_violated(self, opts, complete):
+        if not complete or not matches_option(opts, self._pattern):
+            return False
+        return not any([matches_option(opts, x) for x in self._required])
+
+class ExcludeConstraint(Constraint):
+    """Disallows configurations that have options matching all patterns."""
+
+    def __init__(self, patterns):
+        self._patterns = patterns
+
+    def is_violated(self, opts, complete):
+        return all([matches_option(opts, x) for x in self._patterns])
+
+class _Generator(object):
+    def __init__(self, axes, constraints, is_valid):
+        self._axes = axes
+        self._constraints = constraints
+        self._is_valid = is_valid
+        self._completable = dict()
+
+    def _get_opts(self, assignment):
+        opts = []
+        for axis_index, value_index in sorted(assignment.iteritems()):
+            opts.extend(self._axes[axis_index].values[value_index])
+        return opts
+
+    def _is_allowed(self, assignment, complete):
+        opts = self._get_opts(assignment)
+        for constraint in self._constraints:
+            if constraint.is_violated(opts, complete):
+                return False
+        if complete and self._is_valid and not self._is_valid(opts):
+            return False
+        return True
+
+    def is_completable(self, assignment):
+        """Checks whether a partial assignment can be extended to a valid one."""
+        key = frozenset(assignment.iteritems())
+        result = self._completable.get(key, None)
+        if result is not None:
+            return result
+        complete = len(assignment) == len(self._axes)
+        if not self._is_allowed(assignment, complete):
+            result = False
+        elif complete:
+            result = True
+        else:
+            axis_index = min(set(range(len(self._axes))) - set(assignment.iterkeys()))
+            result = False
+            for value_index in range(len(self._axes[axis_index].values)):
+                assignment[axis_index] = value_index
+                if self.is_completable(assignment):
+                    result = True
+                del assignment[axis_index]
+                if result:
+                    break
+        self._completable[key] = result
+        return result
+
+    def get_tuples(self, strength):
+        """Returns all t-wise value combinations that valid configs can have."""
+        tuples = set()
+        for axis_indices in itertools.combinations(range(len(self._axes)), strength):
+            value_ranges = [range(len(self._axes[x].values)) for x in axis_indices]
+            for value_indices in itertools.product(*value_ranges):
+                item = tuple(zip(axis_indices, value_indices))
+                if self.is_completable(dict(item)):
+                    tuples.add(item)
+        return tuples
+
+    def generate(self, strength):
+        uncovered = self.get_tuples(strength)
+        configs = []
+        while uncovered:
+            assignment = dict(min(uncovered))
+            for axis_index in range(len(self._axes)):
+                if axis_index in assignment:
+                    continue
+                best = None
+                for value_index in range(len(self._axes[axis_index].values)):
+                    assignment[axis_index] = value_index
+                    if self.is_completable(assignment):
+                        gain = self._count_covered(assignment, axis_index, uncovered, strength)
+                        if best is None or gain > best[0]:
+                            best = (gain, value_index)
+                    del assignment[axis_index]
+                assignment[axis_index] = best[1]
+            covered = self._get_covered(assignment, strength)
+            uncovered.difference_update(covered)
+            configs.append(self._get_opts(assignment))
+        return configs
+
+    def _count_covered(self, assignment, axis_index, uncovered, strength):
+        """Counts uncovered tuples that involve axis_index and are covered."""
+        others = [x for x in assignment.iterkeys() if x != axis_index]
+        count = 0
+        for combination in itertools.combinations(sorted(others), strength - 1):
+            axis_indices = sorted(combination + (axis_index,))
+            item = tuple([(x, assignment[x]) for x in axis_indices])
+            if item in uncovered:
+                count += 1
+        return count
+
+    def _get_covered(self, assignment, strength):
+        result = set()
+        for axis_indices in itertools.combinations(sorted(assignment.iterkeys()), strength):
+            result.add(tuple([(x, assignment[x]) for x in axis_indices]))
+        return result
+
+def generate_covering_array(axes, constraints=None, strength=2, is_valid=None):
+    """Generates configurations that cover all t-wise value combinations.
+
+    The generation is greedy (each configuration is built to cover as many
+    still uncovered combinations as possible), so the result is not always
+    the smallest possible, but it is deterministic for the same input.
+    Only combinations that can appear in a configuration that satisfies the
+    constraints are required to be covered.
+
+    Args:
+        axes (List[Axis]): Option axes.
+        constraints (List[Constraint]): Constraints for the configurations.
+        strength (int): Interaction strength t.
+        is_valid (function): If given, called with the options of each
+            complete configuration; configurations for which it returns False
+            are not generated.
+
+    Returns:
+        List[List[str]]: Options for each generated configuration.
+    """
+    if not axes:
+        return []
+    if strength < 1:
+        raise ConfigurationError('covering array strength must be positive')
+    strength = min(strength, len(axes))
+    generator = _Generator(axes, constraints or [], is_valid)
+    return generator.generate(strength)
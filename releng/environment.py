@@ -4,6 +4,7 @@ Build and Jenkins environment handling
 This file contains all the code that hardcodes details about the Jenkins build
 agent environment, such as paths to various executables.
 """
+from __future__ import print_function
 
 import os
 
@@ -11,6 +12,8 @@ from common import ConfigurationError
 from common import Compiler,System
 import cmake
 import agents
+import hardware
+import resourcespec
 import re
 
 # TODO: Check that the paths returned/used actually exists and raise nice
@@ -20,6 +23,20 @@ import re
 # different approaches may be used (some might set an environment variable,
 # others use an absolute path, or set a CMake option).
 
+# Estimated peak memory use (in GiB) of a single compilation job for each
+# compiler, used to limit the number of parallel jobs with build-jobs=auto
+# and memory-governor.  Compilers not listed use the default.
+_COMPILE_JOB_MEMORY = {
+        Compiler.INTEL: 1.5
+    }
+_DEFAULT_COMPILE_JOB_MEMORY = 1.0
+# nvcc compilation of the CUDA kernels needs considerably more memory.
+_CUDA_COMPILE_JOB_MEMORY = 2.5
+# ThreadSanitizer instrumentation roughly doubles the compiler memory use.
+_TSAN_MEMORY_FACTOR = 2.0
+# Estimated peak memory use (in GiB) of a single link job.
+_LINK_JOB_MEMORY = 1.5
+
 def _to_version_tuple(version_string):
     return [int(x) for x in version_string.split('.')]
 
@@ -93,11 +110,27 @@ class BuildEnvironment(object):
 
         self._build_prefix_cmd = None
         self._cmd_runner = factory.cmd_runner
+        self._executor = factory.executor
         self._workspace = factory.workspace
         self._node_name = factory.jenkins.node_name
         self._cmake_base_dir = None
 
         self._build_jobs = agents.get_default_build_parallelism(self._node_name)
+        self._build_jobs_auto = False
+        self._build_load_limit = None
+        self._adaptive_build_jobs = False
+        self._build_jobs_explicit = False
+        self._use_cpu_partition = False
+        self._cpu_partition = None
+        self._test_jobs = None
+        self._test_jobs_auto = False
+        self._test_jobs_explicit = False
+        self._test_shard = None
+        self._test_selection = None
+        self._tsan = False
+        self._memory_governor = False
+        self._memory_job_limits = None
+        self._node_cache_dir = factory.jenkins.node_cache_dir
 
         environment_command = agents.get_environment_subshell(self._node_name)
         if environment_command:
@@ -132,19 +165,229 @@ class BuildEnvironment(object):
         clang_format_name = 'clang-format-{0}'.format(version)
         return self._cmd_runner.find_executable(clang_format_name)
 
-    def _get_build_cmd(self, target=None, parallel=True, keep_going=False):
+    def _get_build_cmd(self, target=None, parallel=True, keep_going=False,
+            jobserver=False):
         cmd = []
         if self._build_prefix_cmd is not None:
             cmd.extend(self._build_prefix_cmd)
         cmd.extend([self.cmake_command, '--build', '.'])
         if target is not None:
             cmd.extend(['--target', target])
-        jobs = self._build_jobs if parallel else 1
-        cmd.extend(['--', '-j{0}'.format(jobs)])
+        cmd.append('--')
+        if not jobserver:
+            # With a jobserver, parallelism comes from MAKEFLAGS, and -j on
+            # the command line would disable the jobserver.
+            jobs = self._get_max_build_jobs() if parallel else 1
+            cmd.append('-j{0}'.format(jobs))
+            if parallel and self._build_load_limit and self._supports_load_limit():
+                cmd.append('-l{0}'.format(self._build_load_limit))
         if keep_going:
             cmd.append('-k')
         return cmd
 
+    def _get_max_build_jobs(self):
+        """Returns the number of parallel build jobs, limited by memory.
+
+        With job pools (Ninja), the memory limits are applied through the
+        pools instead.
+        """
+        jobs = self._build_jobs
+        if self._memory_job_limits and not self._uses_job_pools():
+            jobs = min(jobs, self._memory_job_limits[0])
+        return jobs
+
+    def _supports_load_limit(self):
+        """Whether the native build tool accepts a load-average limit (-l)."""
+        generator = self.cmake_generator
+        if generator is None:
+            return self.system != System.WINDOWS
+        if 'NMake' in generator or 'Visual Studio' in generator:
+            return False
+        return 'Makefiles' in generator or 'Ninja' in generator
+
+    def _supports_jobserver(self):
+        """Whether the native build tool can use a GNU make jobserver."""
+        if self.cmake_generator is None:
+            return self.system not in (System.WINDOWS, None)
+        return self.cmake_generator == 'Unix Makefiles'
+
+    def _get_compile_job_memory(self):
+        """Returns estimated peak memory use of a compilation job in bytes."""
+        memory_per_job = _COMPILE_JOB_MEMORY.get(self.compiler, _DEFAULT_COMPILE_JOB_MEMORY)
+        if self.cuda_root is not None:
+            memory_per_job = max(memory_per_job, _CUDA_COMPILE_JOB_MEMORY)
+        if self._tsan:
+            memory_per_job *= _TSAN_MEMORY_FACTOR
+        return int(memory_per_job * 2**30)
+
+    def _get_link_job_memory(self):
+        """Returns estimated peak memory use of a link job in bytes."""
+        memory_per_job = _LINK_JOB_MEMORY
+        if self._tsan:
+            memory_per_job *= _TSAN_MEMORY_FACTOR
+        return int(memory_per_job * 2**30)
+
+    def _get_memory_share(self):
+        """Returns the memory available to this build in bytes, or None.
+
+        If the available memory cannot be read from the system, the memory
+        of the agent from the inventory is used instead.
+        """
+        memory = hardware.get_available_memory(self._executor)
+        if memory is None:
+            info = agents.get_agent_info(self._node_name)
+            if info and info.memory:
+                memory = int(info.memory * 2**30)
+        if memory is None:
+            return None
+        return memory // agents.get_executor_count(self._node_name)
+
+    def _set_memory_job_limits(self):
+        """Limits the number of concurrent compile and link jobs by memory.
+
+        With Ninja, the limits are applied through CMake job pools, so that
+        only the memory-hungry jobs are limited; otherwise, the number of
+        parallel build jobs is limited to the number of compile jobs that
+        fit into memory.
+        """
+        memory = self._get_memory_share()
+        if memory is None:
+            print('memory-governor: available memory not known, not limiting build jobs',
+                    file=self._executor.console)
+            return
+        compile_jobs = max(1, memory // self._get_compile_job_memory())
+        link_jobs = max(1, memory // self._get_link_job_memory())
+        self._memory_job_limits = (compile_jobs, link_jobs)
+        print('memory-governor: {0:.1f} GiB available for the build: at most {1} compile and {2} link jobs'.format(
+            float(memory) / 2**30, compile_jobs, link_jobs), file=self._executor.console)
+
+    def _uses_job_pools(self):
+        return self.cmake_generator is not None and 'Ninja' in self.cmake_generator
+
+    def _get_job_pool_cmake_options(self):
+        """Returns CMake options to configure job pools for the build."""
+        if not self._memory_job_limits or not self._uses_job_pools():
+            return dict()
+        compile_jobs, link_jobs = self._memory_job_limits
+        return {
+                'CMAKE_JOB_POOLS': 'compile={0};link={1}'.format(compile_jobs, link_jobs),
+                'CMAKE_JOB_POOL_COMPILE': 'compile',
+                'CMAKE_JOB_POOL_LINK': 'link'
+            }
+
+    def _set_auto_build_jobs(self):
+        """Sizes build parallelism based on the available hardware.
+
+        The number of CPUs usable by this process (or the CPUs in the claimed
+        CPU partition) and the available memory are shared between the
+        executors on the agent, and the memory is further divided by an
+        estimate of the memory use of a single compilation job.  The build
+        tool is also asked not to start new jobs when the system load exceeds
+        the number of CPUs, which helps when the other executors use more than
+        their share.
+        """
+        memory = self._get_memory_share()
+        executors = agents.get_executor_count(self._node_name)
+        if self._cpu_partition:
+            cpus = len(self._cpu_partition.cpus)
+        else:
+            cpus = max(1, hardware.get_available_cpu_count(self._executor) // executors)
+        self._build_jobs = hardware.compute_build_jobs(cpus, memory,
+                self._get_compile_job_memory())
+        self._build_load_limit = hardware.get_total_cpu_count()
+        if memory is None:
+            memory_info = 'unknown'
+        else:
+            memory_info = '{0:.1f} GiB'.format(float(memory) / 2**30)
+        print('build-jobs=auto: using {0} jobs (CPUs: {1}, memory: {2}, executors: {3})'.format(
+            self._build_jobs, cpus, memory_info, executors), file=self._executor.console)
+
+    def _set_auto_test_jobs(self):
+        """Sizes test parallelism based on the available CPUs.
+
+        Tests use the claimed CPU partition if there is one, and otherwise
+        share the CPUs usable by this process with the other executors on the
+        agent.
+        """
+        executors = agents.get_executor_count(self._node_name)
+        if self._cpu_partition:
+            self._test_jobs = len(self._cpu_partition.cpus)
+        else:
+            cpus = hardware.get_available_cpu_count(self._executor)
+            self._test_jobs = max(1, cpus // executors)
+        print('test-jobs=auto: running {0} tests in parallel (executors: {1})'.format(
+            self._test_jobs, executors), file=self._executor.console)
+
+    def _is_cmake_version_at_least(self, version):
+        """Whether the CMake version is known to be at least the given one."""
+        if not self.cmake_version:
+            return False
+        return not _is_older_version(self.cmake_version, version)
+
+    def _supports_resource_spec(self):
+        """Whether CTest is known to support resource specification files."""
+        return self._is_cmake_version_at_least(resourcespec.MINIMUM_CTEST_VERSION)
+
+    def _get_test_resource_spec(self):
+        """Returns the CTest resource specification for running tests.
+
+        The CPUs are those of the claimed CPU partition, or otherwise the
+        share of this executor of the CPUs available to the build.  GPUs come
+        from the agent inventory.
+        """
+        import affinity
+        if self._cpu_partition:
+            cpus = self._cpu_partition.cpus
+        else:
+            cpus = hardware.get_allowed_cpus(self._executor)
+            if not cpus:
+                cpus = range(hardware.get_total_cpu_count())
+            executors = agents.get_executor_count(self._node_name)
+            topology = affinity.get_cpu_topology(self._executor, cpus)
+            cpus = affinity.partition_cpus(topology, executors)[0] or cpus
+        topology = affinity.get_cpu_topology(self._executor, cpus)
+        gpus = None
+        info = agents.get_agent_info(self._node_name)
+        if info:
+            gpus = info.gpus
+        return resourcespec.create_resource_spec(topology, gpus)
+
+    def _release_resources(self):
+        """Releases resources claimed for the build (e.g., the CPU partition).
+
+        Only needed if the same process continues with another build.
+        """
+        if self._cpu_partition:
+            self._cpu_partition.release()
+            self._cpu_partition = None
+
+    def _claim_cpu_partition(self):
+        """Claims a disjoint set of CPUs for this build.
+
+        The CPUs are split between the executors on the agent, and subsequent
+        commands are pinned to the claimed CPUs.  Unless specified otherwise,
+        the build and test parallelism is set to the number of these CPUs.
+        """
+        if self.system != System.LINUX:
+            return
+        import affinity
+        executors = agents.get_executor_count(self._node_name)
+        lock_dir = os.path.join(self._node_cache_dir, 'cpu-partition')
+        partition = affinity.claim_cpu_partition(self._executor, lock_dir, executors)
+        if partition is None:
+            print('cpu-partition: no free CPU partition, not pinning the build to CPUs',
+                    file=self._executor.console)
+            return
+        self._cpu_partition = partition
+        self._cmd_runner.set_cpu_affinity(partition.cpus)
+        if not self._build_jobs_explicit:
+            self._build_jobs = len(partition.cpus)
+        if not self._test_jobs_explicit:
+            self._test_jobs = len(partition.cpus)
+        print('cpu-partition: using partition {0} of {1}: CPUs {2}'.format(
+            partition.index, executors, ','.join([str(x) for x in partition.cpus])),
+            file=self._executor.console)
+
     def _set_cmake_minimum_version(self, version):
         if self.cmake_version or not version:
             return
@@ -224,8 +467,44 @@ class BuildEnvironment(object):
     # Methods from here down are used as build option handlers in options.py.
     # Please keep them in the same order as in process_build_options().
 
+    def _enable_adaptive_build_jobs(self):
+        self._adaptive_build_jobs = True
+
     def _set_build_jobs(self, jobs):
+        if jobs == 'auto':
+            # Resolved in _finalize(), when the compiler is known.
+            self._build_jobs_auto = True
+            return
         self._build_jobs = jobs
+        self._build_jobs_explicit = True
+
+    def _set_test_jobs(self, jobs):
+        if jobs == 'auto':
+            # Resolved in _finalize(), after a possible CPU partition is claimed.
+            self._test_jobs_auto = True
+            return
+        self._test_jobs = jobs
+        self._test_jobs_explicit = True
+
+    def _set_test_shard(self, value):
+        match = re.match(r'^(\d+)/(\d+)$', value)
+        if not match:
+            raise ConfigurationError('invalid test-shard value: ' + value)
+        index, count = int(match.group(1)), int(match.group(2))
+        if not 1 <= index <= count:
+            raise ConfigurationError('invalid test-shard value: ' + value)
+        self._test_shard = (index - 1, count)
+
+    def _set_test_selection(self, mode):
+        if mode not in ('first', 'only'):
+            raise ConfigurationError('invalid test-selection value: ' + mode)
+        self._test_selection = mode
+
+    def _enable_cpu_partition(self):
+        self._use_cpu_partition = True
+
+    def _enable_memory_governor(self):
+        self._memory_governor = True
 
     def _init_cmake(self, version):
         cmake_bin_dir = os.path.join(self._cmake_base_dir, 'cmake-' + version, 'bin')
@@ -480,6 +759,9 @@ class BuildEnvironment(object):
     def _init_phi(self):
         self.extra_cmake_options['CMAKE_PREFIX_PATH'] = os.path.expanduser('~/utils/libxml2')
 
+    def _init_tsan(self):
+        self._tsan = True
+
     def _init_atlas(self):
         self.set_env_var('CMAKE_LIBRARY_PATH', '/usr/lib/atlas-base')
 
@@ -554,3 +836,15 @@ class BuildEnvironment(object):
         if use_stdlib_through_env_vars is None:
             use_stdlib_through_env_vars = True
         self._manage_stdlib(use_stdlib_through_env_vars)
+        if self._use_cpu_partition:
+            self._claim_cpu_partition()
+        if self._build_jobs_auto:
+            self._set_auto_build_jobs()
+        if self._test_jobs_auto:
+            self._set_auto_test_jobs()
+        if self._memory_governor:
+            self._set_memory_job_limits()
+        if self._adaptive_build_jobs and not self._supports_jobserver():
+            # Without a jobserver, the best we can do is to ask the build
+            # tool to not start new jobs when the agent is overloaded.
+            self._build_load_limit = hardware.get_total_cpu_count()
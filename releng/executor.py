@@ -13,7 +13,7 @@ expanding unit tests.
 """
 from __future__ import print_function
 
-from distutils.spawn import find_executable
+import gzip
 import os
 import pipes
 import re
@@ -80,22 +80,56 @@ class Executor(object):
         if os.path.isfile(source):
             shutil.copy(source, dest)
 
+    def list_dir(self, path):
+        """Returns names of the entries in a directory."""
+        return os.listdir(self._cwd.to_abs_path(path))
+
     def read_file(self, path, binary=False):
         """Iterates over lines in a file."""
         path = self._cwd.to_abs_path(path)
         return _read_file(path, binary)
 
-    def write_file(self, path, contents):
-        """Writes a file with the given contents."""
+    def write_file(self, path, contents, compress=False):
+        """Writes a file with the given contents.
+
+        Args:
+            path (str): Path to the file to write.
+            contents (str or iterable): Contents to write, either as a single
+                string or as an iterable over strings (written as they are
+                produced).  With an iterable, the contents are written into
+                a temporary file that is renamed to path only if the
+                iteration completes, so that an exception while producing
+                the contents does not leave a truncated file behind.
+            compress (bool): If ``True``, the file is written compressed
+                with gzip.
+        """
         path = self._cwd.to_abs_path(path)
-        with open(path, 'w') as fp:
-            fp.write(contents)
+        if isinstance(contents, basestring):
+            with self._open_for_write(path, compress) as fp:
+                fp.write(contents)
+            return
+        tmp_path = path + '.tmp'
+        try:
+            with self._open_for_write(tmp_path, compress) as fp:
+                for chunk in contents:
+                    fp.write(chunk)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def _open_for_write(self, path, compress):
+        if compress:
+            return gzip.open(path, 'wb')
+        return open(path, 'w')
 
     def find_executable_with_path(self, name, environment_path):
         """Returns the full path to the given executable,
         including resolving symlinks."""
         # If we at some point require Python 3.3, shutil.which() would be
         # more obvious.
+        from distutils.spawn import find_executable
         executable = find_executable(name, environment_path)
         if executable is None:
             raise ConfigurationError('can not find the executable: "' + name + '"')
@@ -134,11 +168,16 @@ class DryRunExecutor(object):
         if os.path.isfile(source):
             shutil.copy(source, dest)
 
+    def list_dir(self, path):
+        return os.listdir(self._cwd.to_abs_path(path))
+
     def read_file(self, path, binary=False):
         path = self._cwd.to_abs_path(path)
         return _read_file(path, binary)
 
-    def write_file(self, path, contents):
+    def write_file(self, path, contents, compress=False):
+        if not isinstance(contents, basestring):
+            contents = ''.join(contents)
         print('write: ' + path + ' <<<')
         print(contents + '<<<')
 
@@ -179,6 +218,8 @@ class CommandRunner(object):
             self._shell_call_opts['executable'] = '/bin/bash'
         self._is_windows = factory.system and factory.system == System.WINDOWS
         self._executor = factory.executor
+        self._cpu_affinity = None
+        self._affinity_setter = None
 
     def set_env_var(self, variable, value):
         if value is not None:
@@ -199,6 +240,29 @@ class CommandRunner(object):
     def copy_env_var(self, to_variable, from_variable):
         self._env[to_variable] = self._env[from_variable]
 
+    def set_cpu_affinity(self, cpus):
+        """Pins subsequently run commands to the given CPUs (Linux only)."""
+        import affinity
+        self._cpu_affinity = list(cpus)
+        self._affinity_setter = None
+        if self._cpu_affinity and not self._is_windows:
+            self._affinity_setter = affinity.create_affinity_setter(self._cpu_affinity)
+            if self._affinity_setter is None:
+                print('Cannot set CPU affinity on this system', file=self._executor.console)
+
+    def _save_state(self):
+        """Returns the environment and affinity for _restore_state()."""
+        return dict(self._env), (self._cpu_affinity, self._affinity_setter)
+
+    def _restore_state(self, state):
+        """Restores the state saved with _save_state()."""
+        env, (self._cpu_affinity, self._affinity_setter) = state
+        self._env = dict(env)
+
+    def get_environment(self):
+        """Returns a copy of the environment used for commands."""
+        return dict(self._env)
+
     def get_env_var(self, variable):
         try:
             return self._env[variable]
@@ -285,6 +349,8 @@ class CommandRunner(object):
             kwargs['cwd'] = self._cwd.cwd
         if not 'env' in kwargs:
             kwargs['env'] = self._env
+        if self._affinity_setter and not 'preexec_fn' in kwargs:
+            kwargs['preexec_fn'] = self._affinity_setter
         utils.flush_output()
         return cmd_string, kwargs
 
@@ -1,15 +1,16 @@
 """
 Declares a factory class for wiring together all the other releng classes.
+
+The modules for the wired classes are imported only when the corresponding
+object is first needed, so that entry points that only need a few of the
+objects do not pay for importing (and initializing) everything.
 """
 
 import os
 import platform
 
 from common import Project, System
-from context import BuildContext
-from executor import CommandRunner, CurrentDirectoryTracker, Executor
-from integration import GerritIntegration, JenkinsIntegration, ProjectsManager, StatusReporter
-from workspace import Workspace
+from executor import CurrentDirectoryTracker
 
 class ContextFactory(object):
 
@@ -115,6 +116,7 @@ class ContextFactory(object):
         """
         assert self._executor is None
         if instance is None:
+            from executor import Executor
             if cls is None:
                 instance = Executor(self)
             else:
@@ -123,6 +125,7 @@ class ContextFactory(object):
 
     def _init_cmd_runner(self):
         assert self._cmd_runner is None
+        from executor import CommandRunner
         self._cmd_runner = CommandRunner(self)
 
     def init_status_reporter(self, **kwargs):
@@ -131,6 +134,7 @@ class ContextFactory(object):
         If not called, the object will be created with default parameters.
         """
         assert self._status_reporter is None
+        from integration import StatusReporter
         self._status_reporter = StatusReporter(factory=self, **kwargs)
 
     def init_gerrit_integration(self, **kwargs):
@@ -139,6 +143,7 @@ class ContextFactory(object):
         If not called, the object will be created with default parameters.
         """
         assert self._gerrit is None
+        from integration import GerritIntegration
         self._gerrit = GerritIntegration(factory=self, **kwargs)
 
     def init_jenkins_integration(self):
@@ -147,16 +152,20 @@ class ContextFactory(object):
         If not called, the object will be created with default parameters.
         """
         assert self._jenkins is None
+        from integration import JenkinsIntegration
         self._jenkins = JenkinsIntegration(factory=self)
 
     def init_workspace_and_projects(self):
         """Initializes Workspace and ProjectsManager."""
         assert self._projects is None
         assert self._workspace is None
+        from integration import ProjectsManager
+        from workspace import Workspace
         self._workspace = Workspace(factory=self)
         self._projects = ProjectsManager(factory=self)
         self._projects.init_workspace()
 
     def create_context(self, *args):
         """Creates a BuildContext with given arguments."""
+        from context import BuildContext
         return BuildContext(self, *args)
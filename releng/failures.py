@@ -0,0 +1,129 @@
+"""
+Classification of matrix configuration failures
+
+Distinguishes failures caused by the build infrastructure (a lost agent, a
+full disk, a failed checkout) from genuine build and test failures, based on
+the result of the run and the end of its console log.  Configurations that
+failed because of the infrastructure can be retried without rebuilding the
+whole matrix.
+
+The console logs are read through a fetcher object, so that the logs can
+come from Jenkins or, for testing, from a local stand-in.
+"""
+
+import re
+import socket
+import urllib2
+
+class FailureClass(object):
+    """Classes of unsuccessful matrix runs."""
+    BUILD = 'build'
+    INFRASTRUCTURE = 'infrastructure'
+    # Not built at all, most likely because no agent matches the axis value;
+    # retrying would fail the same way.
+    NOT_BUILT = 'not-built'
+
+# Patterns in the console log that indicate an infrastructure failure, with
+# a description for each.  The checkout failure message comes from
+# ProjectsManager.check_projects().
+_INFRASTRUCTURE_PATTERNS = [
+        (r'ChannelClosedException|Agent went offline|Backing channel .* is disconnected'
+            r'|Connection was broken|RemotingSystemException', 'agent lost'),
+        (r'No space left on device|Disk quota exceeded', 'disk full'),
+        (r'Checkout failed \(Jenkins issue\)', 'checkout failure'),
+        (r'fatal: (?:unable to access|Could not read from remote repository)'
+            r'|ERROR: Error cloning remote repo|ERROR: Error fetching remote repo', 'git failure'),
+        (r'java\.lang\.OutOfMemoryError', 'Jenkins out of memory')
+    ]
+
+_INFRASTRUCTURE_REGEXES = [(re.compile(pattern), reason)
+        for pattern, reason in _INFRASTRUCTURE_PATTERNS]
+
+def _read_tail(fp, max_bytes, max_total):
+    """Reads a file-like object, keeping only its last max_bytes bytes.
+
+    Returns None if more than max_total bytes would need to be read.
+    """
+    tail = ''
+    total = 0
+    while True:
+        block = fp.read(64 * 1024)
+        if not block:
+            return tail
+        total += len(block)
+        if total > max_total:
+            return None
+        tail = (tail + block)[-max_bytes:]
+
+class JenkinsConsoleFetcher(object):
+    """Fetches console logs of builds from Jenkins.
+
+    Only the end of the log is requested (with an HTTP range request), and
+    if Jenkins sends the whole log instead, at most ``max_total`` bytes of it
+    are read.  Each request times out after ``timeout`` seconds.
+    """
+
+    def __init__(self, timeout=30, max_bytes=256 * 1024, max_total=64 * 1024 * 1024):
+        self._timeout = timeout
+        self._max_bytes = max_bytes
+        self._max_total = max_total
+
+    def get_console_tail(self, url, lines):
+        """Returns the last lines of the console log of a build.
+
+        Args:
+            url (str): Absolute URL of the build.
+            lines (int): Number of lines to return.
+
+        Returns:
+            List[str] or None: The lines, or None if the log is not available.
+        """
+        request = urllib2.Request(url.rstrip('/') + '/consoleText',
+                headers={'Range': 'bytes=-{0}'.format(self._max_bytes)})
+        try:
+            fp = urllib2.urlopen(request, timeout=self._timeout)
+            try:
+                text = _read_tail(fp, self._max_bytes, self._max_total)
+            finally:
+                fp.close()
+        except (IOError, socket.timeout):
+            return None
+        if text is None:
+            return None
+        return text.splitlines()[-lines:]
+
+class StaticConsoleFetcher(object):
+    """Local stand-in for JenkinsConsoleFetcher that serves given logs.
+
+    Args:
+        logs (Dict[str, str]): Console log text for each build URL.
+    """
+
+    def __init__(self, logs):
+        self._logs = logs
+
+    def get_console_tail(self, url, lines):
+        text = self._logs.get(url, None)
+        if text is None:
+            return None
+        return text.splitlines()[-lines:]
+
+def classify_failure(result, log_tail):
+    """Classifies an unsuccessful matrix run.
+
+    Args:
+        result (str): Jenkins result of the run.
+        log_tail (List[str]): End of the console log, or None if not available.
+
+    Returns:
+        Tuple[str, str]: FailureClass value, and for infrastructure failures,
+            a short description of the failure (None otherwise).
+    """
+    if result == 'NOT_BUILT':
+        return FailureClass.NOT_BUILT, None
+    if log_tail:
+        for line in log_tail:
+            for regex, reason in _INFRASTRUCTURE_REGEXES:
+                if regex.search(line):
+                    return FailureClass.INFRASTRUCTURE, reason
+    return FailureClass.BUILD, None
@@ -0,0 +1,142 @@
+"""
+Detection of hardware resources available to the build
+
+The functions here determine how many CPUs and how much memory the current
+process can actually use on the build agent, taking into account CPU affinity
+and cgroup (container) limits on Linux.  All files are read through Executor,
+and information that cannot be read is treated as unknown (no limit).
+"""
+
+import math
+import multiprocessing
+
+def _read_lines(executor, path):
+    try:
+        return list(executor.read_file(path))
+    except (IOError, OSError):
+        return None
+
+def _read_first_line(executor, path):
+    lines = _read_lines(executor, path)
+    if not lines:
+        return None
+    return lines[0].strip()
+
+def parse_cpu_list(text):
+    """Parses a CPU list in the format used by Linux (e.g., ``0-3,8,10-11``).
+
+    Returns:
+        List[int]: Sorted list of the CPU indices.
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def get_total_cpu_count():
+    """Returns the number of CPUs (hardware threads) in the system."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def get_allowed_cpus(executor):
+    """Returns the CPUs in the affinity mask of this process.
+
+    Returns:
+        List[int] or None: CPU indices, or None if not known.
+    """
+    lines = _read_lines(executor, '/proc/self/status')
+    if lines:
+        for line in lines:
+            if line.startswith('Cpus_allowed_list:'):
+                return parse_cpu_list(line.split(':', 1)[1])
+    return None
+
+def _get_cgroup_cpu_quota(executor):
+    """Returns the CPU quota of the cgroup as a number of CPUs, or None."""
+    # cgroup v2
+    line = _read_first_line(executor, '/sys/fs/cgroup/cpu.max')
+    if line:
+        fields = line.split()
+        if fields[0] == 'max' or len(fields) < 2:
+            return None
+        return float(fields[0]) / float(fields[1])
+    # cgroup v1
+    quota = _read_first_line(executor, '/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _read_first_line(executor, '/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0 and int(period) > 0:
+        return float(quota) / float(period)
+    return None
+
+def get_available_cpu_count(executor):
+    """Returns the number of CPUs that this process can use.
+
+    This considers the affinity mask of the process and the CPU quota of the
+    cgroup it runs in, in addition to the number of CPUs in the system.
+    """
+    cpus = get_allowed_cpus(executor)
+    count = len(cpus) if cpus else get_total_cpu_count()
+    quota = _get_cgroup_cpu_quota(executor)
+    if quota:
+        count = min(count, max(1, int(math.ceil(quota))))
+    return count
+
+def _get_cgroup_memory_limit(executor):
+    """Returns the memory limit of the cgroup in bytes, or None."""
+    for path in ('/sys/fs/cgroup/memory.max',
+                 '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        line = _read_first_line(executor, path)
+        if line:
+            if line == 'max':
+                return None
+            limit = int(line)
+            # cgroup v1 reports a huge number if there is no limit.
+            if limit >= 2**60:
+                return None
+            return limit
+    return None
+
+def get_available_memory(executor):
+    """Returns the memory available for new processes in bytes.
+
+    Returns:
+        int or None: Available memory, or None if it cannot be determined.
+    """
+    available = None
+    lines = _read_lines(executor, '/proc/meminfo')
+    if lines:
+        values = dict()
+        for line in lines:
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].isdigit():
+                values[fields[0].rstrip(':')] = int(fields[1]) * 1024
+        available = values.get('MemAvailable', values.get('MemFree', None))
+    limit = _get_cgroup_memory_limit(executor)
+    if limit is not None and (available is None or limit < available):
+        available = limit
+    return available
+
+def compute_build_jobs(cpus, memory, memory_per_job):
+    """Computes the number of parallel build jobs for a build.
+
+    Args:
+        cpus (int): Number of CPUs available to the build.
+        memory (int or None): Memory available to the build in bytes (None
+            if not known).
+        memory_per_job (int): Estimated peak memory use of a single
+            compilation job in bytes.
+
+    Returns:
+        int: Number of parallel jobs (at least one).
+    """
+    jobs = cpus
+    if memory is not None:
+        jobs = min(jobs, memory // memory_per_job)
+    return max(1, int(jobs))
@@ -0,0 +1,194 @@
+"""
+Historical matrix build results
+
+Every matrix configuration run processed by process_matrix_failures() is
+recorded in an SQLite database (given by the ``RELENG_HISTORY_DB``
+environment variable), with its options, host, result, and timing.  Jenkins
+discards old builds quickly, so this is the only long-term record of how
+long each configuration takes and how often it fails.  The data is used for
+ordering matrix configurations, and the query helpers here are also intended
+for capacity planning reports.
+
+Configurations are identified by the canonical key of their options (see
+options.get_canonical_key()), so that reordering or respelling the options in
+a matrix file does not lose the history.
+"""
+
+import json
+import sqlite3
+import time
+
+# Results that count as failures in the statistics.  Aborted and not built
+# runs are ignored, since they say nothing about the configuration.
+_FAILED_RESULTS = ('FAILURE', 'UNSTABLE')
+_COUNTED_RESULTS = ('SUCCESS',) + _FAILED_RESULTS
+
+def median(values):
+    """Returns the median of a list of numbers, or None if it is empty."""
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+class BuildHistory(object):
+    """Access to the database of matrix configuration runs.
+
+    Args:
+        path (str): Path to the SQLite database file (created if it does not
+            exist).
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=60)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS matrix_runs (
+                    id INTEGER PRIMARY KEY,
+                    config_key TEXT NOT NULL,
+                    opts TEXT NOT NULL,
+                    host TEXT,
+                    result TEXT NOT NULL,
+                    url TEXT UNIQUE,
+                    duration REAL,
+                    started REAL,
+                    finished REAL,
+                    recorded REAL NOT NULL)''')
+            self._conn.execute('''CREATE INDEX IF NOT EXISTS matrix_runs_by_config
+                    ON matrix_runs (config_key, started)''')
+            self._conn.execute('''CREATE INDEX IF NOT EXISTS matrix_runs_by_host
+                    ON matrix_runs (host, started)''')
+
+    def close(self):
+        self._conn.close()
+
+    def record_runs(self, runs, key):
+        """Records matrix configuration runs.
+
+        Runs without a URL (configurations that were not built) are skipped,
+        and a run with the same URL is only recorded once.
+
+        Args:
+            runs (List[MatrixRunInfo]): Runs to record.
+            key (function): Function that returns the canonical key for the
+                options of a run.
+        """
+        now = time.time()
+        with self._conn:
+            for run in runs:
+                if not run.url:
+                    continue
+                finished = None
+                if run.timestamp is not None and run.duration is not None:
+                    finished = run.timestamp + run.duration
+                self._conn.execute('''INSERT OR IGNORE INTO matrix_runs
+                        (config_key, opts, host, result, url, duration, started, finished, recorded)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                        (key(run.opts), json.dumps(run.opts), run.host, run.result,
+                            run.url, run.duration, run.timestamp, finished, now))
+
+    def _get_recent_results(self, config_key, limit):
+        """Returns results of the most recent runs, oldest first."""
+        rows = self._conn.execute('''SELECT result FROM matrix_runs
+                WHERE config_key = ? AND result IN (?, ?, ?)
+                ORDER BY started DESC, id DESC LIMIT ?''',
+                (config_key,) + _COUNTED_RESULTS + (limit,)).fetchall()
+        return [x[0] for x in reversed(rows)]
+
+    def get_run_count(self, config_key):
+        """Returns the number of recorded runs for a configuration."""
+        return self._conn.execute(
+                'SELECT COUNT(*) FROM matrix_runs WHERE config_key = ?',
+                (config_key,)).fetchone()[0]
+
+    def get_median_duration(self, config_key, host=None, limit=20):
+        """Returns the median duration of recent runs of a configuration.
+
+        Args:
+            config_key (str): Canonical key of the configuration.
+            host (Optional[str]): If given, only consider runs on this host.
+            limit (int): Number of most recent runs to consider.
+
+        Returns:
+            float or None: Median duration in seconds, or None if there are no
+                runs with a known duration.
+        """
+        query = 'SELECT duration FROM matrix_runs WHERE config_key = ? AND duration IS NOT NULL'
+        args = [config_key]
+        if host:
+            query += ' AND host = ?'
+            args.append(host)
+        query += ' ORDER BY started DESC, id DESC LIMIT ?'
+        args.append(limit)
+        rows = self._conn.execute(query, args).fetchall()
+        return median([x[0] for x in rows])
+
+    def get_failure_rate(self, config_key, limit=20):
+        """Returns the fraction of recent runs of a configuration that failed.
+
+        Unstable runs count as failures; aborted runs are ignored.
+
+        Returns:
+            float or None: Failure rate, or None if there are no runs.
+        """
+        results = self._get_recent_results(config_key, limit)
+        if not results:
+            return None
+        failures = len([x for x in results if x in _FAILED_RESULTS])
+        return float(failures) / len(results)
+
+    def get_flakiness(self, config_key, limit=20):
+        """Returns how often the result of a configuration flips.
+
+        This is the fraction of consecutive pairs of recent runs where one
+        succeeded and the other failed.  A configuration that always fails
+        (or always succeeds) has flakiness zero.
+
+        Returns:
+            float or None: Flakiness, or None if there are fewer than two runs.
+        """
+        results = self._get_recent_results(config_key, limit)
+        if len(results) < 2:
+            return None
+        flips = 0
+        for previous, current in zip(results[:-1], results[1:]):
+            if (previous in _FAILED_RESULTS) != (current in _FAILED_RESULTS):
+                flips += 1
+        return float(flips) / (len(results) - 1)
+
+    def get_host_statistics(self, since=None):
+        """Returns usage statistics for each host.
+
+        Args:
+            since (Optional[float]): If given, only runs started at or after
+                this time (in seconds since the epoch) are considered.
+
+        Returns:
+            Dict[str, Dict]: For each host, the number of runs (``runs``),
+                the total build time in seconds (``busy_time``), and the
+                number of failed runs (``failures``).
+        """
+        query = '''SELECT host, COUNT(*), TOTAL(duration),
+                SUM(CASE WHEN result IN (?, ?) THEN 1 ELSE 0 END)
+                FROM matrix_runs WHERE host IS NOT NULL'''
+        args = list(_FAILED_RESULTS)
+        if since is not None:
+            query += ' AND started >= ?'
+            args.append(since)
+        query += ' GROUP BY host'
+        result = dict()
+        for host, runs, busy_time, failures in self._conn.execute(query, args):
+            result[host] = { 'runs': runs, 'busy_time': busy_time, 'failures': failures }
+        return result
+
+def open_build_history(factory):
+    """Opens the build history database configured for the build.
+
+    Returns:
+        BuildHistory or None: The database, or None if none is configured.
+    """
+    path = factory.jenkins.history_path
+    if not path:
+        return None
+    return BuildHistory(path)
@@ -9,6 +9,7 @@ from __future__ import print_function
 
 import ast
 import base64
+from contextlib import contextmanager
 import json
 import os
 import re
@@ -17,6 +18,7 @@ import urllib
 
 from common import AbortError, BuildError, ConfigurationError
 from common import Project, System
+import failures
 import utils
 
 class RefSpec(object):
@@ -214,7 +216,8 @@ class ProjectInfo(object):
         self.refspec = refspec
         self.head_hash = None
         self.head_title = None
-        self.remote_hash = None
+        self._remote_hash = None
+        self._remote_hash_gerrit = None
         self.is_checked_out = False
         if refspec:
             self.set_branch(refspec.branch)
@@ -222,7 +225,19 @@ class ProjectInfo(object):
                 # TODO: Populate more useful information for print_project_info()
                 self.head_hash = refspec.checkout
                 self.head_title = 'From tarball'
-                self.remote_hash = refspec.checkout
+                self._remote_hash = refspec.checkout
+
+    @property
+    def remote_hash(self):
+        """SHA1 of the refspec at the remote repository.
+
+        For static refspecs of checked-out projects, querying this requires
+        a round trip to Gerrit, so it is only done when first accessed.
+        """
+        if self._remote_hash_gerrit is not None:
+            self._remote_hash = self._remote_hash_gerrit.get_remote_hash(self.project, self.refspec)
+            self._remote_hash_gerrit = None
+        return self._remote_hash
 
     def set_branch(self, branch):
         if self.branch is None:
@@ -240,9 +255,9 @@ class ProjectInfo(object):
             return
         self.head_title, self.head_hash = workspace._get_git_commit_info(self.project, 'HEAD')
         if self.refspec.is_static:
-            self.remote_hash = gerrit.get_remote_hash(self.project, self.refspec)
+            self._remote_hash_gerrit = gerrit
         else:
-            self.remote_hash = self.head_hash
+            self._remote_hash = self.head_hash
 
     def ensure_branch_loaded(self, gerrit):
         if not self.branch:
@@ -253,7 +268,7 @@ class ProjectInfo(object):
             return
         if not self.is_checked_out:
             self.head_hash = gerrit.get_remote_hash(self.project, self.refspec)
-            self.remote_hash = self.head_hash
+            self._remote_hash = self.head_hash
             self.head_title, dummy = workspace._get_git_commit_info(self.project, self.head_hash, allow_none=True)
         self._load_from_gerrit(gerrit)
 
@@ -460,6 +475,36 @@ class ProjectsManager(object):
             projects.append(info)
         return [project.to_dict() for project in projects]
 
+    def get_source_tree_hashes(self):
+        """Returns hashes that identify the source of each project in the build.
+
+        For checked-out projects, this is the git tree hash, which stays the
+        same if the commit is recreated with identical contents (e.g., when
+        only the commit message changes).  For other projects, the commit
+        hash is used.
+
+        Returns:
+            Dict[str, str]: Hash for each project in get_build_revisions().
+        """
+        result = dict()
+        for revision in self.get_build_revisions():
+            project = revision['project']
+            tree_hash = None
+            if self._projects[project].is_checked_out:
+                tree_hash = self._workspace.get_tree_hash(project)
+            result[project] = tree_hash or revision['hash']
+        return result
+
+    def get_projects_not_on_branch(self):
+        """Returns projects that are not built from the head of a branch.
+
+        These are the projects built from a Gerrit change (the triggering
+        change, or changes requested for cross-verification), from a tarball,
+        or from an explicitly specified commit.
+        """
+        return set([p.project for p in self._projects.itervalues()
+            if not p.refspec or not p.refspec.branch])
+
     def override_refspec(self, project, refspec):
         self._verify_project(project)
         self._projects[project].override_refspec(refspec)
@@ -501,13 +546,19 @@ class ParameterTypes(object):
 
 class MatrixRunInfo(object):
     """Information retrieved from Jenkins about a single matrix configuration
-    run results."""
+    run results.
 
-    def __init__(self, opts, host, result, url):
+    duration and timestamp (the start time) are in seconds, or None if not
+    known.
+    """
+
+    def __init__(self, opts, host, result, url, duration=None, timestamp=None):
         self.opts = opts
         self.host = host
         self.result = result
         self.url = url
+        self.duration = duration
+        self.timestamp = timestamp
 
     @property
     def is_success(self):
@@ -538,17 +589,40 @@ class MatrixBuildInfo(object):
         for run_data in json_runs_data:
             result = run_data['result']
             url = run_data['url']
+            # Jenkins reports times in milliseconds.
+            duration = run_data.get('duration', None)
+            if duration is not None:
+                duration = duration / 1000.0
+            timestamp = run_data.get('timestamp', None)
+            if timestamp is not None:
+                timestamp = timestamp / 1000.0
             options_parts = [x for x in url.split('/') if x.startswith("OPTIONS=")]
             assert len(options_parts) == 1
             opts = urllib.unquote(options_parts[0][8:]).split()
             host = opts[-1].split(',')[0][5:]
             opts = opts[:-1]
-            self.runs.append(MatrixRunInfo(opts, host, result, url))
+            self.runs.append(MatrixRunInfo(opts, host, result, url, duration, timestamp))
+
+    def merge_known_configs(self, configs, key=None):
+        """Matches the runs with the configurations that were requested.
+
+        After this, there is one run for each configuration, in the same
+        order, and configurations that have no run are marked as not built.
 
-    def merge_known_configs(self, configs):
+        Args:
+            configs (List[BuildConfig]): Requested configurations.
+            key (function): If given, runs and configurations are matched by
+                comparing the result of this function on the options,
+                instead of comparing the options directly.
+        """
+        if key is None:
+            key = lambda opts: opts
+        runs_by_key = dict()
+        for run in self.runs:
+            runs_by_key.setdefault(self._to_hashable(key(run.opts)), []).append(run)
         new_runs = []
         for config in configs:
-            found = [x for x in self.runs if x.opts == config.opts]
+            found = runs_by_key.get(self._to_hashable(key(config.opts)), [])
             if not found:
                 new_runs.append(MatrixRunInfo(config.opts, config.host, 'NOT_BUILT', None))
             else:
@@ -556,6 +630,28 @@ class MatrixBuildInfo(object):
                 new_runs.append(found[0])
         self.runs = new_runs
 
+    def replace_runs(self, other, key=None):
+        """Replaces runs with the runs of the same configurations in another build.
+
+        Used to take into account a build that retried some of the
+        configurations.
+
+        Args:
+            other (MatrixBuildInfo): Build whose runs take precedence.
+            key (function): Function for matching the options of the runs
+                (see merge_known_configs()).
+        """
+        if key is None:
+            key = lambda opts: opts
+        other_runs = dict([(self._to_hashable(key(x.opts)), x) for x in other.runs])
+        self.runs = [other_runs.get(self._to_hashable(key(x.opts)), x) for x in self.runs]
+
+    @staticmethod
+    def _to_hashable(value):
+        if isinstance(value, list):
+            return tuple(value)
+        return value
+
     @property
     def is_success(self):
         return self.result == 'SUCCESS'
@@ -573,6 +669,13 @@ class JenkinsIntegration(object):
         self.node_name = factory.env.get('NODE_NAME', None)
         if not self.node_name:
             self.node_name = 'unknown'
+        self.node_cache_dir = factory.env.get('RELENG_CACHE_DIR', None)
+        if not self.node_cache_dir:
+            self.node_cache_dir = os.path.expanduser('~/.cache/releng')
+        self.result_store_path = factory.env.get('RELENG_RESULT_STORE', None)
+        self.history_path = factory.env.get('RELENG_HISTORY_DB', None)
+        self.build_url = factory.env.get('BUILD_URL', None)
+        self.console_fetcher = failures.JenkinsConsoleFetcher()
         self.params = BuildParameters(factory)
 
     def query_matrix_build(self, url):
@@ -588,7 +691,7 @@ class JenkinsIntegration(object):
         run_urls = [x['url'] for x in data['runs'] if x['number'] == data['number']]
         runs_data = []
         for url in run_urls:
-            result = self._query_build(url, 'url,result')
+            result = self._query_build(url, 'url,result,duration,timestamp')
             runs_data.append(result)
         return MatrixBuildInfo(data['result'], runs_data)
 
@@ -597,6 +700,18 @@ class JenkinsIntegration(object):
         return ast.literal_eval(urllib.urlopen(query_url).read())
 
 
+class StatusSection(object):
+    """Status of a part of the build reported with StatusReporter.section().
+
+    Attributes:
+        name (str): Name of the section.
+        result (str): Result of the section after it has ended.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.result = None
+
 class StatusReporter(object):
     """Handles tracking and reporting of failures during the build.
 
@@ -617,6 +732,7 @@ class StatusReporter(object):
         self._unsuccessful_reason = []
         self.return_value = None
         self._tracebacks = tracebacks
+        self._section = None
 
     def __enter__(self):
         return self
@@ -652,6 +768,49 @@ class StatusReporter(object):
             self._executor.exit(returncode)
         return True
 
+    @contextmanager
+    def section(self, name):
+        """Reports status for a part of the build (e.g., one configuration).
+
+        Within the section, failure reasons are prefixed with the name of the
+        section, and ``failed`` only reflects failures within the section.
+        A BuildError or ConfigurationError raised within the section marks
+        the build failed, but does not propagate, so that the build can
+        continue with the next section.
+
+        Yields:
+            StatusSection: Object whose ``result`` is set to ``SUCCESS``,
+            ``UNSTABLE``, or ``FAILURE`` when the section ends.
+        """
+        assert self._section is None
+        section = StatusSection(name)
+        failed_before = self.failed
+        reasons_before = len(self._unsuccessful_reason)
+        self.failed = False
+        self._section = section
+        try:
+            yield section
+        except ConfigurationError as e:
+            traceback.print_exc(file=self._executor.console)
+            self.mark_failed('Jenkins configuration error: ' + str(e))
+        except BuildError as e:
+            traceback.print_exc(file=self._executor.console)
+            self.mark_failed(str(e))
+        finally:
+            self._section = None
+            if self.failed:
+                section.result = 'FAILURE'
+            elif len(self._unsuccessful_reason) > reasons_before:
+                section.result = 'UNSTABLE'
+            else:
+                section.result = 'SUCCESS'
+            self.failed = self.failed or failed_before
+
+    def _add_section_prefix(self, reason):
+        if self._section is None:
+            return reason
+        return '[{0}] {1}'.format(self._section.name, reason)
+
     def mark_failed(self, reason):
         """Marks the build failed.
 
@@ -659,7 +818,7 @@ class StatusReporter(object):
             reason (str): Reason printed to the build log for the failure.
         """
         self.failed = True
-        self._unsuccessful_reason.append(reason)
+        self._unsuccessful_reason.append(self._add_section_prefix(reason))
 
     def mark_unstable(self, reason, details=None):
         """Marks the build unstable.
@@ -671,9 +830,8 @@ class StatusReporter(object):
         """
         print('FAILED: ' + reason, file=self._executor.console)
         if details is None:
-            self._unsuccessful_reason.append(reason)
-        else:
-            self._unsuccessful_reason.extend(details)
+            details = [reason]
+        self._unsuccessful_reason.extend([self._add_section_prefix(x) for x in details])
 
     def _report_on_exception(self):
         console = self._executor.console
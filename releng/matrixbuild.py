@@ -4,71 +4,547 @@ Utilities for handling matrix builds
 See __init__.py for documentation (the functions are called essentially
 directly from there).
 """
+from __future__ import print_function
 
+import fnmatch
 import json
 import os.path
 import pipes
 import shlex
 
-from common import BuildError, ConfigurationError, Project
-from options import BuildConfig, select_build_hosts
+from common import BuildError, ConfigurationError, JobType, Project
+from options import BuildConfig, get_build_cost, get_build_labels, get_canonical_key
+from options import has_build_host, select_build_hosts
 import agents
+import covering
+import failures
+import history
+import resultstore
 
-def prepare_build_matrix(factory, configfile):
+# Name of the file in admin/builds/ that maps changed files to affected options.
+_IMPACT_MAP_FILE = 'matrix-impact'
+
+def prepare_build_matrix(factory, configfile, shards=1, job_type=JobType.GERRIT):
     projects = factory.projects
     projects.checkout_project(Project.GROMACS)
     projects.print_project_info()
     projects.check_projects()
-    return get_matrix_info(factory, configfile)
+    return get_matrix_info(factory, configfile, shards, job_type)
 
-def get_matrix_info(factory, configfile):
-    configs = _get_build_configs(factory, configfile)
-    return _create_return_value(configs)
+def get_matrix_info(factory, configfile, shards=1, job_type=JobType.GERRIT,
+        prune_unaffected=True):
+    JobType.validate(job_type)
+    configs, removed = _get_build_configs(factory, configfile, job_type,
+            prune_unaffected)
+    result = _create_return_value(configs)
+    for key, value in removed.iteritems():
+        if value:
+            result[key] = value
+    if shards > 1:
+        result['shards'] = [_create_return_value(x)
+                for x in _split_into_shards(factory, configs, shards)]
+    return result
 
 def process_matrix_results(factory, inputfile):
     data = json.loads(''.join(factory.executor.read_file(inputfile)))
-    configs = data['matrix']['configs']
-    build_url = data['build_url']
-    return process_matrix_failures(factory, configs, build_url)
+    matrix = data['matrix']
+    verified = matrix.get('verified', None)
+    retry_info = _query_retry_build(factory, data.get('retry_build_url', None))
+    if 'build_urls' not in data:
+        return _process_matrix_failures(factory, matrix['configs'], data['build_url'],
+                verified, retry_info)
+    shards = matrix.get('shards', [])
+    build_urls = data['build_urls']
+    if len(shards) != len(build_urls):
+        raise ConfigurationError('expected {0} matrix builds (one per shard), got {1}'.format(
+            len(shards), len(build_urls)))
+    runs = []
+    for shard, build_url in zip(shards, build_urls):
+        runs.extend(_process_matrix_failures(factory, shard['configs'], build_url,
+            None, retry_info))
+    runs.extend(_get_verified_runs(verified))
+    return runs
+
+def process_matrix_failures(factory, configs, build_url, verified=None, retry_build_url=None):
+    retry_info = _query_retry_build(factory, retry_build_url)
+    return _process_matrix_failures(factory, configs, build_url, verified, retry_info)
+
+def _query_retry_build(factory, retry_build_url):
+    """Queries the build that retried configurations with infrastructure failures.
+
+    The retry build can contain configurations from several shards, so it is
+    queried (and its runs recorded in the history) only once.
+    """
+    if not retry_build_url:
+        return None
+    retry_info = factory.jenkins.query_matrix_build(retry_build_url)
+    _record_run_history(factory, retry_info.runs)
+    return retry_info
 
-def process_matrix_failures(factory, configs, build_url):
+def _process_matrix_failures(factory, configs, build_url, verified, retry_info):
     status = factory.status_reporter
     configs = [BuildConfig.from_dict(x) for x in configs]
     build_info = factory.jenkins.query_matrix_build(build_url)
-    build_info.merge_known_configs(configs)
-    for run in build_info.runs:
+    build_info.merge_known_configs(configs, key=get_canonical_key)
+    _record_run_history(factory, build_info.runs)
+    if retry_info:
+        build_info.replace_runs(retry_info, key=get_canonical_key)
+    _record_verified_results(factory, configs, build_info.runs)
+    runs = []
+    retries = []
+    for config, run in zip(configs, build_info.runs):
+        run_info = run.to_dict()
+        runs.append(run_info)
         if run.is_success:
             continue
         reason = '{0} ({1}): {2}'.format(' '.join(run.opts), run.host, run.result)
+        if not build_info.is_aborted:
+            failure_class, failure_reason = _classify_failure(factory, run)
+            run_info['failure_class'] = failure_class
+            if failure_class == failures.FailureClass.INFRASTRUCTURE:
+                reason += ' (infrastructure failure: {0})'.format(failure_reason)
+                run_info['failure_reason'] = failure_reason
+                retries.append((config, run.host or config.host, run_info))
         if run.is_unstable:
             status.mark_unstable(reason)
         else:
             status.mark_failed(reason)
+    for (config, failed_host, run_info), host in zip(retries, _assign_retry_hosts(retries)):
+        if host is None:
+            print('Not retrying "{0}": no other agent can build it'.format(
+                ' '.join(config.opts)), file=factory.executor.console)
+            continue
+        run_info['retry_axis'] = _get_options_string([BuildConfig(config.opts, host)])
     if not build_info.is_aborted and any([x.is_not_built for x in build_info.runs]):
         status.mark_failed("Some matrix configurations were not built (likely matrix axis is missing build agents)")
-    return [x.to_dict() for x in build_info.runs]
+    runs.extend(_get_verified_runs(verified))
+    return runs
+
+def _assign_retry_hosts(retries):
+    """Selects hosts for retrying configurations with infrastructure failures.
+
+    The configurations are retried on other agents than where they failed,
+    since an agent that was lost or broke the build is likely to do so again.
+
+    Args:
+        retries (List[Tuple[BuildConfig, str, Dict]]): Configuration to
+            retry, the host where it failed, and its run info.
 
-def _get_build_configs(factory, configfile):
+    Returns:
+        List[str]: Host for each configuration, or None if no other agent can
+            build it.
+    """
+    requests = [(set(get_build_labels(config.opts)), get_build_cost(config.opts))
+            for config, host, dummy in retries]
+    excluded = [set([host]) for config, host, dummy in retries]
+    return agents.assign_hosts(requests, excluded)
+
+# Number of lines from the end of the console log used for classifying failures.
+_CONSOLE_TAIL_LINES = 200
+
+def _classify_failure(factory, run):
+    """Classifies an unsuccessful run as an infrastructure or build failure."""
+    log_tail = None
+    if run.url and not run.is_not_built:
+        log_tail = factory.jenkins.console_fetcher.get_console_tail(run.url, _CONSOLE_TAIL_LINES)
+    return failures.classify_failure(run.result, log_tail)
+
+def _get_verified_runs(verified):
+    """Returns runs to report for configurations skipped as verified."""
+    if not verified:
+        return []
+    return [dict(x, host=None) for x in verified]
+
+def _get_build_configs(factory, configfile, job_type, prune_unaffected=True):
     executor = factory.executor
     workspace = factory.workspace
     inputpath = workspace._resolve_build_input_file(configfile, '.txt')
     configs = _read_matrix_configs(executor, inputpath)
+    removed = dict()
+    configs, removed['merged'] = _remove_duplicate_configs(executor, configs)
+    removed['pruned'] = []
+    if prune_unaffected:
+        configs, removed['pruned'] = _prune_unaffected_configs(factory, configs, job_type)
+    # The result keys depend on the hosts, so these are selected first.
     configs = select_build_hosts(factory, configs)
+    matrix_name = os.path.splitext(os.path.basename(configfile))[0]
+    configs, removed['verified'] = _skip_verified_configs(factory, configs,
+            job_type, matrix_name)
     _check_matrix_configs(configs)
-    return configs
+    configs = _order_configs(factory, configs)
+    return configs, removed
+
+def _split_into_shards(factory, configs, count):
+    """Splits configurations into shards with similar estimated duration.
+
+    The configurations are assigned, longest first, to the shard with the
+    least total duration so far.  Within each shard, the configurations stay
+    in the order of the input.
+
+    Returns:
+        List[List[BuildConfig]]: Configurations in each shard; empty shards
+            are not returned.
+    """
+    risks, durations = _estimate_risks_and_durations(factory, configs)
+    totals = [0.0] * count
+    assignment = dict()
+    for index in sorted(range(len(configs)), key=lambda x: -durations[x]):
+        shard = min(range(count), key=lambda x: (totals[x], x))
+        totals[shard] += durations[index]
+        assignment[index] = shard
+    shards = [[] for dummy in range(count)]
+    for index, config in enumerate(configs):
+        shards[assignment[index]].append(config)
+    return [x for x in shards if x]
+
+# Assumed failure probability for configurations without history.
+_NEW_CONFIG_FAILURE_RATE = 0.5
+
+def _order_configs(factory, configs):
+    """Orders configurations such that Jenkins starts the riskiest first.
+
+    Configurations are sorted by their recent failure rate (rounded to
+    tenths, so that small differences do not matter), and then by the
+    expected duration, both in decreasing order.  This gets the first
+    failures reported early, and starting long builds first reduces the
+    total time of the matrix build.
+
+    The failure rates and durations come from the build history database.
+    Configurations not found there are assumed to be risky, and their
+    duration is estimated from the build cost of the options.  Without the
+    database, the configurations are only sorted by the build cost.
+    """
+    risks, durations = _estimate_risks_and_durations(factory, configs)
+    order = sorted(range(len(configs)), key=lambda x: (-risks[x], -durations[x]))
+    return [configs[x] for x in order]
+
+def _estimate_risks_and_durations(factory, configs):
+    """Estimates the failure risk and duration of each configuration.
+
+    Returns:
+        Tuple[List[float], List[float]]: Failure rate (rounded to tenths) and
+            expected duration of each configuration.  Without the history
+            database, the risks are zero and the durations are relative
+            costs.
+    """
+    build_history = history.open_build_history(factory)
+    keys = [get_canonical_key(config.opts) for config in configs]
+    costs = [get_build_cost(config.opts) for config in configs]
+    risks = [0.0] * len(configs)
+    durations = list(costs)
+    if build_history is not None:
+        try:
+            for index, config in enumerate(configs):
+                rate = build_history.get_failure_rate(keys[index])
+                if rate is None:
+                    rate = _NEW_CONFIG_FAILURE_RATE
+                risks[index] = round(rate, 1)
+                durations[index] = build_history.get_median_duration(keys[index], host=config.host)
+                if durations[index] is None:
+                    durations[index] = build_history.get_median_duration(keys[index])
+        finally:
+            build_history.close()
+        # Scale the cost estimates to the typical duration of a unit-cost build.
+        known = [duration / cost for duration, cost in zip(durations, costs) if duration is not None]
+        scale = history.median(known) if known else 1.0
+        durations = [cost * scale if duration is None else duration
+                for duration, cost in zip(durations, costs)]
+    return risks, durations
+
+def _record_run_history(factory, runs):
+    """Records the matrix runs in the build history database."""
+    build_history = history.open_build_history(factory)
+    if build_history is None:
+        return
+    try:
+        build_history.record_runs(runs, key=get_canonical_key)
+    finally:
+        build_history.close()
+
+def _skip_verified_configs(factory, configs, job_type, matrix_name):
+    """Removes configurations that have been verified for identical sources.
+
+    Only results from builds of the same matrix with the same job type, on
+    the same host with the same toolchain, are used.  Configurations whose
+    host has no recorded toolchain fingerprint are always built.
+
+    If a result store is configured, the result key is set for each
+    configuration, so that the result can be recorded after the build.
+    At least one configuration is always kept, so that the matrix build
+    has something to build.
+
+    Returns:
+        Tuple[List[BuildConfig], List[Dict]]: Remaining configurations, and
+            for each removed one, its options and the earlier result.
+    """
+    store = resultstore.open_result_store(factory)
+    if store is None:
+        return configs, []
+    try:
+        tree_hashes = factory.projects.get_source_tree_hashes()
+        result = []
+        verified = []
+        for config in configs:
+            labels = get_build_labels(config.opts)
+            toolchain = store.get_toolchain(config.host, labels)
+            config.result_key = resultstore.compute_result_key(tree_hashes,
+                    get_canonical_key(config.opts), labels, config.host, toolchain,
+                    job_type, matrix_name)
+            earlier = None
+            if toolchain is not None:
+                earlier = store.find(config.result_key)
+            if earlier is None:
+                result.append(config)
+            else:
+                verified.append((config, earlier))
+    finally:
+        store.close()
+    if verified and not result:
+        result.append(verified.pop(0)[0])
+    for config, earlier in verified:
+        print('Configuration "{0}" already verified for identical sources: {1}'.format(
+            ' '.join(config.opts), earlier.url), file=factory.executor.console)
+    return result, [_get_verified_info(config, earlier) for config, earlier in verified]
+
+def _get_verified_info(config, earlier):
+    info = earlier.to_dict()
+    info['opts'] = config.opts
+    return info
+
+def _record_verified_results(factory, configs, runs):
+    """Records successful results of configurations in the result store."""
+    store = resultstore.open_result_store(factory)
+    if store is None:
+        return
+    try:
+        for config, run in zip(configs, runs):
+            if config.result_key and run.is_success:
+                store.record(config.result_key, config.opts, run.result, run.url)
+    finally:
+        store.close()
+
+def _remove_duplicate_configs(executor, configs):
+    """Removes configurations that are equivalent to an earlier one.
+
+    Returns:
+        Tuple[List[BuildConfig], List[Dict]]: Remaining configurations, and
+            for each removed one, its options and the options of the
+            configuration it was merged into.
+    """
+    result = []
+    merged = []
+    seen = dict()
+    for config in configs:
+        key = get_canonical_key(config.opts)
+        if key in seen:
+            into = seen[key]
+            print('Merged duplicate configuration "{0}" into "{1}"'.format(
+                ' '.join(config.opts), ' '.join(into.opts)), file=executor.console)
+            merged.append({ 'opts': config.opts, 'merged_into': into.opts })
+            continue
+        seen[key] = config
+        result.append(config)
+    return result, merged
+
+def _get_triggering_changed_files(factory, job_type):
+    """Returns files changed by the gromacs change that triggered the build.
+
+    Returns None if the build is not a pre-submit verification of a single
+    gromacs change: for other job types, and if any other project is built
+    from a change (e.g., for cross-verification), since the impact map only
+    knows about gromacs files.
+    """
+    if job_type != JobType.GERRIT:
+        return None
+    gerrit = factory.gerrit
+    if gerrit.get_triggering_project() != Project.GROMACS:
+        return None
+    if not gerrit.get_triggering_refspec().is_static:
+        return None
+    if factory.projects.get_projects_not_on_branch() - set([Project.GROMACS]):
+        return None
+    return factory.workspace.get_changed_files(Project.GROMACS)
+
+def _prune_unaffected_configs(factory, configs, job_type):
+    """Removes configurations that the triggering change cannot affect.
+
+    The impact map is read from :file:`admin/builds/matrix-impact.txt`; if it
+    does not exist or the build is not a pre-submit verification of a gromacs
+    change (see _get_triggering_changed_files()), nothing is pruned.
+    At least one configuration is always kept, so that every change gets
+    built.
+
+    Returns:
+        Tuple[List[BuildConfig], List[Dict]]: Remaining configurations, and
+            the options of each removed one.
+    """
+    changed_files = _get_triggering_changed_files(factory, job_type)
+    if changed_files is None:
+        return configs, []
+    executor = factory.executor
+    path = factory.workspace._resolve_build_input_file(_IMPACT_MAP_FILE, '.txt')
+    try:
+        impact_map = _ImpactMap.read(executor, path)
+    except IOError:
+        return configs, []
+    patterns = impact_map.get_affected_options(changed_files)
+    if patterns is None:
+        return configs, []
+    result = []
+    pruned = []
+    for config in configs:
+        if any([covering.matches_option(config.opts, x) for x in patterns]):
+            result.append(config)
+        else:
+            pruned.append(config)
+    if pruned and not result:
+        result.append(pruned.pop(0))
+    for config in pruned:
+        print('Pruned configuration "{0}": not affected by the changed files'.format(
+            ' '.join(config.opts)), file=executor.console)
+    print('Change affects {0} of {1} configurations ({2} changed files)'.format(
+        len(result), len(configs), len(changed_files)), file=executor.console)
+    return result, [{ 'opts': x.opts } for x in pruned]
+
+class _ImpactMap(object):
+    """Mapping from changed source files to affected build options.
+
+    Each line of the file has the format::
+
+        PATH_PATTERN: OPTION_PATTERN...
+
+    where the patterns are shell-style wildcard patterns, and ``-`` as the
+    only option pattern means that the files affect no configuration.  The
+    first rule that matches a file applies to it.  A file that matches no
+    rule can affect any configuration.
+    """
+
+    @staticmethod
+    def read(executor, path):
+        rules = []
+        for line in executor.read_file(path):
+            comment_start = line.find('#')
+            if comment_start >= 0:
+                line = line[:comment_start]
+            line = line.strip()
+            if not line:
+                continue
+            if ':' not in line:
+                raise ConfigurationError('invalid matrix impact rule: ' + line)
+            pattern, options = line.split(':', 1)
+            options = shlex.split(options)
+            if not options:
+                raise ConfigurationError('matrix impact rule has no options: ' + line)
+            if options == ['-']:
+                options = []
+            rules.append((pattern.strip(), options))
+        return _ImpactMap(rules)
+
+    def __init__(self, rules):
+        self._rules = rules
+
+    def get_affected_options(self, paths):
+        """Returns option patterns for configurations affected by the files.
+
+        Returns:
+            Set[str] or None: Patterns that match options in the affected
+                configurations, or None if all configurations can be affected.
+        """
+        result = set()
+        for path in paths:
+            for pattern, options in self._rules:
+                if fnmatch.fnmatchcase(path, pattern):
+                    result.update(options)
+                    break
+            else:
+                return None
+        return result
 
 def _read_matrix_configs(executor, path):
     configs = []
+    generator = _CoveringArraySpec()
     for line in executor.read_file(path):
         comment_start = line.find('#')
         if comment_start >= 0:
             line = line[:comment_start]
         line = line.strip()
-        if line:
+        if line.startswith('%'):
+            generator.add_directive(line[1:])
+        elif line:
             opts = shlex.split(line)
             configs.append(BuildConfig(opts))
+    if generator.has_axes():
+        generated = generator.generate()
+        print('Generated {0} configurations covering all {1}-way combinations of {2} axes'.format(
+            len(generated), generator.strength, generator.axis_count), file=executor.console)
+        configs.extend([BuildConfig(opts) for opts in generated])
     return configs
 
+class _CoveringArraySpec(object):
+    """Axes and constraints declared with directives in a matrix file.
+
+    The supported directives are::
+
+        %axis NAME: VALUE...
+        %require PATTERN: PATTERN...
+        %exclude PATTERN...
+        %strength N
+
+    Each axis value is a set of options joined with ``+``, or ``-`` for no
+    options.  Patterns are shell-style wildcard patterns matched against the
+    options in a configuration.
+    """
+
+    def __init__(self):
+        self._axes = []
+        self._constraints = []
+        self.strength = 2
+
+    @property
+    def axis_count(self):
+        return len(self._axes)
+
+    def has_axes(self):
+        return bool(self._axes)
+
+    def add_directive(self, line):
+        parts = line.split(None, 1)
+        directive = parts[0] if parts else ''
+        args = parts[1] if len(parts) > 1 else ''
+        if directive == 'axis':
+            name, values = self._split_colon(line, args)
+            values = [tuple(x.split('+')) if x != '-' else tuple() for x in values]
+            if not values:
+                raise ConfigurationError('matrix axis has no values: ' + line)
+            self._axes.append(covering.Axis(name, values))
+        elif directive == 'require':
+            pattern, required = self._split_colon(line, args)
+            if not required:
+                raise ConfigurationError('matrix constraint has no required options: ' + line)
+            self._constraints.append(covering.RequireConstraint(pattern, required))
+        elif directive == 'exclude':
+            patterns = shlex.split(args)
+            if not patterns:
+                raise ConfigurationError('matrix constraint has no options: ' + line)
+            self._constraints.append(covering.ExcludeConstraint(patterns))
+        elif directive == 'strength':
+            try:
+                self.strength = int(args)
+            except ValueError:
+                raise ConfigurationError('invalid matrix directive: ' + line)
+        else:
+            raise ConfigurationError('unknown matrix directive: ' + line)
+
+    def _split_colon(self, line, args):
+        if ':' not in args:
+            raise ConfigurationError('invalid matrix directive: ' + line)
+        name, values = args.split(':', 1)
+        return name.strip(), shlex.split(values)
+
+    def generate(self):
+        return covering.generate_covering_array(self._axes, self._constraints,
+                self.strength, is_valid=has_build_host)
+
 def _check_matrix_configs(configs):
     for config in configs:
         if config.host and not agents.is_matrix_host(config.host):
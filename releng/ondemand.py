@@ -193,7 +193,9 @@ class RequestParser(object):
             build_type = build['type']
             if build_type == 'matrix':
                 self._projects.checkout_project(Project.GROMACS)
-                matrix = get_matrix_info(self._factory, build['matrix-file'])
+                # Explicitly requested matrices are built in full.
+                matrix = get_matrix_info(self._factory, build['matrix-file'],
+                        prune_unaffected=False)
                 del build['matrix-file']
                 build['matrix'] = matrix
             elif build_type in ('regtest-package', 'update-regtest-hash'):
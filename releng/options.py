@@ -13,7 +13,6 @@ import shlex
 from common import to_python_identifier
 from common import ConfigurationError
 from common import BuildType, FftLibrary, Simd, Gpuhw
-from environment import BuildEnvironment
 import agents
 
 class BuildConfig(object):
@@ -21,17 +20,23 @@ class BuildConfig(object):
         self.opts = opts
         self.host = host
         self.labels = None
+        self.result_key = None
 
     def to_dict(self):
-        return {
+        result = {
                 'opts': self.opts,
                 'host': self.host,
                 'labels': ' && '.join(sorted(self.labels))
             }
+        if self.result_key:
+            result['result_key'] = self.result_key
+        return result
 
     @staticmethod
     def from_dict(data):
-        return BuildConfig(data['opts'], data['host'])
+        config = BuildConfig(data['opts'], data['host'])
+        config.result_key = data.get('result_key', None)
+        return config
 
 
 class BuildOptions(object):
@@ -220,6 +225,18 @@ class _BuildOptionHandler(object):
         """
         return self._label(opt, value)
 
+    def canonical(self, opt, value):
+        """Returns a canonical string for the option.
+
+        Options that have the same effect (e.g., ``no-mpi`` and ``mpi=off``)
+        have the same canonical string.
+
+        Args:
+            opt (str): Original option string.
+            value (variable): Value of the option returned by parse().
+        """
+        return '{0}={1}'.format(self.name, value)
+
 class _SimpleOptionHandler(_BuildOptionHandler):
     """Handler for a simple flag option.
 
@@ -239,6 +256,9 @@ class _SimpleOptionHandler(_BuildOptionHandler):
     def handle(self, value):
         self._handler()
 
+    def canonical(self, opt, value):
+        return self.name
+
 class _StringOptionHandler(_BuildOptionHandler):
     """Handler for an option with syntax 'opt=VALUE'.
 
@@ -263,6 +283,18 @@ class _IntOptionHandler(_BuildOptionHandler):
     def parse(self, opt):
         return int(opt[len(self.name)+1:])
 
+class _BuildJobsOptionHandler(_IntOptionHandler):
+    """Handler for an option with syntax 'opt=VALUE' or 'opt=auto'.
+
+    The value of the option will be VALUE (an integer), or ``'auto'``.
+    """
+
+    def parse(self, opt):
+        value = opt[len(self.name)+1:]
+        if value == 'auto':
+            return value
+        return int(value)
+
 class _EnumOptionHandler(_BuildOptionHandler):
     """Handler for an option with syntax 'opt=VALUE' with enumerated values.
 
@@ -291,6 +323,9 @@ class _VersionOptionHandler(_BuildOptionHandler):
     def parse(self, opt):
         return opt[len(self.name)+1:]
 
+    def canonical(self, opt, value):
+        return '{0}-{1}'.format(self.name, value)
+
 class _BoolOptionHandler(_BuildOptionHandler):
     """Handler for an option with syntax '[no-]opt[=on/off]'.
 
@@ -319,6 +354,9 @@ class _BoolOptionHandler(_BuildOptionHandler):
             return None
         return self._label(opt, value)
 
+    def canonical(self, opt, value):
+        return '{0}={1}'.format(self.name, 'on' if value else 'off')
+
 def simd_label(opt, value):
     """Determines the host label needed for selected SIMD option."""
     if value in (Simd.NONE, Simd.REFERENCE):
@@ -331,6 +369,27 @@ def gpuhw_label(opt, value):
         return None
     return str(value).lower()
 
+class _LabelOnlyEnvironment(object):
+    """Stand-in for BuildEnvironment when options are only needed for labels.
+
+    Host selection only parses the options to determine the required labels,
+    so there is no need to pay for initializing a full BuildEnvironment (which
+    may, e.g., run commands to import a toolchain environment).  All handler
+    callbacks (the ``_init_*``, ``_set_*``, and ``_enable_*`` methods of
+    BuildEnvironment) only ignore the values (the handlers store them in
+    BuildOptions), so new handlers do not need changes here.
+    """
+
+    _HANDLER_PREFIXES = ('_init_', '_set_', '_enable_')
+
+    def __getattr__(self, name):
+        if name.startswith(self._HANDLER_PREFIXES):
+            return _ignore_option_value
+        raise AttributeError(name)
+
+def _ignore_option_value(*args):
+    pass
+
 def _define_handlers(e, extra_options):
     """Defines the list of recognized build options."""
     # The options are processed in the order they are in the tuple, to support
@@ -344,9 +403,15 @@ def _define_handlers(e, extra_options):
     # Labels need to be specified for options that require specific features
     # from the build host (e.g., required software versions or special
     # hardware support).  They need to match with the labels defined in
-    # agents.py.
+    # agents.json.
     handlers = [
-            _IntOptionHandler('build-jobs', e._set_build_jobs),
+            _BuildJobsOptionHandler('build-jobs', e._set_build_jobs),
+            _BuildJobsOptionHandler('test-jobs', e._set_test_jobs),
+            _StringOptionHandler('test-shard', e._set_test_shard),
+            _StringOptionHandler('test-selection', e._set_test_selection),
+            _SimpleOptionHandler('adaptive-jobs', e._enable_adaptive_build_jobs),
+            _SimpleOptionHandler('cpu-partition', e._enable_cpu_partition),
+            _SimpleOptionHandler('memory-governor', e._enable_memory_governor),
             _SimpleOptionHandler('out-of-source'),
             _VersionOptionHandler('cmake', e._init_cmake, label=OPT),
             _VersionOptionHandler('gcc', e._init_gcc, label=OPT),
@@ -364,7 +429,7 @@ def _define_handlers(e, extra_options):
             _VersionOptionHandler('clFFT', e._init_clFFT, label=OPT),
             _VersionOptionHandler('armhpc', e._init_armhpc, label=OPT),
             _SimpleOptionHandler('phi', e._init_phi, label=OPT),
-            _SimpleOptionHandler('tsan', label=OPT),
+            _SimpleOptionHandler('tsan', e._init_tsan, label=OPT),
             _SimpleOptionHandler('atlas', e._init_atlas),
             _SimpleOptionHandler('x11', label=OPT),
             _EnumOptionHandler('simd', Simd, label=simd_label),
@@ -414,6 +479,7 @@ def process_build_options(factory, opts, script_settings):
         Tuple[BuildEnvironment, BuildParameters, BuildOptions]: Build
             environment and options initialized from the options.
     """
+    from environment import BuildEnvironment
     e = BuildEnvironment(factory)
     handlers = _define_handlers(e, script_settings.extra_options)
     if script_settings.build_opts:
@@ -430,9 +496,105 @@ def _remove_host_option(opts):
     """Removes options that specify the execution host."""
     return list(filter(lambda x: not x.lower().startswith(('host=', 'label=')), opts))
 
+# Relative cost of building a configuration with a given option, compared to
+# a plain build.  Used to balance the matrix configurations between the build
+# agents; the values only need to be roughly right.
+_BUILD_COST_FACTORS = {
+        'clang-static-analyzer': 3.0,
+        'cuda': 1.5,
+        'icc': 1.3,
+        'msvc': 1.5,
+        'phi': 1.5,
+        'tsan': 2.0
+    }
+
+def _get_labels_and_cost(handlers, opts):
+    """Returns the required host labels and relative cost for options."""
+    labels = set()
+    cost = 1.0
+    for handler in handlers:
+        found_opts = [x for x in opts if handler.matches(x)]
+        for found_opt in found_opts:
+            value = handler.parse(found_opt)
+            label = handler.label(found_opt, value)
+            if label:
+                labels.add(label)
+            cost *= _BUILD_COST_FACTORS.get(handler.name, 1.0)
+    return labels, cost
+
+# Only word spellings are mapped: script-declared options can be numeric,
+# and, e.g., ``ranks=1`` is not the same as ``ranks``.
+_BOOL_OPTION_VALUES = {
+        'on': 'on', 'true': 'on', 'yes': 'on',
+        'off': 'off', 'false': 'off', 'no': 'off'
+    }
+
+def _get_unknown_canonical(opt):
+    """Returns canonical form for an option not known to releng.
+
+    Such options are declared in the build scripts, which are not available
+    where this is used.  The common boolean spellings are still recognized,
+    so that ``no-double`` and ``double=off`` (or ``double`` and
+    ``double=on``) are equivalent.
+    """
+    if opt.startswith('no-') and '=' not in opt:
+        return opt[3:] + '=off'
+    if '=' in opt:
+        name, value = opt.split('=', 1)
+        value = _BOOL_OPTION_VALUES.get(value.lower(), None)
+        if value == 'off':
+            return name + '=off'
+        if value == 'on':
+            return name
+    return opt
+
+def get_canonical_key(opts):
+    """Returns a key that is the same for equivalent sets of options.
+
+    The key is independent of the order of the options and of ``host=`` and
+    ``label=`` options, and options that are parsed to the same value (like
+    ``no-mpi`` and ``mpi=off``) produce the same key.
+
+    Args:
+        opts (List[str]): Build options.
+
+    Returns:
+        str: Canonical key for the options.
+    """
+    handlers = _define_handlers(_LabelOnlyEnvironment(), None)
+    parts = set()
+    for opt in _remove_host_option(opts):
+        handler = next((x for x in handlers if x.matches(opt)), None)
+        if handler is None:
+            parts.add(_get_unknown_canonical(opt))
+        else:
+            parts.add(handler.canonical(opt, handler.parse(opt)))
+    return ' '.join(sorted(parts))
+
+def get_build_labels(opts):
+    """Returns the agent labels required to build with the given options."""
+    handlers = _define_handlers(_LabelOnlyEnvironment(), None)
+    labels, cost = _get_labels_and_cost(handlers, _remove_host_option(opts))
+    return sorted(labels)
+
+def get_build_cost(opts):
+    """Returns the estimated relative cost of building with the given options."""
+    handlers = _define_handlers(_LabelOnlyEnvironment(), None)
+    labels, cost = _get_labels_and_cost(handlers, _remove_host_option(opts))
+    return cost
+
+def has_build_host(opts):
+    """Checks whether any build agent can build with the given options."""
+    handlers = _define_handlers(_LabelOnlyEnvironment(), None)
+    labels, cost = _get_labels_and_cost(handlers, _remove_host_option(opts))
+    return bool(agents.get_possible_hosts(labels))
+
 def select_build_hosts(factory, configs):
     """Selects build host for each configuration.
 
+    The hosts are selected for all the configurations together, such that
+    the builds get distributed between the agents that can build them.
+
     Args:
         factory (ContextFactory): Factory to access other objects.
         List[MatrixConfig]: List of build options for each configuration.
@@ -441,24 +603,17 @@ def select_build_hosts(factory, configs):
         List[MatrixConfig]: The input configurations with ``host=`` or ``label=``
             option added/replaced.
     """
-    e = BuildEnvironment(factory)
-    handlers = _define_handlers(e, None)
-    result = []
+    handlers = _define_handlers(_LabelOnlyEnvironment(), None)
+    requests = []
     for config in configs:
         config.opts = _remove_host_option(config.opts)
-        opts = config.opts
-        labels = set()
-        for handler in handlers:
-            found_opts = [x for x in opts if handler.matches(x)]
-            for found_opt in found_opts:
-                value = handler.parse(found_opt)
-                label = handler.label(found_opt, value)
-                if label:
-                    labels.add(label)
+        labels, cost = _get_labels_and_cost(handlers, config.opts)
         config.labels = list(labels)
-        config.host = agents.pick_host(labels, config.opts)
+        requests.append((labels, cost))
+    hosts = agents.assign_hosts(requests)
+    for config, host in zip(configs, hosts):
+        config.host = host
         if not config.host:
-            reason = 'no build agent supports this combination: ' + ' '.join(opts)
+            reason = 'no build agent supports this combination: ' + ' '.join(config.opts)
             factory.status_reporter.mark_failed(reason)
-        result.append(config)
-    return result
+    return list(configs)
@@ -0,0 +1,151 @@
+"""
+Optional profiling of the releng Python code
+
+If the ``RELENG_PROFILE`` environment variable is set, the entry points run
+their work under a profiler, and write the results into the log directory
+after the work is done (also if it fails):
+
+ - :file:`logs/profile-{name}.pstats` contains cProfile statistics that can be
+   inspected with the pstats module or, e.g., snakeviz.
+ - :file:`logs/profile-{name}.collapsed.txt` contains sampled stacks of the
+   main thread in the collapsed format used by flame graph tools.
+
+With ``RELENG_PROFILE=wall``, both report wall-clock time, which includes time
+spent waiting for external commands.  With ``RELENG_PROFILE=cpu``, only CPU
+time used by the Python process itself is reported.
+"""
+from __future__ import print_function
+
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+import traceback
+
+from common import Enum
+
+ProfileMode = Enum.create('ProfileMode',
+    'cpu', 'wall',
+    doc="""Enum to identify what time is measured when profiling""")
+
+def _get_cpu_timer():
+    if hasattr(time, 'process_time'):
+        return time.process_time
+    if sys.platform != 'win32':
+        # On Unix, time.clock() returns the processor time.
+        return time.clock
+    def cpu_time():
+        times = os.times()
+        return times[0] + times[1]
+    return cpu_time
+
+class _StackSampler(object):
+    """Periodically samples the stack of a thread from a background thread.
+
+    In CPU mode, each sample is weighted by the processor time used since the
+    previous sample (in microseconds), so that time spent waiting for child
+    processes does not show up.  In wall-clock mode, each sample has weight
+    one.
+    """
+
+    def __init__(self, mode, interval=0.005):
+        self._thread_id = threading.current_thread().ident
+        self._interval = interval
+        self._cpu_timer = None
+        if mode == ProfileMode.CPU:
+            self._cpu_timer = _get_cpu_timer()
+        self._stacks = dict()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='releng-profiler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        last_cpu = self._cpu_timer() if self._cpu_timer else None
+        while not self._stop.wait(self._interval):
+            weight = 1
+            if self._cpu_timer:
+                cpu = self._cpu_timer()
+                weight = int(round((cpu - last_cpu) * 1e6))
+                last_cpu = cpu
+                if weight <= 0:
+                    continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{0} ({1}:{2})'.format(code.co_name,
+                    os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self._stacks[key] = self._stacks.get(key, 0) + weight
+
+    def get_collapsed_stacks(self):
+        """Returns the samples in the collapsed stack format."""
+        return ''.join(['{0} {1}\n'.format(stack, count)
+            for stack, count in sorted(self._stacks.iteritems())])
+
+class _Profiler(object):
+    def __init__(self, mode):
+        import cProfile
+        if mode == ProfileMode.CPU:
+            self._profile = cProfile.Profile(_get_cpu_timer())
+        else:
+            self._profile = cProfile.Profile()
+        self._sampler = _StackSampler(mode)
+
+    def start(self):
+        self._sampler.start()
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        self._sampler.stop()
+
+    def write(self, log_dir, name):
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        base_path = os.path.join(log_dir, 'profile-' + name)
+        self._profile.dump_stats(base_path + '.pstats')
+        with open(base_path + '.collapsed.txt', 'w') as fp:
+            fp.write(self._sampler.get_collapsed_stacks())
+
+def get_profile_mode(env):
+    """Returns the profiling mode requested with RELENG_PROFILE, or None."""
+    value = env.get('RELENG_PROFILE', None)
+    if not value:
+        return None
+    return ProfileMode.parse(value)
+
+@contextmanager
+def profile(factory, name):
+    """Runs the body of the with statement under a profiler if requested.
+
+    Args:
+        factory (ContextFactory): Factory to access other objects.
+        name (str): Name of the profiled operation, used in the file names.
+    """
+    mode = get_profile_mode(factory.env)
+    if mode is None:
+        yield
+        return
+    profiler = _Profiler(mode)
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        # Failure to write the profile should not mask the actual result.
+        try:
+            profiler.write(factory.workspace.get_log_dir(), name)
+        except Exception:
+            traceback.print_exc(file=factory.executor.console)
@@ -0,0 +1,49 @@
+"""
+CTest resource specification for parallel test runs
+
+When CTest runs tests in parallel, it only counts tests, so tests that use
+several cores (MPI tests with multiple ranks, or multithreaded tests) or a
+GPU oversubscribe the agent.  CTest 3.16 and newer can instead pack tests
+that declare their needs (the ``RESOURCE_GROUPS`` test property) against a
+resource specification file that describes the hardware available to the
+tests.  This module generates that file from the CPU topology of the build
+and the capacity of the agent from the agent inventory.
+
+CPUs are modeled as one ``cpus`` resource per NUMA node, with one slot per
+physical core in the node, so that a resource group (e.g., one MPI rank with
+several threads) always gets cores from a single node.  GPUs are modeled as
+``gpus`` resources with one slot each.  Tests that do not declare resource
+groups are unaffected.
+"""
+
+import json
+
+# First CTest version that supports --resource-spec-file.
+MINIMUM_CTEST_VERSION = '3.16'
+
+def create_resource_spec(topology, gpus=None):
+    """Creates a CTest resource specification.
+
+    Args:
+        topology: CPU topology available to the tests, as returned by
+            affinity.get_cpu_topology().
+        gpus (Optional[int]): Number of GPUs available to the tests.
+
+    Returns:
+        Dict: Resource specification that can be written as JSON.
+    """
+    cpus = []
+    for node in topology:
+        if node:
+            cpus.append({'id': str(node[0][0]), 'slots': len(node)})
+    resources = {'cpus': cpus}
+    if gpus:
+        resources['gpus'] = [{'id': str(x), 'slots': 1} for x in range(gpus)]
+    return {
+            'version': {'major': 1, 'minor': 0},
+            'local': [resources]
+        }
+
+def write_resource_spec(executor, path, spec):
+    """Writes a resource specification created by create_resource_spec()."""
+    executor.write_file(path, json.dumps(spec, indent=2, sort_keys=True) + '\n')
@@ -0,0 +1,172 @@
+"""
+Store of verified matrix build results for build avoidance
+
+Results of successful matrix configurations are recorded in an SQLite
+database, keyed by a hash of the source trees of all projects in the build
+(including releng, and gromacs, which contains the build scripts), the
+canonical build options, the toolchain, and the job type and matrix that the
+configuration was built in (the build scripts do different work for different
+job types).  When a later matrix build (e.g., a re-trigger after an unrelated
+failure) would build a configuration with an identical key, the earlier
+result is used instead.
+
+The toolchain is identified by the agent labels that the options map to, the
+build host, and a fingerprint of the compiler, CUDA and CMake versions that
+builds with those labels on the host last used (recorded by each build in
+run_cmake()).  Updating a tool in place thus invalidates earlier results once
+a build has used the new version, and a configuration is not considered
+verified if no fingerprint has been recorded for its host.
+
+The database is a single file (given by the ``RELENG_RESULT_STORE``
+environment variable), so it can be placed on storage shared between the
+agents, or mirrored by a separate service.
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+
+def compute_result_key(tree_hashes, config_key, labels, host, toolchain,
+        job_type, matrix_name):
+    """Computes the key for a configuration in the result store.
+
+    Args:
+        tree_hashes (Dict[str, str]): Source tree hash for each project.
+        config_key (str): Canonical key of the build options (from
+            options.get_canonical_key()).
+        labels (List[str]): Agent labels that the options map to.
+        host (str): Host that builds the configuration.
+        toolchain (str): Toolchain fingerprint recorded for the labels on the
+            host (see ResultStore.get_toolchain()).
+        job_type (JobType): Type of the job that builds the configuration.
+        matrix_name (str): Name of the matrix the configuration is from.
+
+    Returns:
+        str: Hexadecimal key.
+    """
+    data = json.dumps([sorted(tree_hashes.iteritems()), config_key, sorted(labels),
+        host, toolchain, job_type, matrix_name])
+    return hashlib.sha1(data).hexdigest()
+
+def compute_toolchain_fingerprint(versions):
+    """Computes a fingerprint from the version output of build tools.
+
+    Args:
+        versions (List[str]): Output of the tools when asked for the version
+            (None for tools that could not be queried).
+
+    Returns:
+        str: Hexadecimal fingerprint.
+    """
+    return hashlib.sha1(json.dumps(versions)).hexdigest()
+
+class VerifiedResult(object):
+    """Result of an earlier build of a configuration.
+
+    Attributes:
+        opts (List[str]): Build options of the earlier build.
+        result (str): Result of the build (always ``SUCCESS`` currently).
+        url (str): URL of the earlier matrix configuration build.
+        timestamp (float): Time when the result was recorded.
+    """
+
+    def __init__(self, opts, result, url, timestamp):
+        self.opts = opts
+        self.result = result
+        self.url = url
+        self.timestamp = timestamp
+
+    def to_dict(self):
+        return {
+                'opts': self.opts,
+                'result': self.result,
+                'url': self.url
+            }
+
+class ResultStore(object):
+    """Access to the database of verified results.
+
+    Args:
+        path (str): Path to the SQLite database file (created if it does not
+            exist).
+    """
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=60)
+        with self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS verified_results (
+                    key TEXT PRIMARY KEY,
+                    opts TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    url TEXT,
+                    timestamp REAL NOT NULL)''')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS toolchains (
+                    host TEXT NOT NULL,
+                    labels TEXT NOT NULL,
+                    fingerprint TEXT NOT NULL,
+                    timestamp REAL NOT NULL,
+                    PRIMARY KEY (host, labels))''')
+
+    def close(self):
+        self._conn.close()
+
+    def find(self, key):
+        """Returns the verified result for a key.
+
+        Returns:
+            VerifiedResult or None: The recorded result, or None if there is
+                none.
+        """
+        row = self._conn.execute(
+                'SELECT opts, result, url, timestamp FROM verified_results WHERE key = ?',
+                (key,)).fetchone()
+        if row is None:
+            return None
+        opts, result, url, timestamp = row
+        return VerifiedResult(json.loads(opts), result, url, timestamp)
+
+    def record(self, key, opts, result, url, timestamp=None):
+        """Records a successful result for a key.
+
+        An existing result for the same key is replaced.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self._conn:
+            self._conn.execute(
+                    'INSERT OR REPLACE INTO verified_results VALUES (?, ?, ?, ?, ?)',
+                    (key, json.dumps(opts), result, url, timestamp))
+
+    def get_toolchain(self, host, labels):
+        """Returns the toolchain fingerprint last recorded for labels on a host.
+
+        Returns:
+            str or None: The fingerprint, or None if none has been recorded.
+        """
+        row = self._conn.execute(
+                'SELECT fingerprint FROM toolchains WHERE host = ? AND labels = ?',
+                (host, json.dumps(sorted(labels)))).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def record_toolchain(self, host, labels, fingerprint, timestamp=None):
+        """Records the toolchain fingerprint of a build with labels on a host."""
+        if timestamp is None:
+            timestamp = time.time()
+        with self._conn:
+            self._conn.execute(
+                    'INSERT OR REPLACE INTO toolchains VALUES (?, ?, ?, ?)',
+                    (host, json.dumps(sorted(labels)), fingerprint, timestamp))
+
+def open_result_store(factory):
+    """Opens the result store configured for the build.
+
+    Returns:
+        ResultStore or None: The store, or None if no store is configured.
+    """
+    path = factory.jenkins.result_store_path
+    if not path:
+        return None
+    return ResultStore(path)
@@ -0,0 +1,132 @@
+import shutil
+import tempfile
+import unittest
+
+from releng import affinity
+from releng.common import JobType, System
+from releng.context import BuildContext
+
+from releng.test.utils import TestHelper
+
+def _add_topology(helper, nodes, threads_per_core):
+    """Adds sysfs files for a system with hyperthreads numbered like Linux.
+
+    Args:
+        nodes (int): Number of NUMA nodes.
+        threads_per_core (int): Number of hardware threads per core.
+    """
+    cores_per_node = 4
+    cores = nodes * cores_per_node
+    cpus = cores * threads_per_core
+    helper.add_input_file('/proc/self/status', 'Cpus_allowed_list:\t0-{0}\n'.format(cpus - 1))
+    helper.add_input_file('/sys/devices/system/node/online', '0-{0}\n'.format(nodes - 1))
+    for node in range(nodes):
+        node_cpus = []
+        for thread in range(threads_per_core):
+            first = thread * cores + node * cores_per_node
+            node_cpus.append('{0}-{1}'.format(first, first + cores_per_node - 1))
+        helper.add_input_file('/sys/devices/system/node/node{0}/cpulist'.format(node),
+                ','.join(node_cpus) + '\n')
+    for cpu in range(cpus):
+        core = cpu % cores
+        siblings = [str(core + thread * cores) for thread in range(threads_per_core)]
+        helper.add_input_file('/sys/devices/system/cpu/cpu{0}/topology/thread_siblings_list'.format(cpu),
+                ','.join(siblings) + '\n')
+
+class TestPartition(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_Topology(self):
+        _add_topology(self.helper, 2, 2)
+        topology = affinity.get_cpu_topology(self.helper.executor, range(16))
+        self.assertEqual(topology, [
+                [[0, 8], [1, 9], [2, 10], [3, 11]],
+                [[4, 12], [5, 13], [6, 14], [7, 15]]
+            ])
+
+    def test_UnknownTopology(self):
+        topology = affinity.get_cpu_topology(self.helper.executor, [0, 1, 2])
+        self.assertEqual(topology, [[[0], [1], [2]]])
+
+    def test_PartitionKeepsCoresAndNodes(self):
+        topology = [
+                [[0, 8], [1, 9], [2, 10], [3, 11]],
+                [[4, 12], [5, 13], [6, 14], [7, 15]]
+            ]
+        self.assertEqual(affinity.partition_cpus(topology, 2),
+                [[0, 1, 2, 3, 8, 9, 10, 11], [4, 5, 6, 7, 12, 13, 14, 15]])
+        self.assertEqual(affinity.partition_cpus(topology, 3),
+                [[0, 1, 8, 9], [2, 3, 4, 10, 11, 12], [5, 6, 7, 13, 14, 15]])
+
+    def test_ClaimDisjointSlots(self):
+        _add_topology(self.helper, 1, 2)
+        executor = self.helper.executor
+        first = affinity.claim_cpu_partition(executor, self.lock_dir, 2)
+        second = affinity.claim_cpu_partition(executor, self.lock_dir, 2)
+        self.assertEqual(first.cpus, [0, 1, 4, 5])
+        self.assertEqual(second.cpus, [2, 3, 6, 7])
+        self.assertIsNone(affinity.claim_cpu_partition(executor, self.lock_dir, 2))
+        first.release()
+        third = affinity.claim_cpu_partition(executor, self.lock_dir, 2)
+        self.assertEqual(third.index, 0)
+        second.release()
+        third.release()
+
+class TestCpuPartitionOption(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.helper = TestHelper(self, env={
+                'NODE_NAME': 'bs_gpu01',
+                'RELENG_CACHE_DIR': self.lock_dir
+            })
+        self.helper.factory.system = System.LINUX
+        _add_topology(self.helper, 1, 2)
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_BuildAndTest(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.build_target(target='all')
+                    context.run_ctest(args=['--output-on-failure'])
+                """)
+        self.helper.add_input_file('Testing/TAG', 'tag\n')
+        self.helper.add_input_file('Testing/tag/Test.xml', '<Site/>\n')
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, ['cpu-partition'])
+        build_call, test_call = self.helper.executor.check_call.call_args_list[-2:]
+        self.assertEqual(build_call[0][0][-1], '-j4')
+        self.assertIn('preexec_fn', build_call[1])
+        self.assertEqual(test_call[0][0][-3:], ['-j', '4', '--output-on-failure'])
+
+    def test_ResourceSpec(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.run_ctest(args=['--output-on-failure'])
+                """)
+        self.helper.add_input_file('Testing/TAG', 'tag\n')
+        self.helper.add_input_file('Testing/tag/Test.xml', '<Site/>\n')
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, ['cmake-3.16', 'cpu-partition'])
+        test_call = self.helper.executor.check_call.call_args_list[-1]
+        spec_path = '/ws/logs/ctest-resource-spec.json'
+        self.assertEqual(test_call[0][0][-5:],
+                ['-j', '4', '--resource-spec-file', spec_path, '--output-on-failure'])
+        self.helper.assertOutputJsonFile(spec_path, {
+                'version': {'major': 1, 'minor': 0},
+                'local': [{
+                    'cpus': [{'id': '0', 'slots': 2}],
+                    'gpus': [{'id': '0', 'slots': 1}]
+                }]
+            })
+
+if __name__ == '__main__':
+    unittest.main()
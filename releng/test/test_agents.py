@@ -0,0 +1,141 @@
+import itertools
+import json
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from releng import agents
+from releng.common import ConfigurationError
+
+def _get_possible_hosts_naive(inventory, labels):
+    if not labels:
+        return [inventory.default_label]
+    possible_hosts = [host for host, info in inventory.agents.iteritems()
+            if labels.issubset(info.labels)]
+    for group in inventory.special_host_groups:
+        if set(possible_hosts).issubset(group):
+            break
+        possible_hosts = [x for x in possible_hosts if x not in group]
+    return sorted(possible_hosts)
+
+class TestGetPossibleHosts(unittest.TestCase):
+    def test_MatchesLabelTable(self):
+        inventory = agents._get_inventory()
+        all_labels = set()
+        for info in inventory.agents.itervalues():
+            all_labels.update(info.labels)
+        all_labels = sorted(all_labels) + ['unknown-label']
+        for count in (0, 1, 2):
+            for labels in itertools.combinations(all_labels, count):
+                labels = set(labels)
+                self.assertEqual(agents.get_possible_hosts(labels),
+                        _get_possible_hosts_naive(inventory, labels), labels)
+
+    def test_SpecialGroups(self):
+        self.assertEqual(agents.get_possible_hosts({'msvc-2015'}), ['bs-win2012r2'])
+        self.assertNotIn('bs-win2012r2', agents.get_possible_hosts({'sse2'}))
+        self.assertEqual(agents.get_possible_hosts({'gcc-5', 'nosuchlabel'}), [])
+
+    def test_ResultIsNotShared(self):
+        hosts = agents.get_possible_hosts({'gcc-5'})
+        hosts.append('extra')
+        self.assertNotIn('extra', agents.get_possible_hosts({'gcc-5'}))
+
+class TestInventory(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'agents.json')
+        self.data = {
+                'default_label': 'docker',
+                'defaults': { 'executors': 2, 'build_parallelism': 2 },
+                'special_host_groups': [ { 'hosts': ['win'] } ],
+                'agents': {
+                    'nix': {
+                        'labels': ['gcc-5', 'gcc-7'],
+                        'matrix': True,
+                        'cores': 16,
+                        'memory': 64,
+                        'gpus': 2,
+                        'executors': 4,
+                        'gcc_for_libstdcxx': 'gcc-5'
+                    },
+                    'win': {
+                        'labels': ['msvc-2017'],
+                        'cores': None,
+                        'memory': None,
+                        'gpus': 0,
+                        'build_parallelism': 8
+                    }
+                }
+            }
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _read(self):
+        with open(self.path, 'w') as fp:
+            json.dump(self.data, fp)
+        return agents.read_inventory(self.path)
+
+    def test_Valid(self):
+        inventory = self._read()
+        nix = inventory.get('nix')
+        self.assertEqual(nix.labels, {'gcc-5', 'gcc-7'})
+        self.assertTrue(nix.matrix)
+        self.assertEqual((nix.cores, nix.memory, nix.gpus), (16, 64, 2))
+        self.assertEqual((nix.executors, nix.build_parallelism), (4, 2))
+        win = inventory.get('win')
+        self.assertFalse(win.matrix)
+        self.assertIsNone(win.cores)
+        self.assertEqual((win.executors, win.build_parallelism), (2, 8))
+        self.assertEqual(inventory.get('unknown').build_parallelism, 2)
+        self.assertEqual(inventory.label_index.get_possible_hosts({'gcc-5'}), ['nix'])
+
+    def test_MissingLabels(self):
+        del self.data['agents']['win']['labels']
+        with self.assertRaises(ConfigurationError):
+            self._read()
+
+    def test_MissingCapacity(self):
+        del self.data['agents']['win']['memory']
+        with self.assertRaises(ConfigurationError):
+            self._read()
+
+    def test_UnknownCapacityWarns(self):
+        self.assertEqual(agents.validate_inventory(self.data),
+                ['agent inventory: unknown capacity for win: cores, memory'])
+        self.data['agents']['win'].update(cores=8, memory=16)
+        self.assertEqual(agents.validate_inventory(self.data), [])
+
+    def test_UnknownKey(self):
+        self.data['agents']['win']['colour'] = 'blue'
+        with self.assertRaises(ConfigurationError):
+            self._read()
+
+    def test_InvalidValue(self):
+        self.data['agents']['nix']['executors'] = 0
+        with self.assertRaises(ConfigurationError):
+            self._read()
+        self.data['agents']['nix']['executors'] = True
+        with self.assertRaises(ConfigurationError):
+            self._read()
+
+    def test_UnknownGcc(self):
+        self.data['agents']['nix']['gcc_for_libstdcxx'] = 'gcc-4.8'
+        with self.assertRaises(ConfigurationError):
+            self._read()
+
+    def test_UnknownHostInGroup(self):
+        self.data['special_host_groups'].append({ 'hosts': ['mac'] })
+        with self.assertRaises(ConfigurationError):
+            self._read()
+
+    def test_InvalidJson(self):
+        with open(self.path, 'w') as fp:
+            fp.write('{')
+        with self.assertRaises(ConfigurationError):
+            agents.read_inventory(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,15 @@
+import json
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
 
-from releng.cmake import process_ctest_xml
+import releng
+from releng.cmake import TestOutputPolicy, process_ctest_xml
+from releng.cmake import merge_junit_xml, read_ctest_cost_data, split_tests_into_shards
+from releng.common import BuildError
 
 from releng.test.utils import TestHelper
 
@@ -76,3 +85,256 @@ class TestRunBuild(unittest.TestCase):
         process_ctest_xml(self.helper.executor, memcheck=True)
         self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
                 <testsuites><testsuite name="CTest_MemCheck"><testcase classname="CTest_MemCheck" name="Test1"><failure message="SEGV" /><system-out>some output</system-out></testcase></testsuite></testsuites>""")
+
+    def test_CTestMultipleTests(self):
+        self.helper.add_input_file("Testing/YYYYMMDD-HHMM/Test.xml", """\
+                <Site>
+                  <Testing>
+                    <TestList>
+                      <Test>./Test1</Test>
+                      <Test>./Test2</Test>
+                    </TestList>
+                    <Test Status="passed">
+                      <Name>Test1</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>output &lt;1&gt;</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                    <Test Status="passed">
+                      <Name>Test2</Name>
+                      <Results>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.2</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>output 2</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """)
+        process_ctest_xml(self.helper.executor, memcheck=False)
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.1"><system-out>output &lt;1&gt;</system-out></testcase><testcase classname="CTest" name="Test2" time="0.2"><system-out>output 2</system-out></testcase></testsuite></testsuites>""")
+
+    def _add_test_xml_with_output(self, status, output):
+        self.helper.add_input_file("Testing/YYYYMMDD-HHMM/Test.xml", """\
+                <Site>
+                  <Testing>
+                    <Test Status="{0}">
+                      <Name>Test/1</Name>
+                      <Results>
+                        <NamedMeasurement name="Exit Code">
+                          <Value>Failed</Value>
+                        </NamedMeasurement>
+                        <NamedMeasurement name="Execution Time">
+                          <Value>0.1</Value>
+                        </NamedMeasurement>
+                        <Measurement>
+                          <Value>{1}</Value>
+                        </Measurement>
+                      </Results>
+                    </Test>
+                  </Testing>
+                </Site>
+                """.format(status, output))
+
+    def test_PassedTestOutputIsTruncated(self):
+        self._add_test_xml_with_output('passed', 'line1\nline2\nline3\nline4\nline5')
+        policy = TestOutputPolicy(head_lines=1, tail_lines=2,
+                spill_dir='/ws/logs/ctest-output',
+                spill_link='http://build/artifact/logs/ctest-output')
+        process_ctest_xml(self.helper.executor, memcheck=False, output_policy=policy)
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test/1" time="0.1"><system-out>line1
+                [... 2 lines omitted; full output in http://build/artifact/logs/ctest-output/1-Test_1.log.gz ...]
+                line4
+                line5</system-out></testcase></testsuite></testsuites>""")
+        self.helper.executor.write_file.assert_any_call(
+                '/ws/logs/ctest-output/1-Test_1.log.gz',
+                'line1\nline2\nline3\nline4\nline5', compress=True)
+
+    def test_SpillFileNamesAreUnique(self):
+        policy = TestOutputPolicy(spill_dir='/ws/logs/ctest-output')
+        self.assertEqual([policy._get_spill_filename(x) for x in ('Test/1', 'Test:1')],
+                ['1-Test_1.log.gz', '2-Test_1.log.gz'])
+
+    def test_PassedTestShortOutputIsKept(self):
+        self._add_test_xml_with_output('passed', 'line1\nline2\nline3')
+        policy = TestOutputPolicy(head_lines=1, tail_lines=2, spill_dir='/ws/logs/ctest-output')
+        process_ctest_xml(self.helper.executor, memcheck=False, output_policy=policy)
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test/1" time="0.1"><system-out>line1
+                line2
+                line3</system-out></testcase></testsuite></testsuites>""")
+        self.assertEqual(self.helper.executor.write_file.call_count, 1)
+
+    def test_FailedTestOutputIsKept(self):
+        self._add_test_xml_with_output('failed', 'line1\nline2\nline3\nline4\nline5')
+        policy = TestOutputPolicy(head_lines=1, tail_lines=2, spill_dir='/ws/logs/ctest-output')
+        process_ctest_xml(self.helper.executor, memcheck=False, output_policy=policy)
+        self.helper.assertOutputFile("Testing/Temporary/CTest.xml", """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test/1" time="0.1"><failure message="Failed" /><system-out>line1
+                line2
+                line3
+                line4
+                line5</system-out></testcase></testsuite></testsuites>""")
+        self.assertEqual(self.helper.executor.write_file.call_count, 1)
+
+class TestTestShards(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+
+    def test_ReadCostData(self):
+        self.helper.add_input_file('Testing/Temporary/CTestCostData.txt', """\
+                TestA 3 10.5
+                Test with spaces 1 2
+                ---
+                TestA
+                """)
+        costs = read_ctest_cost_data(self.helper.executor, 'Testing/Temporary/CTestCostData.txt')
+        self.assertEqual(costs, {'TestA': 10.5, 'Test with spaces': 2.0})
+
+    def test_MissingCostData(self):
+        costs = read_ctest_cost_data(self.helper.executor, 'Testing/Temporary/CTestCostData.txt')
+        self.assertEqual(costs, {})
+
+    def test_SplitBalancesDurations(self):
+        tests = ['A', 'B', 'C', 'D', 'E']
+        costs = {'A': 10.0, 'B': 6.0, 'C': 5.0, 'D': 4.0}
+        shards = split_tests_into_shards(tests, costs, 2)
+        # E is assumed to take the average of the others (6.25).
+        self.assertEqual(shards, [['A', 'C'], ['B', 'D', 'E']])
+
+    def test_SplitWithMoreShardsThanTests(self):
+        shards = split_tests_into_shards(['A', 'B'], {}, 3)
+        self.assertEqual(shards, [['A'], ['B'], []])
+
+    def test_MergeJUnitXml(self):
+        self.helper.add_input_file('shard1.xml', """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.1"><system-out>out 1</system-out></testcase></testsuite></testsuites>
+                """)
+        self.helper.add_input_file('shard2.xml', """\
+                <testsuites>
+                  <testsuite name="CTest_2">
+                    <testcase classname="Other" name="Test2" time="0.2"><failure message="Failed" /></testcase>
+                    <testcase classname="Other" name="Test3" time="0.3" />
+                  </testsuite>
+                </testsuites>
+                """)
+        merge_junit_xml(self.helper.executor, ['shard1.xml', 'shard2.xml'], 'merged.xml')
+        self.helper.assertOutputFile('merged.xml', """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" time="0.1"><system-out>out 1</system-out></testcase><testcase classname="CTest" name="Test2" time="0.2"><failure message="Failed" /></testcase><testcase classname="CTest" name="Test3" time="0.3" /></testsuite></testsuites>""")
+
+    def _add_shard(self, path, shard, tests, names):
+        testcases = ''.join(['<testcase classname="CTest" name="{0}" />'.format(x) for x in names])
+        self.helper.add_input_file(path, """\
+                <testsuites><testsuite name="CTest"><properties><property name="test-shard" value="{0}" /><property name="test-shard-tests" value="{1}" /></properties>{2}</testsuite></testsuites>
+                """.format(shard, tests, testcases))
+
+    def test_MergeTestShards(self):
+        self._add_shard('shard1.xml', '1/2', 'hash', ['Test1', 'Test3'])
+        self._add_shard('shard2.xml', '2/2', 'hash', ['Test2'])
+        merge_junit_xml(self.helper.executor, ['shard1.xml', 'shard2.xml'], 'merged.xml')
+        self.helper.assertOutputFile('merged.xml', """\
+                <testsuites><testsuite name="CTest"><testcase classname="CTest" name="Test1" /><testcase classname="CTest" name="Test3" /><testcase classname="CTest" name="Test2" /></testsuite></testsuites>""")
+
+    def test_MergeRequiresAllShards(self):
+        self._add_shard('shard1.xml', '1/3', 'hash', ['Test1'])
+        self._add_shard('shard2.xml', '2/3', 'hash', ['Test2'])
+        with self.assertRaises(BuildError):
+            merge_junit_xml(self.helper.executor, ['shard1.xml', 'shard2.xml'], 'merged.xml')
+
+    def test_MergeRequiresSameTestList(self):
+        self._add_shard('shard1.xml', '1/2', 'hash', ['Test1'])
+        self._add_shard('shard2.xml', '2/2', 'other', ['Test2'])
+        with self.assertRaises(BuildError):
+            merge_junit_xml(self.helper.executor, ['shard1.xml', 'shard2.xml'], 'merged.xml')
+
+    def test_MergeRejectsDuplicateTests(self):
+        self._add_shard('shard1.xml', '1/2', 'hash', ['Test1', 'Test2'])
+        self._add_shard('shard2.xml', '2/2', 'hash', ['Test2'])
+        with self.assertRaises(BuildError):
+            merge_junit_xml(self.helper.executor, ['shard1.xml', 'shard2.xml'], 'merged.xml')
+
+@unittest.skipUnless(os.environ.get('RELENG_RUN_BENCHMARKS'),
+        'set RELENG_RUN_BENCHMARKS to run benchmarks')
+class TestCTestXmlBenchmark(unittest.TestCase):
+    """Benchmarks for converting large CTest XML files.
+
+    Memcheck and ASAN builds can produce CTest XML files of hundreds of MB,
+    so the conversion should not need memory proportional to the file size.
+    These generate a large file and run the conversion in a subprocess, so
+    they are only run if ``RELENG_RUN_BENCHMARKS`` is set.
+    """
+
+    _PROCESS_SCRIPT = """\
+import json, resource, sys, time
+from releng.cmake import process_ctest_xml
+from releng.factory import ContextFactory
+factory = ContextFactory(env={'WORKSPACE': sys.argv[1]})
+factory.cwd.chdir(sys.argv[1])
+executor = factory.executor
+start_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.time()
+process_ctest_xml(executor, memcheck=False)
+elapsed = time.time() - start
+memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_memory
+print(json.dumps({'time': elapsed, 'memory': memory * 1024}))
+"""
+
+    _TEST_XML = """\
+    <Test Status="{status}">
+      <Name>Test{index}</Name>
+      <Results>
+        <NamedMeasurement type="text/string" name="Exit Code">
+          <Value>Failed</Value>
+        </NamedMeasurement>
+        <NamedMeasurement type="numeric/double" name="Execution Time">
+          <Value>0.5</Value>
+        </NamedMeasurement>
+        <Measurement>
+          <Value>{output}</Value>
+        </Measurement>
+      </Results>
+    </Test>
+"""
+
+    def setUp(self):
+        self._workdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self._workdir)
+        os.makedirs(os.path.join(self._workdir, 'Testing', 'TAG-DIR'))
+        os.makedirs(os.path.join(self._workdir, 'Testing', 'Temporary'))
+        with open(os.path.join(self._workdir, 'Testing', 'TAG'), 'w') as fp:
+            fp.write('TAG-DIR\nExperimental\n')
+
+    def _write_ctest_xml(self, count, output_size):
+        path = os.path.join(self._workdir, 'Testing', 'TAG-DIR', 'Test.xml')
+        output = ('x' * 79 + '\n') * (output_size // 80)
+        with open(path, 'w') as fp:
+            fp.write('<?xml version="1.0" encoding="UTF-8"?>\n<Site>\n  <Testing>\n')
+            for index in range(count):
+                status = 'failed' if index % 10 == 0 else 'passed'
+                fp.write(self._TEST_XML.format(index=index, status=status, output=output))
+            fp.write('  </Testing>\n</Site>\n')
+        return os.path.getsize(path)
+
+    def _run_conversion(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(releng.__file__)))
+        output = subprocess.check_output(
+                [sys.executable, '-c', self._PROCESS_SCRIPT, self._workdir], cwd=root)
+        return json.loads(output)
+
+    def test_LargeCTestXml(self):
+        size = self._write_ctest_xml(4000, 10000)
+        result = self._run_conversion()
+        output_path = os.path.join(self._workdir, 'Testing', 'Temporary', 'CTest.xml')
+        self.assertGreater(os.path.getsize(output_path), size // 2)
+        self.assertLess(result['memory'], size // 4)
+        self.assertLess(result['time'], 10)
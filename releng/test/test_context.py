@@ -1,11 +1,15 @@
 import os.path
+import shutil
+import tempfile
 import unittest
 # With Python 2.7, this needs to be separately installed.
 # With Python 3.3 and up, this should change to unittest.mock.
 import mock
 
-from releng.common import JobType
+from releng.common import JobType, Project
 from releng.context import BuildContext
+from releng.options import get_build_labels
+from releng.resultstore import ResultStore
 
 from releng.test.utils import TestHelper
 
@@ -66,6 +70,258 @@ class TestRunBuild(unittest.TestCase):
                 'script/build.py', JobType.GERRIT, None)
 
 
+class TestRunCTest(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, env={'RELENG_CACHE_DIR': '/cache'})
+        self.helper.add_input_file('Testing/TAG', 'tag\n')
+        self.helper.add_input_file('Testing/tag/Test.xml', '<Site/>\n')
+
+    def _run_ctest(self, opts, extra_args=''):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.run_ctest(args=['--output-on-failure']{0})
+                """.format(extra_args))
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, opts)
+        return self.helper.executor.check_call.call_args_list[-1][0][0]
+
+    def _get_cost_data_copies(self):
+        return [x[0] for x in self.helper.executor.copy_file.call_args_list
+                if 'CTestCostData' in x[0][0] or 'CTestCostData' in x[0][1]]
+
+    def test_TestJobs(self):
+        cmd = self._run_ctest(['gcc-7', 'test-jobs=3'])
+        self.assertEqual(cmd[-3:], ['-j', '3', '--output-on-failure'])
+
+    def _get_output_dirs(self):
+        return [x[0][0] for x in self.helper.executor.ensure_dir_exists.call_args_list
+                if x[0][0].endswith('ctest-output')]
+
+    def test_FullOutputByDefault(self):
+        self._run_ctest(['gcc-7'])
+        self.assertEqual(self._get_output_dirs(), [])
+
+    def test_TruncateOutput(self):
+        self._run_ctest(['gcc-7'], ', truncate_output=True')
+        self.assertIn('/ws/logs/ctest-output', self._get_output_dirs())
+
+    def test_CostDataIsKeptPerConfiguration(self):
+        self._run_ctest(['gcc-7', 'mpi', 'host=bs_mic'])
+        restore, save = self._get_cost_data_copies()
+        cache_path = restore[0]
+        self.assertTrue(cache_path.startswith('/cache/ctest-cost/'))
+        self.assertEqual(restore[1], 'Testing/Temporary/CTestCostData.txt')
+        self.assertEqual(save, ('Testing/Temporary/CTestCostData.txt', cache_path))
+        self.helper.executor.copy_file.reset_mock()
+        self._run_ctest(['mpi', 'gcc-7', 'host=bs_nix1204'])
+        restore, save = self._get_cost_data_copies()
+        self.assertEqual(restore[0], cache_path)
+        self.helper.executor.copy_file.reset_mock()
+        self._run_ctest(['gcc-7'])
+        restore, save = self._get_cost_data_copies()
+        self.assertNotEqual(restore[0], cache_path)
+
+    def test_TestShard(self):
+        self.helper.set_ctest_tests(['TestA', 'TestB', 'TestC.1'])
+        self.helper.add_input_file('Testing/Temporary/CTestCostData.txt', """\
+                TestA 1 10
+                TestB 1 4
+                TestC.1 1 5
+                ---
+                """)
+        cmd = self._run_ctest(['gcc-7', 'test-shard=2/2'])
+        # The split does not depend on the timing data, which can differ
+        # between the agents that run the shards.
+        self.assertEqual(cmd[-2:], ['-R', r'^(TestB)$'])
+        self.assertEqual(self._get_cost_data_copies(), [])
+
+    def test_EmptyTestShard(self):
+        self.helper.set_ctest_tests(['TestA'])
+        self._run_ctest(['gcc-7', 'test-shard=2/2'])
+        self.helper.assertOutputFile('Testing/Temporary/CTest.xml',
+                '<testsuites><testsuite name="CTest"><properties>'
+                '<property name="test-shard" value="2/2" />'
+                '<property name="test-shard-tests" value="e1a5788f2731d9cdb218b95b9c1a0a94f0f8cbc5" />'
+                '</properties></testsuite></testsuites>')
+
+    def _add_codemodel(self):
+        reply = '.cmake/api/v1/reply/'
+        self.helper.add_input_json_file(reply + 'index-1.json', {
+                'reply': {'codemodel-v2': {'jsonFile': 'codemodel.json'}}
+            })
+        self.helper.add_input_json_file(reply + 'codemodel.json', {
+                'paths': {'build': '/ws/gromacs', 'source': '/ws/gromacs'},
+                'configurations': [{'targets': [
+                        {'jsonFile': 'target-a.json'}, {'jsonFile': 'target-b.json'},
+                        {'jsonFile': 'target-smoke.json'}]}]
+            })
+        for name in ('a', 'b', 'smoke'):
+            self.helper.add_input_json_file(reply + 'target-{0}.json'.format(name), {
+                    'id': name, 'name': name + '-test',
+                    'sources': [{'path': 'src/{0}.cpp'.format(name)}],
+                    'artifacts': [{'path': 'bin/{0}-test'.format(name)}]
+                })
+        self.helper.set_ctest_tests(['TestA', 'TestB', 'Smoke'], {
+                'TestA': ['/ws/gromacs/bin/a-test'],
+                'TestB': ['/ws/gromacs/bin/b-test'],
+                'Smoke': ['/ws/gromacs/bin/smoke-test']
+            })
+        self.helper.set_changed_files(Project.GROMACS, ['src/b.cpp'])
+
+    def test_TestSelectionFirst(self):
+        self._add_codemodel()
+        self._run_ctest(['cmake-3.14', 'test-selection=first'], ", smoke_tests=['Smoke']")
+        calls = [x[0][0] for x in self.helper.executor.check_call.call_args_list]
+        self.assertEqual(calls[-2][-2:], ['-R', '^(TestB|Smoke)$'])
+        self.assertEqual(calls[-1][-2:], ['-E', '^(TestB|Smoke)$'])
+        self.helper.assertOutputFile('Testing/Temporary/CTest.xml',
+                '<testsuites><testsuite name="CTest"></testsuite></testsuites>')
+        self.helper.assertOutputJsonFile('/ws/logs/ctest-selection.json', {
+                'mode': 'first',
+                'tests': ['TestB', 'Smoke'],
+                'reason': None,
+                'changed_files': ['src/b.cpp'],
+                'affected_targets': ['b-test'],
+                'smoke_tests': ['Smoke']
+            })
+
+    def test_TestSelectionOnly(self):
+        self._add_codemodel()
+        cmd = self._run_ctest(['cmake-3.14', 'test-selection=only'])
+        self.assertEqual(cmd[-2:], ['-R', '^(TestB)$'])
+        ctest_calls = [x for x in self.helper.executor.check_call.call_args_list
+                if x[0][0][0] == '/opt/cmake/3.14/bin/ctest']
+        self.assertEqual(len(ctest_calls), 1)
+
+    def test_TestSelectionKeepsScriptTests(self):
+        self._add_codemodel()
+        self.helper.set_ctest_tests(['TestA', 'TestB', 'Script'], {
+                'TestA': ['/ws/gromacs/bin/a-test'],
+                'TestB': ['/ws/gromacs/bin/b-test'],
+                'Script': ['/usr/bin/perl', 'gmxtest.pl']
+            })
+        cmd = self._run_ctest(['cmake-3.14', 'test-selection=only'])
+        self.assertEqual(cmd[-2:], ['-R', '^(TestB|Script)$'])
+
+    def test_TestSelectionWithUnknownChanges(self):
+        self._add_codemodel()
+        self.helper.set_changed_files(Project.GROMACS, ['src/b.h'])
+        cmd = self._run_ctest(['cmake-3.14', 'test-selection=only'])
+        self.assertEqual(cmd[-1], '--output-on-failure')
+
+class TestRunCMake(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.tempdir, 'results.db')
+        self.helper = TestHelper(self, env={
+                'NODE_NAME': 'bs_mic',
+                'RELENG_RESULT_STORE': self.store_path
+            })
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _get_toolchain(self):
+        store = ResultStore(self.store_path)
+        try:
+            return store.get_toolchain('bs_mic', get_build_labels(['gcc-5', 'host=bs_mic']))
+        finally:
+            store.close()
+
+    def _run_cmake(self, compiler_version='gcc 5.4.0', opts=None):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.run_cmake({})
+                """)
+        check_output = self.helper._check_output
+        self.helper.executor.check_output.side_effect = lambda cmd, **kwargs: \
+                compiler_version if cmd[0] == 'gcc-5' else check_output(cmd, **kwargs)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, ['gcc-5', 'host=bs_mic'] + (opts or []))
+        return self._get_toolchain()
+
+    def _get_codemodel_queries(self):
+        return [x[0][0] for x in self.helper.executor.write_file.call_args_list
+                if x[0][0].startswith('.cmake/api/')]
+
+    def test_NoCodemodelQueryByDefault(self):
+        self._run_cmake()
+        self.assertEqual(self._get_codemodel_queries(), [])
+
+    def test_CodemodelQueryForTestSelection(self):
+        self._run_cmake(opts=['test-selection=first'])
+        self.assertEqual(self._get_codemodel_queries(), ['.cmake/api/v1/query/codemodel-v2'])
+
+    def test_RecordsToolchain(self):
+        self.assertIsNone(self._get_toolchain())
+        toolchain = self._run_cmake('gcc 5.4.0')
+        self.assertIsNotNone(toolchain)
+        self.assertEqual(self._run_cmake('gcc 5.4.0'), toolchain)
+        self.assertNotEqual(self._run_cmake('gcc 5.5.0'), toolchain)
+
+class TestRunBuilds(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+
+    def test_SeparateConfigurations(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_out_of_source = True
+                extra_options = {
+                    'fail': Option.simple,
+                    'unstable': Option.simple
+                }
+                def do_build(context):
+                    context.env.set_env_var('CONFIG_DIR', context.workspace.build_dir)
+                    if context.opts.unstable:
+                        context.mark_unstable('tests failed')
+                    if context.opts.fail:
+                        raise BuildError('compilation failed')
+                """)
+        factory = self.helper.factory
+        results = BuildContext._run_builds(factory, 'script/build.py', JobType.GERRIT,
+                [['gcc-4.8', 'fail'], ['gcc-4.8', 'unstable'], ['gcc-4.8']])
+        self.assertEqual(results, [
+                { 'opts': ['gcc-4.8', 'fail'], 'result': 'FAILURE' },
+                { 'opts': ['gcc-4.8', 'unstable'], 'result': 'UNSTABLE' },
+                { 'opts': ['gcc-4.8'], 'result': 'SUCCESS' }
+            ])
+        self.assertTrue(factory.status_reporter.failed)
+        self.assertEqual(factory.status_reporter._unsuccessful_reason,
+                ['[config-1] compilation failed', '[config-2] tests failed'])
+        self.assertEqual(factory.workspace.build_dir, '/ws/build/config-3')
+        self.assertEqual(factory.workspace.get_log_dir(), '/ws/logs/config-3')
+        self.assertEqual(factory.cmd_runner.get_env_var('CONFIG_DIR'), '/ws/build/config-3')
+
+    def test_InvalidConfigurationDoesNotStopOthers(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                build_out_of_source = True
+                def do_build(context):
+                    pass
+                """)
+        factory = self.helper.factory
+        results = BuildContext._run_builds(factory, 'script/build.py', JobType.GERRIT,
+                [['gcc-4.8'], ['gcc-4.8', 'no-such-option'], ['gcc-4.8']])
+        self.assertEqual([x['result'] for x in results], ['SUCCESS', 'FAILURE', 'SUCCESS'])
+        self.assertTrue(factory.status_reporter.failed)
+
+    def test_InSourceLocalCheckoutIsNotCleaned(self):
+        self.helper = TestHelper(self, env={'GROMACS_REFSPEC': 'HEAD'})
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    pass
+                """)
+        BuildContext._run_builds(self.helper.factory, 'script/build.py', JobType.GERRIT,
+                [['gcc-4.8'], ['gcc-4.8']])
+        cleans = [x for x in self.helper.executor.check_call.call_args_list
+                if x[0][0][:2] == ['git', 'clean']]
+        self.assertEqual(cleans, [])
+
+
 class TestReadBuildScriptConfig(unittest.TestCase):
     def setUp(self):
         self.helper = TestHelper(self)
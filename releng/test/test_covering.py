@@ -0,0 +1,92 @@
+import itertools
+import unittest
+
+from releng.common import ConfigurationError
+from releng.covering import Axis, ExcludeConstraint, RequireConstraint
+from releng.covering import generate_covering_array
+from releng.matrixbuild import prepare_build_matrix
+
+from releng.test.utils import TestHelper
+
+def _axis(name, *values):
+    return Axis(name, [tuple(x.split('+')) if x != '-' else tuple() for x in values])
+
+class TestGenerateCoveringArray(unittest.TestCase):
+    def _assertCovers(self, axes, configs, strength, is_allowed=None):
+        for chosen_axes in itertools.combinations(axes, strength):
+            for values in itertools.product(*[x.values for x in chosen_axes]):
+                opts = [opt for value in values for opt in value]
+                if is_allowed and not is_allowed(opts):
+                    continue
+                self.assertTrue(any(all(x in config for x in opts) for config in configs),
+                        'not covered: {0}'.format(opts))
+
+    def test_Pairwise(self):
+        axes = [
+                _axis('compiler', 'gcc-5', 'gcc-7', 'clang-6'),
+                _axis('simd', 'simd=sse4.1', 'simd=avx_256', 'simd=reference'),
+                _axis('precision', '-', 'double'),
+                _axis('mpi', '-', 'mpi')
+            ]
+        configs = generate_covering_array(axes)
+        self._assertCovers(axes, configs, 2)
+        self.assertLess(len(configs), 3 * 3 * 2 * 2)
+        self.assertLessEqual(len(configs), 11)
+        self.assertEqual(configs, generate_covering_array(axes))
+
+    def test_ThreeWay(self):
+        axes = [_axis('a{0}'.format(i), '-', 'opt{0}'.format(i)) for i in range(5)]
+        configs = generate_covering_array(axes, strength=3)
+        self._assertCovers(axes, configs, 3)
+        self.assertLess(len(configs), 32)
+
+    def test_Constraints(self):
+        axes = [
+                _axis('compiler', 'gcc-7', 'clang-6', 'icc-18'),
+                _axis('gpu', '-', 'cuda-10.0', 'opencl-1.2')
+            ]
+        constraints = [
+                RequireConstraint('cuda-*', ['gcc-*', 'clang-*']),
+                ExcludeConstraint(['clang-*', 'opencl-*'])
+            ]
+        configs = generate_covering_array(axes, constraints)
+        def is_allowed(opts):
+            if 'cuda-10.0' in opts and 'icc-18' in opts:
+                return False
+            return not ('clang-6' in opts and 'opencl-1.2' in opts)
+        self._assertCovers(axes, configs, 2, is_allowed)
+        for config in configs:
+            self.assertTrue(is_allowed(config), config)
+        self.assertEqual(len(configs), 7)
+
+class TestMatrixDirectives(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+
+    def test_GeneratedConfigs(self):
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt',
+                """\
+                msvc-2013
+                %axis compiler: gcc-5 gcc-7
+                %axis gpu: - cuda-10.0   # no GPU or CUDA
+                %axis extra: - double+mpi
+                %exclude gcc-5 cuda-*
+                """)
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+        opts = [x['opts'] for x in result['configs']]
+        self.assertEqual(opts[0], ['msvc-2013'])
+        self.assertEqual(len(opts), 6)
+        self.assertNotIn(['gcc-5', 'cuda-10.0'], [x[:2] for x in opts])
+        for config in result['configs']:
+            self.assertIsNotNone(config['host'])
+
+    def test_InvalidDirective(self):
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt',
+                """\
+                %axes compiler: gcc-5 gcc-7
+                """)
+        with self.assertRaises(ConfigurationError):
+            prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import json
+import os.path
+import subprocess
+import sys
+import time
+import unittest
+
+import releng
+from releng import _read_build_script_config, _run_batch
+from releng.common import ConfigurationError
+
+from releng.test.utils import RepositoryTestState, TestHelper
+
+class TestRunBatch(unittest.TestCase):
+    def setUp(self):
+        self.commits = RepositoryTestState.create_default()
+        self.helper = TestHelper(self, commits=self.commits, workspace='/ws')
+
+    def test_MultipleOperations(self):
+        commits = self.commits
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt',
+                'msvc-2013\n')
+        self.helper.add_input_file('/ws/gromacs/admin/builds/clang-format.py',
+                """\
+                build_options = ['clang-8']
+                def do_build(context):
+                    pass
+                """)
+        result = _run_batch(self.helper.factory, [
+                'get_build_revisions',
+                ['prepare_multi_configuration_build', 'pre-submit-matrix'],
+                ['read_build_script_config', 'clang-format']
+            ])
+        self.assertEqual(result['get_build_revisions'], commits.expected_build_revisions)
+        self.assertEqual(result['prepare_multi_configuration_build'], {
+                'configs': [
+                    {
+                        'host': 'bs-win2012r2',
+                        'labels': 'msvc-2013',
+                        'opts': ['msvc-2013']
+                    }
+                ],
+                'as_axis': '"msvc-2013 host=bs-win2012r2"'
+            })
+        self.assertEqual(result['read_build_script_config']['opts'], ['clang-8'])
+        self.assertEqual(self.helper.factory.status_reporter.return_value, result)
+
+    def test_UnknownOperation(self):
+        with self.assertRaises(ConfigurationError):
+            _run_batch(self.helper.factory, ['run_build'])
+
+    def test_DuplicateOperation(self):
+        with self.assertRaises(ConfigurationError):
+            _run_batch(self.helper.factory, ['get_build_revisions', 'get_build_revisions'])
+
+class TestStartup(unittest.TestCase):
+    """Tests for the startup cost of the entry points.
+
+    Workflow builds call the entry points many times for trivial operations,
+    so importing and initializing things that the operation does not need
+    adds up.  The imports are checked in a subprocess, so that modules
+    imported by other tests do not affect the result.
+    """
+
+    _IMPORT_SCRIPT = """\
+import json, sys
+{0}
+modules = sorted(x for x in sys.modules if x.startswith('releng.') and sys.modules[x])
+print(json.dumps(modules))
+"""
+
+    def _get_imported_modules(self, code):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(releng.__file__)))
+        script = self._IMPORT_SCRIPT.format(code)
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=root)
+        return json.loads(output)
+
+    def test_FactoryImports(self):
+        modules = self._get_imported_modules("""\
+import releng
+from releng.factory import ContextFactory
+factory = ContextFactory(env={'WORKSPACE': '/ws'})
+""")
+        for module in ('context', 'options', 'environment', 'agents', 'workspace'):
+            self.assertNotIn('releng.' + module, modules)
+
+    def test_OptionsImports(self):
+        modules = self._get_imported_modules('import releng.options')
+        for module in ('environment', 'cmake', 'hardware', 'resourcespec'):
+            self.assertNotIn('releng.' + module, modules)
+
+    def test_ReadBuildScriptConfigTime(self):
+        helper = TestHelper(self, workspace='/ws')
+        helper.add_input_file('/ws/gromacs/admin/builds/clang-format.py',
+                """\
+                build_options = ['clang-8']
+                def do_build(context):
+                    pass
+                """)
+        start = time.time()
+        _read_build_script_config(helper.factory, 'clang-format')
+        # Generous bound to not fail on loaded agents; this catches only
+        # gross regressions such as initializing a full build environment.
+        self.assertLess(time.time() - start, 5)
+
+if __name__ == '__main__':
+    unittest.main()
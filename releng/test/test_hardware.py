@@ -0,0 +1,150 @@
+import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng import hardware
+from releng.common import System
+from releng.options import process_build_options
+from releng.script import BuildScriptSettings
+
+from releng.test.utils import TestHelper
+
+_GiB = 2**30
+
+class TestHardwareDetection(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+        self.executor = self.helper.executor
+
+    def test_ParseCpuList(self):
+        self.assertEqual(hardware.parse_cpu_list('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+
+    def test_AffinityAndQuota(self):
+        self.helper.add_input_file('/proc/self/status',
+                """\
+                Name:\tpython
+                Cpus_allowed:\tff
+                Cpus_allowed_list:\t0-7
+                """)
+        self.assertEqual(hardware.get_available_cpu_count(self.executor), 8)
+        self.helper.add_input_file('/sys/fs/cgroup/cpu.max', '250000 100000\n')
+        self.assertEqual(hardware.get_available_cpu_count(self.executor), 3)
+        self.helper.add_input_file('/sys/fs/cgroup/cpu.max', 'max 100000\n')
+        self.assertEqual(hardware.get_available_cpu_count(self.executor), 8)
+
+    def test_CgroupV1Quota(self):
+        self.helper.add_input_file('/proc/self/status', 'Cpus_allowed_list:\t0-23\n')
+        self.helper.add_input_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '400000\n')
+        self.helper.add_input_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us', '100000\n')
+        self.assertEqual(hardware.get_available_cpu_count(self.executor), 4)
+
+    @mock.patch('releng.hardware.get_total_cpu_count', return_value=6)
+    def test_NoInformation(self, cpu_count):
+        self.assertEqual(hardware.get_available_cpu_count(self.executor), 6)
+        self.assertIsNone(hardware.get_available_memory(self.executor))
+
+    def test_Memory(self):
+        self.helper.add_input_file('/proc/meminfo',
+                """\
+                MemTotal:       32000000 kB
+                MemFree:         1000000 kB
+                MemAvailable:   16000000 kB
+                """)
+        self.assertEqual(hardware.get_available_memory(self.executor), 16000000 * 1024)
+        self.helper.add_input_file('/sys/fs/cgroup/memory.max', '4294967296\n')
+        self.assertEqual(hardware.get_available_memory(self.executor), 4 * _GiB)
+
+    def test_ComputeBuildJobs(self):
+        self.assertEqual(hardware.compute_build_jobs(12, 32 * _GiB, _GiB), 12)
+        self.assertEqual(hardware.compute_build_jobs(12, 5 * _GiB, int(2.5 * _GiB)), 2)
+        self.assertEqual(hardware.compute_build_jobs(24, None, _GiB), 24)
+        self.assertEqual(hardware.compute_build_jobs(1, _GiB // 4, _GiB), 1)
+
+class TestAutoBuildJobs(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, env={'NODE_NAME': 'bs_gpu01'})
+        self.helper.add_input_file('/proc/self/status', 'Cpus_allowed_list:\t0-15\n')
+        self.helper.add_input_file('/proc/meminfo', 'MemAvailable:   33554432 kB\n')
+        self.factory = self.helper.factory
+        self.factory.system = System.LINUX
+
+    @mock.patch('releng.hardware.get_total_cpu_count', return_value=16)
+    def _get_build_cmd(self, opts, cpu_count):
+        e, o = process_build_options(self.factory, opts, BuildScriptSettings())
+        return e._get_build_cmd()
+
+    def test_Auto(self):
+        cmd = self._get_build_cmd(['gcc-7', 'build-jobs=auto'])
+        self.assertEqual(cmd[-2:], ['-j8', '-l16'])
+
+    def test_AutoWithCuda(self):
+        cmd = self._get_build_cmd(['gcc-7', 'cuda-10.0', 'build-jobs=auto'])
+        self.assertEqual(cmd[-2:], ['-j6', '-l16'])
+
+    def test_Explicit(self):
+        cmd = self._get_build_cmd(['gcc-7', 'build-jobs=3'])
+        self.assertEqual(cmd[-1], '-j3')
+
+class TestAutoTestJobs(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, env={'NODE_NAME': 'bs_gpu01'})
+        self.helper.add_input_file('/proc/self/status', 'Cpus_allowed_list:\t0-15\n')
+        self.factory = self.helper.factory
+        self.factory.system = System.LINUX
+
+    def _process_options(self, opts):
+        e, o = process_build_options(self.factory, opts, BuildScriptSettings())
+        return e
+
+    def test_Auto(self):
+        e = self._process_options(['gcc-7', 'test-jobs=auto'])
+        self.assertEqual(e._test_jobs, 8)
+
+    def test_Explicit(self):
+        e = self._process_options(['gcc-7', 'test-jobs=3'])
+        self.assertEqual(e._test_jobs, 3)
+
+    def test_NotParallelByDefault(self):
+        e = self._process_options(['gcc-7'])
+        self.assertIsNone(e._test_jobs)
+
+class TestMemoryGovernor(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, env={'NODE_NAME': 'bs_mic'})
+        self.helper.add_input_file('/proc/meminfo', 'MemAvailable:   25165824 kB\n')
+        self.factory = self.helper.factory
+        self.factory.system = System.LINUX
+
+    def _process_options(self, opts):
+        e, o = process_build_options(self.factory, opts, BuildScriptSettings())
+        return e
+
+    def test_MakefilesLimitJobs(self):
+        e = self._process_options(['gcc-7', 'cuda-10.0', 'build-jobs=8', 'memory-governor'])
+        self.assertEqual(e._get_build_cmd()[-1], '-j4')
+        self.assertEqual(e._get_job_pool_cmake_options(), {})
+
+    def test_NinjaUsesJobPools(self):
+        e = self._process_options(['gcc-7', 'tsan', 'build-jobs=8', 'memory-governor'])
+        e.cmake_generator = 'Ninja'
+        self.assertEqual(e._get_build_cmd()[-1], '-j8')
+        self.assertEqual(e._get_job_pool_cmake_options(), {
+                'CMAKE_JOB_POOLS': 'compile=6;link=4',
+                'CMAKE_JOB_POOL_COMPILE': 'compile',
+                'CMAKE_JOB_POOL_LINK': 'link'
+            })
+
+    def test_InventoryMemoryIsUsedAsFallback(self):
+        self.helper = TestHelper(self, env={'NODE_NAME': 'bs_jetson_tk1'})
+        self.factory = self.helper.factory
+        self.factory.system = System.LINUX
+        e = self._process_options(['gcc-5', 'build-jobs=4', 'memory-governor'])
+        self.assertEqual(e._get_build_cmd()[-1], '-j2')
+
+    def test_Disabled(self):
+        e = self._process_options(['gcc-7', 'cuda-10.0', 'build-jobs=8'])
+        self.assertEqual(e._get_build_cmd()[-1], '-j8')
+
+if __name__ == '__main__':
+    unittest.main()
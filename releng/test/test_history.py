@@ -0,0 +1,57 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from releng.history import BuildHistory
+from releng.integration import MatrixRunInfo
+from releng.options import get_canonical_key
+
+class TestBuildHistory(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.history = BuildHistory(os.path.join(self.tempdir, 'history.db'))
+        self.time = 1000.0
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.tempdir)
+
+    def add_runs(self, opts, host, results, duration=600.0):
+        runs = []
+        for result in results:
+            url = 'http://jenkins/job/matrix/{0}/'.format(int(self.time))
+            runs.append(MatrixRunInfo(opts, host, result, url, duration, self.time))
+            self.time += 10.0
+        self.history.record_runs(runs, key=get_canonical_key)
+
+    def test_MedianDuration(self):
+        key = get_canonical_key(['gcc-5', 'mpi'])
+        self.add_runs(['gcc-5', 'mpi'], 'bs_nix-amd', ['SUCCESS'], 100.0)
+        self.add_runs(['mpi', 'gcc-5'], 'bs_nix-amd', ['SUCCESS'], 300.0)
+        self.add_runs(['gcc-5', 'mpi'], 'bs_mic', ['FAILURE'], 800.0)
+        self.assertEqual(self.history.get_median_duration(key), 300.0)
+        self.assertEqual(self.history.get_median_duration(key, host='bs_nix-amd'), 200.0)
+        self.assertEqual(self.history.get_median_duration(key, limit=2), 550.0)
+        self.assertIs(self.history.get_median_duration('gcc-7'), None)
+
+    def test_FailureRateAndFlakiness(self):
+        key = get_canonical_key(['gcc-5'])
+        self.add_runs(['gcc-5'], 'bs_mic',
+                ['SUCCESS', 'FAILURE', 'ABORTED', 'SUCCESS', 'UNSTABLE', 'SUCCESS'])
+        self.assertEqual(self.history.get_run_count(key), 6)
+        self.assertEqual(self.history.get_failure_rate(key), 0.4)
+        self.assertEqual(self.history.get_flakiness(key), 1.0)
+        self.assertEqual(self.history.get_failure_rate(key, limit=1), 0.0)
+        self.assertIs(self.history.get_flakiness(key, limit=1), None)
+
+    def test_RunsAreRecordedOnce(self):
+        run = MatrixRunInfo(['gcc-5'], 'bs_mic', 'SUCCESS', 'URL', 60.0, 10.0)
+        not_built = MatrixRunInfo(['gcc-7'], 'bs_mic', 'NOT_BUILT', None)
+        self.history.record_runs([run, not_built], key=get_canonical_key)
+        self.history.record_runs([run], key=get_canonical_key)
+        self.assertEqual(self.history.get_host_statistics(),
+                { 'bs_mic': { 'runs': 1, 'busy_time': 60.0, 'failures': 0 } })
+
+if __name__ == '__main__':
+    unittest.main()
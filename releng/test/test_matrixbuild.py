@@ -1,13 +1,21 @@
 import os.path
+import shutil
+import StringIO
+import tempfile
 import unittest
 # With Python 2.7, this needs to be separately installed.
 # With Python 3.3 and up, this should change to unittest.mock.
 import mock
 
-from releng.common import Project
-from releng.matrixbuild import prepare_build_matrix
+from releng.common import JobType, Project
+from releng.matrixbuild import prepare_build_matrix, process_matrix_failures, process_matrix_results
+from releng.failures import StaticConsoleFetcher, _read_tail
+from releng.history import BuildHistory
+from releng.integration import MatrixBuildInfo, MatrixRunInfo, RefSpec
+from releng.options import get_build_labels, get_canonical_key
+from releng.resultstore import ResultStore
 
-from releng.test.utils import TestHelper
+from releng.test.utils import RepositoryTestState, TestHelper
 
 class TestPrepareBuildMatrix(unittest.TestCase):
     def setUp(self):
@@ -39,5 +47,394 @@ class TestPrepareBuildMatrix(unittest.TestCase):
                 "as_axis": '"{0} host=bs_nix1310" "{1} host=bs-win2012r2"'.format(*[x.strip() for x in input_lines])
             })
 
+    def test_BuildsAreDistributedBetweenHosts(self):
+        input_lines = [
+                'gcc-5',
+                'gcc-5 double',
+                'gcc-5 mpi',
+                'gcc-5 tsan'
+            ]
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt',
+                '\n'.join(input_lines) + '\n')
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+        hosts = dict([(' '.join(x['opts']), x['host']) for x in result['configs']])
+        # tsan and mpi can each only be built on one of the hosts, so the
+        # plain configurations fill up the other host first.
+        self.assertEqual(hosts, {
+                'gcc-5': 'bs_nix-amd',
+                'gcc-5 double': 'bs_mic',
+                'gcc-5 mpi': 'bs_nix-amd',
+                'gcc-5 tsan': 'bs_mic'
+            })
+        result2 = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+        self.assertEqual(result2, result)
+
+    def test_DuplicateConfigurationsAreMerged(self):
+        input_lines = [
+                'gcc-5 no-mpi double',
+                'gcc-5 double=on mpi=off',
+                'gcc-5 mpi'
+            ]
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt',
+                '\n'.join(input_lines) + '\n')
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+        self.assertEqual([x['opts'] for x in result['configs']],
+                [['gcc-5', 'no-mpi', 'double'], ['gcc-5', 'mpi']])
+        self.assertEqual(result['merged'], [
+                {
+                    'opts': ['gcc-5', 'double=on', 'mpi=off'],
+                    'merged_into': ['gcc-5', 'no-mpi', 'double']
+                }
+            ])
+
+    def test_ExpensiveConfigurationsStartFirst(self):
+        input_lines = [
+                'gcc-5',
+                'gcc-5 tsan',
+                'gcc-6 cuda-9.0',
+                'gcc-5 mpi'
+            ]
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt',
+                '\n'.join(input_lines) + '\n')
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+        self.assertEqual([' '.join(x['opts']) for x in result['configs']],
+                ['gcc-5 tsan', 'gcc-6 cuda-9.0', 'gcc-5', 'gcc-5 mpi'])
+
+class TestShardedMatrix(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+
+    def test_ShardsAreBalancedByCost(self):
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt', '''\
+                gcc-5 tsan
+                gcc-5
+                gcc-5 double
+                gcc-5 mpi
+                gcc-6 cuda-9.0
+                ''')
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix', shards=2)
+        self.assertEqual(len(result['configs']), 5)
+        shards = [[' '.join(x['opts']) for x in shard['configs']] for shard in result['shards']]
+        self.assertEqual(shards, [
+                ['gcc-5 tsan', 'gcc-5 double'],
+                ['gcc-6 cuda-9.0', 'gcc-5', 'gcc-5 mpi']
+            ])
+        self.assertEqual(result['shards'][0]['as_axis'],
+                '"gcc-5 tsan host=bs_mic" "gcc-5 double host=bs_mic"')
+
+    def test_ResultsFromShardsAreMerged(self):
+        def run_data(opts, host, result):
+            url = 'http://jenkins/job/matrix/OPTIONS={0}%20host={1}/1/'.format(opts, host)
+            return { 'url': url, 'result': result }
+        build_info = {
+                'URL1': MatrixBuildInfo('SUCCESS', [run_data('gcc-5', 'bs_mic', 'SUCCESS')]),
+                'URL2': MatrixBuildInfo('FAILURE', [run_data('gcc-7', 'bs_mic', 'FAILURE')])
+            }
+        self.helper.add_input_json_file('matrix.json', {
+                'matrix': {
+                    'shards': [
+                        { 'configs': [{ 'opts': ['gcc-5'], 'host': 'bs_mic', 'labels': 'gcc-5' }] },
+                        { 'configs': [{ 'opts': ['gcc-7'], 'host': 'bs_mic', 'labels': 'gcc-7' }] }
+                    ]
+                },
+                'build_urls': ['URL1', 'URL2']
+            })
+        factory = self.helper.factory
+        with mock.patch.object(factory.jenkins, 'query_matrix_build', side_effect=build_info.get):
+            runs = process_matrix_results(factory, 'matrix.json')
+        self.assertEqual([(x['opts'], x['result']) for x in runs],
+                [(['gcc-5'], 'SUCCESS'), (['gcc-7'], 'FAILURE')])
+        self.assertTrue(factory.status_reporter.failed)
+
+    def test_RetriedRunsReplaceRunsInShards(self):
+        def run_data(opts, result, number):
+            url = 'http://jenkins/job/matrix/OPTIONS={0}%20host=bs_mic/{1}/'.format(opts, number)
+            return { 'url': url, 'result': result }
+        build_info = {
+                'URL1': MatrixBuildInfo('FAILURE', [run_data('gcc-5', 'FAILURE', 1)]),
+                'URL2': MatrixBuildInfo('FAILURE', [run_data('gcc-7', 'FAILURE', 2)]),
+                'URL3': MatrixBuildInfo('SUCCESS', [run_data('gcc-5', 'SUCCESS', 3),
+                    run_data('gcc-7', 'SUCCESS', 3)])
+            }
+        self.helper.add_input_json_file('matrix.json', {
+                'matrix': {
+                    'shards': [
+                        { 'configs': [{ 'opts': ['gcc-5'], 'host': 'bs_mic', 'labels': 'gcc-5' }] },
+                        { 'configs': [{ 'opts': ['gcc-7'], 'host': 'bs_mic', 'labels': 'gcc-7' }] }
+                    ]
+                },
+                'build_urls': ['URL1', 'URL2'],
+                'retry_build_url': 'URL3'
+            })
+        factory = self.helper.factory
+        with mock.patch.object(factory.jenkins, 'query_matrix_build',
+                side_effect=build_info.get) as query:
+            runs = process_matrix_results(factory, 'matrix.json')
+        self.assertEqual([(x['result'], x['url'][-2]) for x in runs],
+                [('SUCCESS', '3'), ('SUCCESS', '3')])
+        self.assertEqual(query.call_count, 3)
+        self.assertFalse(factory.status_reporter.failed)
+
+class TestFailureClassification(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self, workspace='/ws')
+
+    def test_InfrastructureFailuresAreRetried(self):
+        def run_data(opts, result):
+            url = 'http://jenkins/job/matrix/OPTIONS={0}%20host=bs_mic/1/'.format(opts)
+            return { 'url': url, 'result': result }
+        runs_data = [
+                run_data('gcc-5', 'FAILURE'),
+                run_data('gcc-7', 'FAILURE'),
+                run_data('gcc-8', 'UNSTABLE')
+            ]
+        build_info = MatrixBuildInfo('FAILURE', runs_data)
+        factory = self.helper.factory
+        factory.jenkins.console_fetcher = StaticConsoleFetcher({
+                runs_data[0]['url']: 'Building...\nFATAL: hudson.remoting.ChannelClosedException: Channel closed\n',
+                runs_data[1]['url']: 'Building...\nerror: expected declaration\nBuild step failed\n',
+                runs_data[2]['url']: 'Running tests...\nFAILED: 2 tests failed\n'
+            })
+        configs = [
+                { 'opts': ['gcc-5'], 'host': 'bs_mic', 'labels': 'gcc-5' },
+                { 'opts': ['gcc-7'], 'host': 'bs_mic', 'labels': 'gcc-7' },
+                { 'opts': ['gcc-8'], 'host': 'bs_mic', 'labels': 'gcc-8' },
+                { 'opts': ['gcc-9'], 'host': 'bs_mic', 'labels': 'gcc-9' }
+            ]
+        with mock.patch.object(factory.jenkins, 'query_matrix_build', return_value=build_info):
+            runs = process_matrix_failures(factory, configs, 'URL')
+        self.assertEqual([x.get('failure_class', None) for x in runs],
+                ['infrastructure', 'build', 'build', 'not-built'])
+        self.assertEqual([x.get('failure_reason', None) for x in runs],
+                ['agent lost', None, None, None])
+        # The retry goes to another agent than the one that was lost.
+        self.assertEqual([x['retry_axis'] for x in runs if 'retry_axis' in x],
+                ['"gcc-5 host=bs_nix-amd"'])
+
+    def test_NoRetryWithoutOtherAgent(self):
+        url = 'http://jenkins/job/matrix/OPTIONS=icc-17%20host=bs_mic/1/'
+        build_info = MatrixBuildInfo('FAILURE', [{ 'url': url, 'result': 'FAILURE' }])
+        factory = self.helper.factory
+        factory.jenkins.console_fetcher = StaticConsoleFetcher({
+                url: 'Building...\nFATAL: hudson.remoting.ChannelClosedException: Channel closed\n'
+            })
+        configs = [{ 'opts': ['icc-17'], 'host': 'bs_mic', 'labels': 'icc-17' }]
+        with mock.patch.object(factory.jenkins, 'query_matrix_build', return_value=build_info):
+            runs = process_matrix_failures(factory, configs, 'URL')
+        self.assertEqual(runs[0]['failure_class'], 'infrastructure')
+        self.assertNotIn('retry_axis', runs[0])
+
+    def test_RetriedRunsReplaceOriginalRuns(self):
+        def run_data(opts, result, number):
+            url = 'http://jenkins/job/matrix/OPTIONS={0}%20host=bs_mic/{1}/'.format(opts, number)
+            return { 'url': url, 'result': result }
+        build_info = {
+                'URL1': MatrixBuildInfo('FAILURE', [run_data('gcc-5', 'FAILURE', 1), run_data('gcc-7', 'SUCCESS', 1)]),
+                'URL2': MatrixBuildInfo('SUCCESS', [run_data('gcc-5', 'SUCCESS', 2)])
+            }
+        configs = [
+                { 'opts': ['gcc-5'], 'host': 'bs_mic', 'labels': 'gcc-5' },
+                { 'opts': ['gcc-7'], 'host': 'bs_mic', 'labels': 'gcc-7' }
+            ]
+        factory = self.helper.factory
+        with mock.patch.object(factory.jenkins, 'query_matrix_build', side_effect=build_info.get):
+            runs = process_matrix_failures(factory, configs, 'URL1', retry_build_url='URL2')
+        self.assertEqual([(x['result'], x['url'][-2]) for x in runs],
+                [('SUCCESS', '2'), ('SUCCESS', '1')])
+        self.assertFalse(factory.status_reporter.failed)
+
+class TestReadConsoleTail(unittest.TestCase):
+    def test_KeepsOnlyTail(self):
+        fp = StringIO.StringIO('x' * 200000 + 'last line\n')
+        self.assertEqual(_read_tail(fp, 100, 1000000)[-10:], 'last line\n')
+
+    def test_TooLongLogIsNotRead(self):
+        fp = StringIO.StringIO('x' * 200000)
+        self.assertIsNone(_read_tail(fp, 100, 100000))
+
+class TestChangeImpactPruning(unittest.TestCase):
+    def setUp(self):
+        commits = RepositoryTestState()
+        commits.set_commit(Project.GROMACS, change_number=1234)
+        commits.set_commit(Project.REGRESSIONTESTS)
+        commits.set_commit(Project.RELENG)
+        self.helper = TestHelper(self, commits=commits, workspace='/ws', env={
+                'GERRIT_PROJECT': 'gromacs',
+                'GERRIT_REFSPEC': commits.gromacs.refspec,
+                'GROMACS_REFSPEC': commits.gromacs.refspec
+            })
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt', '''\
+                gcc-5
+                gcc-5 double
+                gcc-6 cuda-9.0
+                ''')
+        self.helper.add_input_file('/ws/gromacs/admin/builds/matrix-impact.txt', '''\
+                docs/*: -
+                src/gromacs/gpu_utils/*.cu: cuda-*
+                src/gromacs/fft/*: gcc-* msvc-*
+                ''')
+
+    def prepare(self, changed_files, job_type=JobType.GERRIT):
+        self.helper.set_changed_files(Project.GROMACS, changed_files)
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix',
+                job_type=job_type)
+        return [x['opts'] for x in result['configs']], result.get('pruned', [])
+
+    def test_PrunesUnaffectedConfigurations(self):
+        configs, pruned = self.prepare(['src/gromacs/gpu_utils/gpu_utils.cu', 'docs/index.rst'])
+        self.assertEqual(configs, [['gcc-6', 'cuda-9.0']])
+        self.assertEqual(pruned, [{ 'opts': ['gcc-5'] }, { 'opts': ['gcc-5', 'double'] }])
+
+    def test_UnmappedFileAffectsAllConfigurations(self):
+        configs, pruned = self.prepare(['src/gromacs/gpu_utils/gpu_utils.cu', 'CMakeLists.txt'])
+        self.assertEqual(len(configs), 3)
+        self.assertEqual(pruned, [])
+
+    def test_KeepsOneConfigurationForDocsOnlyChange(self):
+        configs, pruned = self.prepare(['docs/index.rst'])
+        self.assertEqual(configs, [['gcc-5']])
+        self.assertEqual(len(pruned), 2)
+
+    def test_NoPruningForOtherJobTypes(self):
+        configs, pruned = self.prepare(['docs/index.rst'], job_type=JobType.NIGHTLY)
+        self.assertEqual(len(configs), 3)
+        self.assertEqual(pruned, [])
+
+    def test_NoPruningWithOtherChanges(self):
+        change = RefSpec('refs/changes/22/2222/3')
+        self.helper.factory.projects.override_refspec(Project.REGRESSIONTESTS, change)
+        configs, pruned = self.prepare(['docs/index.rst'])
+        self.assertEqual(len(configs), 3)
+        self.assertEqual(pruned, [])
+
+    def test_MergeCommitIsComparedToFirstParent(self):
+        self.helper.set_changed_files(Project.GROMACS, ['docs/index.rst'])
+        self.helper.factory.projects.checkout_project(Project.GROMACS)
+        paths = self.helper.factory.workspace.get_changed_files(Project.GROMACS)
+        self.assertEqual(paths, ['docs/index.rst'])
+        args, kwargs = self.helper.executor.check_output.call_args
+        self.assertEqual(args[0], ['git', 'diff', '--name-only', 'HEAD^1', 'HEAD', '--'])
+
+    def test_NoPruningForEmptyDiff(self):
+        configs, pruned = self.prepare([])
+        self.assertEqual(len(configs), 3)
+        self.assertEqual(pruned, [])
+
+    def test_NoPruningForRootCommit(self):
+        configs, pruned = self.prepare(None)
+        self.assertEqual(len(configs), 3)
+        self.assertEqual(pruned, [])
+
+class TestHistoryOrdering(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.history_path = os.path.join(self.tempdir, 'history.db')
+        self.helper = TestHelper(self, workspace='/ws', env={
+                'RELENG_HISTORY_DB': self.history_path
+            })
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_RiskyAndLongConfigurationsStartFirst(self):
+        build_history = BuildHistory(self.history_path)
+        runs = [
+                MatrixRunInfo(['gcc-5'], 'bs_mic', 'SUCCESS', 'URL1', 600.0, 10.0),
+                MatrixRunInfo(['gcc-5', 'double'], 'bs_mic', 'SUCCESS', 'URL2', 1200.0, 10.0),
+                MatrixRunInfo(['gcc-5', 'mpi'], 'bs_nix-amd', 'FAILURE', 'URL3', 300.0, 10.0),
+                MatrixRunInfo(['gcc-5', 'mpi'], 'bs_nix-amd', 'SUCCESS', 'URL4', 300.0, 20.0)
+            ]
+        build_history.record_runs(runs, key=get_canonical_key)
+        build_history.close()
+        self.helper.add_input_file('/ws/gromacs/admin/builds/pre-submit-matrix.txt', '''\
+                gcc-5
+                gcc-5 mpi
+                gcc-5 double
+                gcc-5 x11
+                ''')
+        result = prepare_build_matrix(self.helper.factory, 'pre-submit-matrix')
+        # x11 has no history, so it is considered as risky as mpi (which
+        # failed half of the time), and its duration is estimated from the
+        # other configurations, which makes it longer than mpi.
+        self.assertEqual([' '.join(x['opts']) for x in result['configs']],
+                ['gcc-5 x11', 'gcc-5 mpi', 'gcc-5 double', 'gcc-5'])
+
+class TestBuildAvoidance(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.tempdir, 'results.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def prepare(self, input_lines, matrix='pre-submit-matrix', job_type=JobType.GERRIT,
+            commits=None):
+        helper = TestHelper(self, commits=commits, workspace='/ws', env={
+                'RELENG_RESULT_STORE': self.store_path
+            })
+        helper.add_input_file('/ws/gromacs/admin/builds/{0}.txt'.format(matrix),
+                '\n'.join(input_lines) + '\n')
+        return prepare_build_matrix(helper.factory, matrix, job_type=job_type)
+
+    def record_toolchains(self, result, fingerprint):
+        store = ResultStore(self.store_path)
+        for config in result['configs']:
+            store.record_toolchain(config['host'], get_build_labels(config['opts']), fingerprint)
+        store.close()
+
+    def record_results(self, result):
+        store = ResultStore(self.store_path)
+        for config in result['configs']:
+            store.record(config['result_key'], config['opts'], 'SUCCESS', 'URL')
+        store.close()
+
+    def test_VerifiedConfigurationsAreSkipped(self):
+        result = self.prepare(['gcc-5', 'gcc-5 double', 'gcc-5 mpi'])
+        self.record_toolchains(result, 'toolchain')
+        result = self.prepare(['gcc-5', 'gcc-5 double', 'gcc-5 mpi'])
+        self.assertNotIn('verified', result)
+        keys = [x['result_key'] for x in result['configs']]
+        self.assertEqual(len(set(keys)), 3)
+        store = ResultStore(self.store_path)
+        store.record(keys[1], ['gcc-5', 'double'], 'SUCCESS', 'URL')
+        store.close()
+        # Equivalent options produce the same key.
+        result = self.prepare(['gcc-5', 'gcc-5 mpi', 'gcc-5 double=on'])
+        self.assertEqual([x['opts'] for x in result['configs']], [['gcc-5'], ['gcc-5', 'mpi']])
+        self.assertEqual(result['verified'], [
+                { 'opts': ['gcc-5', 'double=on'], 'result': 'SUCCESS', 'url': 'URL' }
+            ])
+
+    def test_OtherJobTypeOrMatrixIsNotVerified(self):
+        result = self.prepare(['gcc-5', 'gcc-5 double'])
+        self.record_toolchains(result, 'toolchain')
+        self.record_results(self.prepare(['gcc-5', 'gcc-5 double']))
+        self.assertIn('verified', self.prepare(['gcc-5', 'gcc-5 double']))
+        result = self.prepare(['gcc-5', 'gcc-5 double'], job_type=JobType.NIGHTLY)
+        self.assertNotIn('verified', result)
+        result = self.prepare(['gcc-5', 'gcc-5 double'], matrix='release-matrix')
+        self.assertNotIn('verified', result)
+
+    def test_UnknownToolchainIsNotVerified(self):
+        result = self.prepare(['gcc-5', 'gcc-5 double'])
+        self.record_results(result)
+        self.assertNotIn('verified', self.prepare(['gcc-5', 'gcc-5 double']))
+
+    def test_ChangedToolchainIsNotVerified(self):
+        result = self.prepare(['gcc-5', 'gcc-5 double'])
+        self.record_toolchains(result, 'toolchain')
+        self.record_results(self.prepare(['gcc-5', 'gcc-5 double']))
+        self.record_toolchains(result, 'updated toolchain')
+        self.assertNotIn('verified', self.prepare(['gcc-5', 'gcc-5 double']))
+
+    def test_ChangedRelengIsNotVerified(self):
+        result = self.prepare(['gcc-5', 'gcc-5 double'])
+        self.record_toolchains(result, 'toolchain')
+        self.record_results(self.prepare(['gcc-5', 'gcc-5 double']))
+        commits = RepositoryTestState()
+        commits.set_commit(Project.GROMACS)
+        commits.set_commit(Project.RELENG, sha1='4567890abcdef0123456789abcdef0123456789a')
+        self.assertNotIn('verified', self.prepare(['gcc-5', 'gcc-5 double'], commits=commits))
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,8 +3,10 @@ import unittest
 from releng.test.utils import TestHelper
 
 from releng.common import Enum, Simd
+from releng.environment import BuildEnvironment
 from releng.options import OptionTypes
-from releng.options import process_build_options
+from releng.options import get_canonical_key, process_build_options
+from releng.options import _LabelOnlyEnvironment, _define_handlers
 from releng.script import BuildScriptSettings
 
 class TestProcessBuildOptions(unittest.TestCase):
@@ -41,3 +43,38 @@ class TestProcessBuildOptions(unittest.TestCase):
         self.assertEqual(o.ex_bool, True)
         self.assertEqual(o.ex_string, 'foo')
         self.assertEqual(o.ex_enum, TestEnum.BAR)
+
+class TestCanonicalKey(unittest.TestCase):
+    def test_EquivalentSpellings(self):
+        self.assertEqual(get_canonical_key(['no-mpi', 'gcc-7']),
+                get_canonical_key(['gcc-7', 'mpi=off', 'host=bs_mic']))
+        self.assertEqual(get_canonical_key(['double', 'no-openmp']),
+                get_canonical_key(['double=on', 'openmp=no']))
+        self.assertEqual(get_canonical_key(['simd=avx_256']),
+                get_canonical_key(['simd=AVX_256']))
+
+    def test_DifferentConfigurations(self):
+        self.assertNotEqual(get_canonical_key(['gcc-7', 'mpi']),
+                get_canonical_key(['gcc-7', 'no-mpi']))
+        self.assertNotEqual(get_canonical_key(['gcc-7']),
+                get_canonical_key(['gcc-8']))
+        self.assertNotEqual(get_canonical_key(['gcc-7', 'foo=1']),
+                get_canonical_key(['gcc-7', 'foo']))
+
+class TestLabelOnlyEnvironment(unittest.TestCase):
+    def test_AllHandlersResolve(self):
+        callbacks = set()
+        class RecordingEnvironment(object):
+            def __getattr__(self, name):
+                callbacks.add(name)
+                return lambda *args: None
+        _define_handlers(RecordingEnvironment(), None)
+        self.assertTrue(callbacks)
+        env = _LabelOnlyEnvironment()
+        for name in callbacks:
+            self.assertTrue(hasattr(BuildEnvironment, name), name)
+            self.assertIsNone(getattr(env, name)('value'), name)
+
+    def test_OtherAttributesAreNotResolved(self):
+        with self.assertRaises(AttributeError):
+            _LabelOnlyEnvironment().c_compiler
@@ -0,0 +1,63 @@
+import os.path
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+from releng.common import ConfigurationError
+from releng.profiling import profile
+
+from releng.test.utils import TestHelper
+
+def _busy_function(duration):
+    end = time.time() + duration
+    count = 0
+    while time.time() < end:
+        count += 1
+    return count
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        self.workspace = tempfile.mkdtemp()
+        self.log_dir = os.path.join(self.workspace, 'logs')
+
+    def tearDown(self):
+        shutil.rmtree(self.workspace)
+
+    def _run_profiled(self, mode):
+        env = dict()
+        if mode:
+            env['RELENG_PROFILE'] = mode
+        helper = TestHelper(self, workspace=self.workspace, env=env)
+        with profile(helper.factory, 'test'):
+            _busy_function(0.1)
+
+    def test_Disabled(self):
+        self._run_profiled(None)
+        self.assertFalse(os.path.exists(self.log_dir))
+
+    def test_WallClock(self):
+        self._run_profiled('wall')
+        stats = pstats.Stats(os.path.join(self.log_dir, 'profile-test.pstats'))
+        functions = [func[2] for func in stats.stats]
+        self.assertIn('_busy_function', functions)
+        with open(os.path.join(self.log_dir, 'profile-test.collapsed.txt')) as fp:
+            lines = fp.readlines()
+        self.assertTrue(lines)
+        self.assertTrue(any('_busy_function' in line for line in lines))
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+
+    def test_Cpu(self):
+        self._run_profiled('CPU')
+        self.assertTrue(os.path.isfile(os.path.join(self.log_dir, 'profile-test.pstats')))
+        self.assertTrue(os.path.isfile(os.path.join(self.log_dir, 'profile-test.collapsed.txt')))
+
+    def test_InvalidMode(self):
+        with self.assertRaises(ConfigurationError):
+            self._run_profiled('memory')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,25 @@
+import unittest
+
+from releng.resourcespec import create_resource_spec
+
+class TestCreateResourceSpec(unittest.TestCase):
+    def test_CpuOnly(self):
+        topology = [[[0, 4], [1, 5]], [[2, 6], [3, 7]]]
+        spec = create_resource_spec(topology)
+        self.assertEqual(spec, {
+                'version': {'major': 1, 'minor': 0},
+                'local': [{
+                        'cpus': [{'id': '0', 'slots': 2}, {'id': '2', 'slots': 2}]
+                    }]
+            })
+
+    def test_Gpus(self):
+        topology = [[[0], [1], [2], [3]]]
+        spec = create_resource_spec(topology, gpus=2)
+        self.assertEqual(spec['local'], [{
+                'cpus': [{'id': '0', 'slots': 4}],
+                'gpus': [{'id': '0', 'slots': 1}, {'id': '1', 'slots': 1}]
+            }])
+
+if __name__ == '__main__':
+    unittest.main()
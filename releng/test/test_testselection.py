@@ -0,0 +1,90 @@
+import unittest
+
+from releng.testselection import TargetInfo, read_codemodel, select_tests
+
+from releng.test.utils import TestHelper
+
+def _target(name, sources, artifacts=None, dependencies=None):
+    data = {
+            'id': name + '::@1',
+            'name': name,
+            'sources': [{'path': x} for x in sources],
+            'artifacts': [{'path': x} for x in (artifacts or [])],
+            'dependencies': [{'id': x + '::@1'} for x in (dependencies or [])]
+        }
+    return TargetInfo(data, '/build')
+
+class TestSelectTests(unittest.TestCase):
+    def setUp(self):
+        self.targets = [
+                _target('libgromacs', ['src/gromacs/a.cpp', 'src/gromacs/b.cpp']),
+                _target('mdrun-test', ['src/mdrun/tests/c.cpp'], ['bin/mdrun-test'], ['libgromacs']),
+                _target('utility-test', ['src/utility/tests/d.cpp'], ['bin/utility-test']),
+                _target('docs', ['docs/index.rst'])
+            ]
+        self.tests = [
+                ('MdrunTests', ['/build/bin/mdrun-test', '--gtest_output=xml']),
+                ('MdrunMpiTests', ['/usr/bin/mpiexec', '-np', '2', '/build/bin/mdrun-test']),
+                ('UtilityTests', ['/build/bin/utility-test']),
+                ('RegressionTests', ['/usr/bin/perl', 'gmxtest.pl'])
+            ]
+
+    def test_DependencyChange(self):
+        selection = select_tests(self.tests, self.targets, ['src/gromacs/b.cpp'])
+        self.assertEqual(selection.tests,
+                ['MdrunTests', 'MdrunMpiTests', 'RegressionTests'])
+        self.assertEqual(selection.affected_targets, ['libgromacs', 'mdrun-test'])
+
+    def test_SmokeTestsAreAlwaysSelected(self):
+        selection = select_tests(self.tests, self.targets, ['src/utility/tests/d.cpp'],
+                smoke_tests=['MdrunTests'])
+        self.assertEqual(selection.tests, ['MdrunTests', 'UtilityTests', 'RegressionTests'])
+
+    def test_NoAffectedTests(self):
+        selection = select_tests(self.tests, self.targets, ['docs/index.rst'])
+        self.assertEqual(selection.tests, ['RegressionTests'])
+
+    def test_UnknownFileSelectsAll(self):
+        selection = select_tests(self.tests, self.targets,
+                ['src/gromacs/a.cpp', 'src/gromacs/a.h'])
+        self.assertIsNone(selection.tests)
+
+    def test_NoCodemodelSelectsAll(self):
+        selection = select_tests(self.tests, None, ['src/gromacs/a.cpp'])
+        self.assertIsNone(selection.tests)
+
+class TestReadCodemodel(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+
+    def test_Read(self):
+        reply = '.cmake/api/v1/reply/'
+        self.helper.add_input_json_file(reply + 'index-2019-01-01T00-00-00-0000.json', {
+                'reply': {'codemodel-v2': {'jsonFile': 'codemodel-v2-old.json'}}
+            })
+        self.helper.add_input_json_file(reply + 'index-2020-01-01T00-00-00-0000.json', {
+                'reply': {'codemodel-v2': {'jsonFile': 'codemodel-v2-1234.json'}}
+            })
+        self.helper.add_input_json_file(reply + 'codemodel-v2-1234.json', {
+                'paths': {'build': '/build', 'source': '/src'},
+                'configurations': [{'targets': [{'jsonFile': 'target-test.json'}]}]
+            })
+        self.helper.add_input_json_file(reply + 'target-test.json', {
+                'id': 'test::@1',
+                'name': 'test',
+                'sources': [{'path': 'src/test.cpp'}],
+                'artifacts': [{'path': 'bin/test'}],
+                'dependencies': [{'id': 'lib::@1'}]
+            })
+        targets = read_codemodel(self.helper.executor)
+        self.assertEqual(len(targets), 1)
+        self.assertEqual(targets[0].name, 'test')
+        self.assertEqual(targets[0].sources, set(['src/test.cpp']))
+        self.assertEqual(targets[0].artifacts, set(['/build/bin/test']))
+        self.assertEqual(targets[0].dependencies, ['lib::@1'])
+
+    def test_NoReply(self):
+        self.assertIsNone(read_codemodel(self.helper.executor))
+
+if __name__ == '__main__':
+    unittest.main()
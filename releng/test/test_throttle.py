@@ -0,0 +1,93 @@
+import os
+import select
+import unittest
+# With Python 2.7, this needs to be separately installed.
+# With Python 3.3 and up, this should change to unittest.mock.
+import mock
+
+from releng.common import JobType, System
+from releng.context import BuildContext
+from releng.throttle import AdaptiveJobServer, compute_target_jobs
+
+from releng.test.utils import TestHelper
+
+_GiB = 2**30
+
+class TestComputeTargetJobs(unittest.TestCase):
+    def test_Overloaded(self):
+        self.assertEqual(compute_target_jobs(8, 8, 20.0, 16, 32 * _GiB, _GiB), 6)
+        self.assertEqual(compute_target_jobs(2, 8, 20.0, 16, 32 * _GiB, _GiB), 1)
+        self.assertEqual(compute_target_jobs(1, 8, 20.0, 16, 32 * _GiB, _GiB), 1)
+
+    def test_LowMemory(self):
+        self.assertEqual(compute_target_jobs(8, 8, 4.0, 16, _GiB // 2, _GiB), 6)
+
+    def test_Headroom(self):
+        self.assertEqual(compute_target_jobs(4, 8, 4.0, 16, 32 * _GiB, _GiB), 5)
+        self.assertEqual(compute_target_jobs(8, 8, 4.0, 16, None, _GiB), 8)
+
+    def test_Steady(self):
+        self.assertEqual(compute_target_jobs(4, 8, 14.0, 16, 32 * _GiB, _GiB), 4)
+
+def _count_tokens(fd):
+    count = 0
+    while select.select([fd], [], [], 0)[0]:
+        os.read(fd, 1)
+        count += 1
+    return count
+
+@mock.patch('releng.hardware.get_total_cpu_count', return_value=16)
+class TestAdaptiveJobServer(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+
+    def test_Adjust(self, cpu_count):
+        server = AdaptiveJobServer(self.helper.executor, 8, _GiB, interval=60)
+        with server:
+            self.assertIn('-j8 --jobserver-fds=', server.makeflags)
+            server.adjust(30.0, None)
+            server.adjust(30.0, None)
+            self.assertEqual(server.jobs, 5)
+            server.adjust(4.0, None)
+            self.assertEqual(server.jobs, 6)
+            # make has one implicit token.
+            self.assertEqual(_count_tokens(server._read_fd), 5)
+        self.helper.assertConsoleOutput("""\
+            adaptive-jobs: load 30.0 on 16 CPUs, available memory unknown: reducing build jobs from 8 to 6
+            adaptive-jobs: load 30.0 on 16 CPUs, available memory unknown: reducing build jobs from 6 to 5
+            adaptive-jobs: load 4.0 on 16 CPUs, available memory unknown: increasing build jobs from 5 to 6
+            """)
+
+class TestAdaptiveBuildTarget(unittest.TestCase):
+    def setUp(self):
+        self.helper = TestHelper(self)
+        self.helper.factory.system = System.LINUX
+
+    def test_BuildTarget(self):
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.build_target(target='all')
+                """)
+        BuildContext._run_build(self.helper.factory,
+                'script/build.py', JobType.GERRIT, ['build-jobs=4', 'adaptive-jobs'])
+        args, kwargs = self.helper.executor.check_call.call_args
+        self.assertEqual(args[0], ['cmake', '--build', '.', '--target', 'all', '--'])
+        self.assertTrue(kwargs['env']['MAKEFLAGS'].startswith('-j4 --jobserver-fds='))
+
+    def test_MemoryGovernorLimitsJobs(self):
+        self.helper = TestHelper(self, env={'NODE_NAME': 'bs_mic'})
+        self.helper.factory.system = System.LINUX
+        self.helper.add_input_file('/proc/meminfo', 'MemAvailable:   25165824 kB\n')
+        self.helper.add_input_file('script/build.py',
+                """\
+                def do_build(context):
+                    context.build_target(target='all')
+                """)
+        BuildContext._run_build(self.helper.factory, 'script/build.py', JobType.GERRIT,
+                ['gcc-7', 'cuda-10.0', 'build-jobs=8', 'adaptive-jobs', 'memory-governor'])
+        args, kwargs = self.helper.executor.check_call.call_args
+        self.assertTrue(kwargs['env']['MAKEFLAGS'].startswith('-j4 --jobserver-fds='))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -111,6 +111,7 @@ class TestHelper(object):
         self.executor.check_output.side_effect = self._check_output
         self.executor.read_file.side_effect = self._read_file
         self.executor.write_file.side_effect = self._write_file
+        self.executor.list_dir.side_effect = self._list_dir
         self.reset_console_output()
 
         if env is None:
@@ -135,6 +136,9 @@ class TestHelper(object):
             self.reset_console_output()
         self._input_files = dict()
         self._output_files = dict()
+        self._changed_files = dict()
+        self._ctest_tests = []
+        self._ctest_commands = dict()
 
     def reset_console_output(self):
         self._console = StringIO()
@@ -150,6 +154,26 @@ class TestHelper(object):
             if not commit:
                 raise CommandError('commit not found: ' + cmd[4])
             return '{0} {1}\n'.format(commit.sha1, commit.title)
+        elif cmd == ['git', 'rev-parse', 'HEAD^{tree}']:
+            project = Project.parse(os.path.basename(kwargs['cwd']))
+            return self._commits.get_head(project).sha1[::-1] + '\n'
+        elif os.path.basename(cmd[0]) == 'ctest' and '--show-only=json-v1' in cmd:
+            tests = [{'name': x, 'command': self._ctest_commands.get(x, [])}
+                    for x in self._ctest_tests]
+            return json.dumps({'kind': 'ctestInfo', 'tests': tests})
+        elif os.path.basename(cmd[0]) == 'ctest' and '-N' in cmd:
+            lines = ['Test project ' + kwargs.get('cwd', '')]
+            for index, name in enumerate(self._ctest_tests):
+                lines.append('  Test #{0}: {1}'.format(index + 1, name))
+            lines.append('')
+            lines.append('Total Tests: {0}'.format(len(self._ctest_tests)))
+            return '\n'.join(lines) + '\n'
+        elif cmd == ['git', 'diff', '--name-only', 'HEAD^1', 'HEAD', '--']:
+            project = Project.parse(os.path.basename(kwargs['cwd']))
+            paths = self._changed_files.get(project, [])
+            if paths is None:
+                raise CommandError('HEAD has no parent')
+            return ''.join([x + '\n' for x in paths])
         elif cmd[:2] == ['git', 'ls-remote']:
             git_url = urlparse.urlsplit(cmd[2])
             project = Project.parse(os.path.splitext(git_url.path[1:])[0])
@@ -178,13 +202,32 @@ class TestHelper(object):
         return None
 
     def _read_file(self, path):
+        if path in self._output_files:
+            return self._output_files[path].splitlines(True)
         if path not in self._input_files:
             raise IOError(path + ': not part of test')
         return self._input_files[path]
 
-    def _write_file(self, path, contents):
+    def _list_dir(self, path):
+        prefix = path.rstrip('/') + '/'
+        names = set([x[len(prefix):].split('/')[0] for x in self._input_files
+            if x.startswith(prefix)])
+        if not names:
+            raise OSError(path + ': not part of test')
+        return sorted(names)
+
+    def _write_file(self, path, contents, compress=False):
+        if not isinstance(contents, basestring):
+            contents = ''.join(contents)
         self._output_files[path] = contents
 
+    def set_ctest_tests(self, names, commands=None):
+        self._ctest_tests = names
+        self._ctest_commands = commands or dict()
+
+    def set_changed_files(self, project, paths):
+        self._changed_files[project] = paths
+
     def add_input_file(self, path, contents):
         lines = textwrap.dedent(contents).splitlines(True)
         self._input_files[path] = lines
@@ -0,0 +1,199 @@
+"""
+Selection of tests affected by a change
+
+For pre-submit builds, most of the test time is spent on tests that a small
+change cannot affect.  This module maps the files changed by the commit
+being built to the tests that can be affected: a test is affected if its
+executable is built from a target that (directly or through the targets it
+depends on) has one of the changed files as a source.
+
+The target information comes from the CMake file-based API (with the
+``test-selection`` build option, a codemodel query is written into the build
+tree before CMake runs, and CMake writes the reply during configuration), and
+the test executables from ``ctest --show-only=json-v1``.  Both need CMake
+3.14 or newer.
+
+The selection is conservative: if any changed file is not a source of any
+target (e.g., a header, a CMake file, or a file that is not built at all), or
+if the information is not available, all tests are considered affected.
+Tests whose command line does not contain the artifact of any target (e.g.,
+script-driven tests such as the regression tests) can depend on anything, and
+are always selected.
+"""
+
+import json
+import os.path
+
+# First CMake version that supports the file-based API and JSON test lists.
+MINIMUM_CMAKE_VERSION = '3.14'
+
+_API_DIR = '.cmake/api/v1'
+
+def write_codemodel_query(executor):
+    """Requests the codemodel from CMake in the current build directory.
+
+    Needs to be called before CMake is run for the reply to be generated.
+    """
+    query_dir = os.path.join(_API_DIR, 'query')
+    executor.ensure_dir_exists(query_dir)
+    executor.write_file(os.path.join(query_dir, 'codemodel-v2'), '')
+
+def _read_json(executor, path):
+    return json.loads(''.join(executor.read_file(path)))
+
+class TargetInfo(object):
+    """Information about a build target from the CMake codemodel.
+
+    Attributes:
+        id (str): Unique identifier of the target.
+        name (str): Name of the target.
+        sources (Set[str]): Source files, relative to the top-level source
+            directory (or absolute if outside it).
+        artifacts (Set[str]): Absolute paths of the files that the target
+            produces.
+        dependencies (List[str]): Identifiers of targets this target
+            directly depends on.
+    """
+
+    def __init__(self, data, build_dir):
+        self.id = data['id']
+        self.name = data['name']
+        self.sources = set([x['path'] for x in data.get('sources', [])])
+        self.artifacts = set([os.path.normpath(os.path.join(build_dir, x['path']))
+            for x in data.get('artifacts', [])])
+        self.dependencies = [x['id'] for x in data.get('dependencies', [])]
+
+def read_codemodel(executor):
+    """Reads the targets from the CMake codemodel reply.
+
+    Returns:
+        List[TargetInfo] or None: Targets in the first configuration, or
+            None if there is no reply (e.g., CMake is too old).
+    """
+    reply_dir = os.path.join(_API_DIR, 'reply')
+    try:
+        indices = [x for x in executor.list_dir(reply_dir)
+                if x.startswith('index-') and x.endswith('.json')]
+    except (IOError, OSError):
+        return None
+    if not indices:
+        return None
+    index = _read_json(executor, os.path.join(reply_dir, max(indices)))
+    codemodel_ref = index.get('reply', dict()).get('codemodel-v2', None)
+    if not codemodel_ref or 'jsonFile' not in codemodel_ref:
+        return None
+    codemodel = _read_json(executor, os.path.join(reply_dir, codemodel_ref['jsonFile']))
+    build_dir = codemodel['paths']['build']
+    configuration = codemodel['configurations'][0]
+    targets = []
+    for target_ref in configuration.get('targets', []):
+        data = _read_json(executor, os.path.join(reply_dir, target_ref['jsonFile']))
+        targets.append(TargetInfo(data, build_dir))
+    return targets
+
+def parse_ctest_json(output):
+    """Parses the output of ``ctest --show-only=json-v1``.
+
+    Returns:
+        List[Tuple[str, List[str]]]: Name and command line of each test, in
+            CTest order.
+    """
+    data = json.loads(output)
+    return [(x['name'], x.get('command', [])) for x in data.get('tests', [])]
+
+class TestSelection(object):
+    """Result of selecting tests for a change.
+
+    Attributes:
+        tests (List[str]): Selected tests, in CTest order, or None if all
+            tests need to be run.
+        reason (str): Why all tests need to be run (if tests is None).
+        changed_files (List[str]): Files changed by the change.
+        affected_targets (List[str]): Names of targets affected by the change.
+        smoke_tests (List[str]): Tests that are always selected.
+    """
+
+    def __init__(self, tests, reason, changed_files, affected_targets, smoke_tests):
+        self.tests = tests
+        self.reason = reason
+        self.changed_files = changed_files
+        self.affected_targets = affected_targets
+        self.smoke_tests = smoke_tests
+
+    def to_dict(self):
+        return {
+                'tests': self.tests,
+                'reason': self.reason,
+                'changed_files': self.changed_files,
+                'affected_targets': self.affected_targets,
+                'smoke_tests': self.smoke_tests
+            }
+
+def _get_affected_targets(targets, changed_files):
+    """Returns the ids of targets affected by changed files.
+
+    Returns None if some changed file is not a source of any target.
+    """
+    changed = set(changed_files)
+    sources = set()
+    for target in targets:
+        sources.update(target.sources)
+    if changed - sources:
+        return None
+    directly_affected = set([x.id for x in targets if x.sources & changed])
+    by_id = dict([(x.id, x) for x in targets])
+    affected = set()
+    for target in targets:
+        stack = [target.id]
+        seen = set()
+        while stack:
+            current = stack.pop()
+            if current in seen or current not in by_id:
+                continue
+            seen.add(current)
+            stack.extend(by_id[current].dependencies)
+        if seen & directly_affected:
+            affected.add(target.id)
+    return affected
+
+def select_tests(tests, targets, changed_files, smoke_tests=None):
+    """Selects the tests affected by changed files.
+
+    Args:
+        tests (List[Tuple[str, List[str]]]): Tests from parse_ctest_json().
+        targets (List[TargetInfo]): Targets from read_codemodel(), or None
+            if not available.
+        changed_files (List[str]): Changed files relative to the top-level
+            source directory, or None if not known.
+        smoke_tests (Optional[List[str]]): Names of tests that are always
+            selected.
+
+    Tests that do not run an artifact of any target are always selected.
+
+    Returns:
+        TestSelection: The selection.
+    """
+    smoke_tests = sorted(smoke_tests or [])
+    def run_all(reason):
+        return TestSelection(None, reason, changed_files, [], smoke_tests)
+    if changed_files is None:
+        return run_all('changed files are not known')
+    if targets is None:
+        return run_all('no CMake codemodel available')
+    affected_ids = _get_affected_targets(targets, changed_files)
+    if affected_ids is None:
+        return run_all('changed files that are not sources of any target')
+    all_artifacts = set()
+    artifacts = set()
+    for target in targets:
+        all_artifacts.update(target.artifacts)
+        if target.id in affected_ids:
+            artifacts.update(target.artifacts)
+    selected = []
+    for name, command in tests:
+        command = set([os.path.normpath(x) for x in command])
+        unknown = not command & all_artifacts
+        if name in smoke_tests or unknown or command & artifacts:
+            selected.append(name)
+    affected_names = sorted([x.name for x in targets if x.id in affected_ids])
+    return TestSelection(selected, None, changed_files, affected_names, smoke_tests)
@@ -0,0 +1,131 @@
+"""
+Adaptive throttling of parallel builds
+
+Provides a GNU make jobserver whose number of tokens follows the load of the
+build agent.  When another executor on the same agent starts a heavy build
+(or memory runs low), tokens are withheld from make to reduce the number of
+concurrent compilation jobs, and they are returned when there is headroom
+again.  The adjustments are written to the build log.
+"""
+from __future__ import print_function
+
+import os
+import select
+import threading
+
+import hardware
+
+# Load average (relative to the number of CPUs in the system) above which
+# the number of jobs is reduced, and below which it is increased again.
+_HIGH_LOAD = 1.0
+_LOW_LOAD = 0.75
+
+def compute_target_jobs(current, max_jobs, load, cpus, memory, memory_per_job):
+    """Computes a new number of parallel jobs from the current system state.
+
+    The number of jobs is reduced by a quarter (at least by one) if the
+    system is overloaded or memory is running out, and increased by one when
+    there is headroom, up to max_jobs.
+
+    Args:
+        current (int): Current number of jobs.
+        max_jobs (int): Maximum number of jobs.
+        load (float): Current load average.
+        cpus (int): Number of CPUs in the system.
+        memory (int or None): Available memory in bytes (None if not known).
+        memory_per_job (int): Estimated memory use per job in bytes.
+    """
+    low_memory = memory is not None and memory < memory_per_job
+    if low_memory or load > _HIGH_LOAD * cpus:
+        return max(1, current - max(1, current // 4))
+    enough_memory = memory is None or memory > 2 * memory_per_job
+    if enough_memory and load < _LOW_LOAD * cpus:
+        return min(max_jobs, current + 1)
+    return current
+
+class AdaptiveJobServer(object):
+    """GNU make jobserver that adapts the number of jobs to the system load.
+
+    Use as a context manager around running the build, and pass
+    ``makeflags`` to the build in the ``MAKEFLAGS`` environment variable
+    (without a ``-j`` option on the command line).  The file descriptors of
+    the jobserver pipe need to be inherited by the build process.
+
+    Args:
+        executor (Executor): Executor for console output and reading system
+            information.
+        max_jobs (int): Maximum (and initial) number of parallel jobs.
+        memory_per_job (int): Estimated memory use per job in bytes.
+        interval (float): Interval in seconds for checking the system state.
+    """
+
+    def __init__(self, executor, max_jobs, memory_per_job, interval=5.0):
+        self._executor = executor
+        self.max_jobs = max_jobs
+        self.jobs = max_jobs
+        self._memory_per_job = memory_per_job
+        self._interval = interval
+        self._cpus = hardware.get_total_cpu_count()
+        self._withheld = 0
+        self._read_fd = None
+        self._write_fd = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def makeflags(self):
+        """Value for MAKEFLAGS that makes make use this jobserver."""
+        return '-j{0} --jobserver-fds={1},{2}'.format(self.max_jobs,
+                self._read_fd, self._write_fd)
+
+    def __enter__(self):
+        self._read_fd, self._write_fd = os.pipe()
+        # make itself holds one implicit token.
+        os.write(self._write_fd, b'+' * (self.max_jobs - 1))
+        self._thread = threading.Thread(target=self._run, name='releng-jobserver')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stop.set()
+        # Wait for the thread to finish (the stop event makes it return
+        # after the current check) before closing the pipe it uses.
+        self._thread.join()
+        os.close(self._read_fd)
+        os.close(self._write_fd)
+        return False
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            self.adjust(os.getloadavg()[0], hardware.get_available_memory(self._executor))
+
+    def adjust(self, load, memory):
+        """Adjusts the number of jobs based on the given system state."""
+        target = compute_target_jobs(self.jobs, self.max_jobs, load, self._cpus,
+                memory, self._memory_per_job)
+        if target != self.jobs:
+            if memory is None:
+                memory_info = 'unknown'
+            else:
+                memory_info = '{0:.1f} GiB'.format(float(memory) / 2**30)
+            print('adaptive-jobs: load {0:.1f} on {1} CPUs, available memory {2}: {3} build jobs from {4} to {5}'.format(
+                load, self._cpus, memory_info,
+                'reducing' if target < self.jobs else 'increasing',
+                self.jobs, target), file=self._executor.console)
+            self.jobs = target
+        self._update_tokens()
+
+    def _update_tokens(self):
+        withhold = self.max_jobs - self.jobs
+        while self._withheld > withhold:
+            os.write(self._write_fd, b'+')
+            self._withheld -= 1
+        # Tokens that are in use by make cannot be taken back immediately;
+        # the rest are withheld when make returns them, on a later check.
+        while self._withheld < withhold:
+            readable, dummy, dummy = select.select([self._read_fd], [], [], 0)
+            if not readable:
+                break
+            os.read(self._read_fd, 1)
+            self._withheld += 1
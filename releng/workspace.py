@@ -19,16 +19,24 @@ class CheckedOutProject(object):
         root (str): Root directory where the project has been checked out.
         tarball_path (str): Path to the tarball where the project has been
             extracted from (if it exists).
+        refspec (RefSpec): Refspec that was checked out (None if the project
+            was checked out outside the Python code).
     """
 
-    def __init__(self, root, tarball_path=None):
+    def __init__(self, root, tarball_path=None, refspec=None):
         self.root = root
         self.tarball_path = tarball_path
+        self.refspec = refspec
 
     @property
     def is_tarball(self):
         return self.tarball_path is not None
 
+    @property
+    def is_no_op(self):
+        """Whether the project is a local checkout that was used as is."""
+        return self.refspec is not None and self.refspec.is_no_op
+
 class Workspace(object):
     """Provides access to set up, query, and act within the build workspace,
     particularly involving operations on the git repositories associated
@@ -53,7 +61,8 @@ class Workspace(object):
         self._checkouts = dict()
         self._build_dir = None
         self._out_of_source = None
-        self._logs_dir = os.path.join(self.root, 'logs')
+        self._logs_root = os.path.join(self.root, 'logs')
+        self._logs_dir = self._logs_root
         self.install_dir = os.path.join(self.root, 'test-install')
 
     def _set_initial_checkouts(self, projects):
@@ -85,6 +94,49 @@ class Workspace(object):
             raise
         return title, sha1
 
+    def get_changed_files(self, project):
+        """Returns files changed by the commit checked out for a project.
+
+        Args:
+            project (Project): Project whose changes should be returned.
+
+        The commit is compared against its first parent, so that a merge
+        commit reports everything it brings in.
+
+        Returns:
+            List[str] or None: Paths relative to the project root, or None if
+                the changes cannot be determined (e.g., for a tarball, for a
+                root commit, or if the diff is empty).
+        """
+        project_info = self._get_checkout_info(project)
+        if project_info.is_tarball:
+            return None
+        cmd = ['git', 'diff', '--name-only', 'HEAD^1', 'HEAD', '--']
+        try:
+            output = self._cmd_runner.check_output(cmd, cwd=project_info.root)
+        except CommandError:
+            return None
+        paths = [x for x in output.splitlines() if x]
+        if not paths:
+            return None
+        return paths
+
+    def get_tree_hash(self, project):
+        """Returns the git tree hash of the commit checked out for a project.
+
+        Returns:
+            str or None: The hash, or None if it cannot be determined.
+        """
+        project_info = self._get_checkout_info(project)
+        if project_info.is_tarball:
+            return None
+        cmd = ['git', 'rev-parse', 'HEAD^{tree}']
+        try:
+            output = self._cmd_runner.check_output(cmd, cwd=project_info.root)
+        except CommandError:
+            return None
+        return output.strip() or None
+
     def _ensure_empty_dir(self, path):
         """Ensures that the given directory exists and is empty."""
         self._executor.ensure_dir_exists(path, ensure_empty=True)
@@ -98,9 +150,26 @@ class Workspace(object):
         else:
             self._build_dir = self.get_project_dir(self._default_project)
 
+    def _init_config_dirs(self, name, out_of_source):
+        """Initializes directories for one configuration in run_builds().
+
+        The build directory (for out-of-source builds) and the log directory
+        are separate subdirectories for each configuration.  For in-source
+        builds, the source directory is cleaned instead as in
+        clean_build_dir().
+        """
+        self._logs_dir = os.path.join(self._logs_root, name)
+        self._executor.remove_path(self.install_dir)
+        self._out_of_source = out_of_source
+        if out_of_source:
+            self._build_dir = os.path.join(self.root, 'build', name)
+        else:
+            self._build_dir = self.get_project_dir(self._default_project)
+        self.clean_build_dir()
+
     def _clear_workspace_dirs(self):
         """Clears directories that get generated for each build."""
-        self._executor.remove_path(self._logs_dir)
+        self._executor.remove_path(self._logs_root)
         self._executor.remove_path(self.install_dir)
 
     def clean_build_dir(self):
@@ -112,7 +181,7 @@ class Workspace(object):
             if project_info.is_tarball:
                 self._executor.remove_path(project_info.root)
                 self._extract_tarball(project_info.tarball_path)
-            elif not project_info.refspec.is_no_op:
+            elif not project_info.is_no_op:
                 self._run_git_clean(project_info.root)
 
     def _resolve_build_input_file(self, path, extension=None):
@@ -209,7 +278,7 @@ class Workspace(object):
             if not refspec.is_no_op:
                 self._do_git_checkout(project, refspec)
             project_dir = os.path.join(self.root, project)
-            project_info = CheckedOutProject(project_dir)
+            project_info = CheckedOutProject(project_dir, refspec=refspec)
         self._checkouts[project] = project_info
 
     def _extract_tarball(self, tarball_path):
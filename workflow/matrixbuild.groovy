@@ -1,4 +1,4 @@
-def processMatrixConfigs(filename)
+def processMatrixConfigs(filename, shards = 1)
 {
     // Information is returned as a list of configurations and as a string
     // suitable as a dynamic axis in a matrix build:
@@ -11,24 +11,111 @@ def processMatrixConfigs(filename)
     //       },
     //       ...
     //    ],
-    //    as_axis: ...
+    //    as_axis: ...,
+    //    merged: [ { opts: [...], merged_into: [...] }, ... ],
+    //    pruned: [ { opts: [...] }, ... ],
+    //    verified: [ { opts: [...], result: ..., url: ... }, ... ]
     //  }
+    // merged, pruned and verified are only present if some configurations
+    // were removed as duplicates, as not affected by the triggering change,
+    // or as already verified for identical sources.  The verified ones are
+    // included in the runs returned by processMatrixResults().
+    // If shards is larger than one, there is also
+    //    shards: [ { configs: [...], as_axis: ... }, ... ]
+    // and doMatrixBuild() builds each shard as a separate matrix build.
     def status = utils.runRelengScriptNoCheckout("""\
-        releng.prepare_multi_configuration_build('${filename}')
+        releng.prepare_multi_configuration_build('${filename}', shards=${shards})
         """)
     return status.return_value
 }
 
 def doMatrixBuild(jobName, matrix)
 {
-    def parameters = utils.currentBuildParametersForJenkins()
-    parameters += [$class: 'StringParameterValue', name: 'OPTIONS', value: matrix.as_axis]
-    def bld = build job: jobName, parameters: parameters, propagate: false
+    if (matrix.shards) {
+        return doShardedMatrixBuild(jobName, matrix)
+    }
+    def bld = triggerMatrixBuild(jobName, matrix.as_axis)
     status = processMatrixResults(matrix, bld)
-    return [ jobName: jobName, build: bld, status: status ]
+    def builds = [bld]
+    def retryAxis = getRetryAxis(status)
+    if (retryAxis) {
+        echo "Retrying configurations with infrastructure failures: ${retryAxis}"
+        def retryBld = triggerMatrixBuild(jobName, retryAxis)
+        status = processMatrixResults(matrix, bld, retryBld)
+        builds += retryBld
+    }
+    return [ jobName: jobName, build: bld, builds: builds, status: status, matrix: matrix ]
+}
+
+def getRetryAxis(status)
+{
+    // Runs that failed because of the infrastructure (e.g., a lost agent)
+    // have retry_axis set to their value for the OPTIONS axis, with the
+    // host replaced by another agent than where they failed.
+    if (!status.return_value) {
+        return null
+    }
+    def values = status.return_value.findAll { it.retry_axis }.collect { it.retry_axis }
+    return values ? values.join(' ') : null
+}
+
+def triggerMatrixBuild(jobName, axis)
+{
+    def parameters = utils.currentBuildParametersForJenkins()
+    parameters += [$class: 'StringParameterValue', name: 'OPTIONS', value: axis]
+    return build(job: jobName, parameters: parameters, propagate: false)
+}
+
+def doShardedMatrixBuild(jobName, matrix)
+{
+    // All shards are builds of the same job, so the job must allow
+    // concurrent builds; otherwise, the shards run one after another.
+    def builds = new Object[matrix.shards.size()]
+    def branches = [:]
+    for (int i = 0; i < matrix.shards.size(); ++i) {
+        def index = i
+        branches["shard ${index + 1}"] = {
+            builds[index] = triggerMatrixBuild(jobName, matrix.shards[index].as_axis)
+        }
+    }
+    parallel branches
+    builds = builds as List
+    def status = processShardedMatrixResults(matrix, builds)
+    def allBuilds = builds
+    def retryAxis = getRetryAxis(status)
+    if (retryAxis) {
+        // Configurations from all shards are retried in a single build.
+        echo "Retrying configurations with infrastructure failures: ${retryAxis}"
+        def retryBld = triggerMatrixBuild(jobName, retryAxis)
+        status = processShardedMatrixResults(matrix, builds, retryBld)
+        allBuilds = builds + retryBld
+    }
+    return [ jobName: jobName, build: builds[0], builds: allBuilds, status: status, matrix: matrix ]
+}
+
+def processShardedMatrixResults(matrix, builds, retryBld = null)
+{
+    // Same as processMatrixResults(), but for the builds of all shards.
+    def status
+    node ('pipeline-general') {
+        def data = [ 'matrix': matrix, 'build_urls': builds.collect { it.absoluteUrl } ]
+        if (retryBld) {
+            data['retry_build_url'] = retryBld.absoluteUrl
+        }
+        utils.writeJsonFile('build/matrix.json', data)
+        status = utils.runRelengScript("""\
+            releng.process_multi_configuration_build_results('build/matrix.json')
+            """, false)
+    }
+    if (!retryBld) {
+        for (def bld : builds) {
+            status.result = utils.combineResults(status.result, bld.result)
+        }
+    }
+    return status
 }
 
-def processMatrixResults(matrix, bld)
+def processMatrixResults(matrix, bld, retryBld = null)
 {
     // Additional information is returned in status.return_value as
     // a list of runs:
@@ -37,26 +124,41 @@ def processMatrixResults(matrix, bld)
     //       opts: [...],
     //       host: ...,
     //       result: ...,
-    //       url: ...
+    //       url: ...,
+    //       failure_class: ...,
+    //       failure_reason: ...,
+    //       retry_axis: ...
     //     },
     //     ...
     //   ]
+    // The failure_* fields are present for unsuccessful runs, and
+    // retry_axis for runs that failed because of the infrastructure.
+    // If retryBld is given, its runs replace the runs of the same
+    // configurations in bld.
     def status
     node ('pipeline-general') {
         def data = [ 'matrix': matrix, 'build_url': bld.absoluteUrl ]
+        if (retryBld) {
+            data['retry_build_url'] = retryBld.absoluteUrl
+        }
         utils.writeJsonFile('build/matrix.json', data)
         status = utils.runRelengScript("""\
             releng.process_multi_configuration_build_results('build/matrix.json')
             """, false)
     }
-    status.result = utils.combineResults(status.result, bld.result)
+    if (!retryBld) {
+        status.result = utils.combineResults(status.result, bld.result)
+    }
     return status
 }
 
 def addSummaryForMatrix(result)
 {
+    def links = result.builds.collect {
+        """<a href="${it.absoluteUrl}">${result.jobName} #${it.number}</a>"""
+    }
     def text = """\
-        Matrix build: <a href="${result.build.absoluteUrl}">${result.jobName} #${result.build.number}</a>
+        Matrix build: ${links.join(', ')}
         <table>
           <tr>
             <td>Configuration</td>
@@ -80,6 +182,17 @@ def addSummaryForMatrix(result)
                 """.stripIndent()
         }
     }
+    if (result.matrix?.pruned) {
+        for (def config : result.matrix.pruned) {
+            text += """\
+                <tr>
+                  <td>${config.opts.join(' ')}</td>
+                  <td></td>
+                  <td>PRUNED (not affected by the change)</td>
+                </tr>
+                """.stripIndent()
+        }
+    }
     text += "</table>"
     manager.createSummary('empty').appendText(text, false)
 }
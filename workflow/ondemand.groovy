@@ -31,6 +31,8 @@ def processTriggeringCommentAndGetActions()
     //       // opaque data passed back to do_ondemand_post_build()
     //     }
     //   }
+    // The revisions and the matrix configurations are computed in this same
+    // call, so there are no separate initialization calls to batch.
     def status = utils.runRelengScriptNoCheckout("""\
         releng.get_actions_from_triggering_comment()
         """)
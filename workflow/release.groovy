@@ -3,8 +3,14 @@ matrixbuild = load 'releng/workflow/matrixbuild.groovy'
 packaging = load 'releng/workflow/packaging.groovy'
 buildRevisions = utils.initBuildRevisions('gromacs')
 utils.checkoutDefaultProject()
-testMatrix = matrixbuild.processMatrixConfigs('release-matrix.txt')
-sourceVersionInfo = utils.readSourceVersion()
+// The rest of the initialization needs the gromacs checkout above, so it is
+// batched after it (otherwise, the Python code would check out gromacs itself).
+initInfo = utils.runRelengBatch("""[
+        ['prepare_multi_configuration_build', 'release-matrix.txt', 1, 'release'],
+        'read_source_version_info'
+    ]""")
+testMatrix = initInfo.prepare_multi_configuration_build
+sourceVersionInfo = initInfo.read_source_version_info
 
 def doBuild(sourcePackageJob, regressiontestsPackageJob)
 {
@@ -148,7 +154,7 @@ def testTarballs(tarballBuilds, testMatrix)
 def runSingleTestConfig(tarballBuilds, config)
 {
     // TODO: This should be config.labels, once Jenkins has all the labels
-    // defined matching agents.py.
+    // defined matching agents.json.
     node(config.host) {
         config.host = env.NODE_NAME
         getTarball(tarballBuilds.gromacs)
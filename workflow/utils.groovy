@@ -114,6 +114,10 @@ def runRelengScriptInternal(prepareScript, contents, propagate)
     } catch (err) {
         handleRelengError(statusFile)
         throw err
+    } finally {
+        if (env.RELENG_PROFILE) {
+            archiveArtifacts artifacts: 'logs/profile-*', allowEmptyArchive: true
+        }
     }
     def status = readJsonFile(statusFile)
     if (propagate) {
@@ -292,6 +296,18 @@ def readSourceVersion()
     return status.return_value
 }
 
+def runRelengBatch(operations)
+{
+    // The operations are passed as a Python list literal, e.g.,
+    //   "[ 'get_build_revisions', ['read_build_script_config', 'clang-format'] ]"
+    // Information is returned as a map from the operation name to the
+    // value that the corresponding individual call would return.
+    def status = runRelengScriptNoCheckout("""\
+        releng.run_batch(${operations})
+        """)
+    return status.return_value
+}
+
 @NonCPS
 def setCombinedBuildResult(results)
 {